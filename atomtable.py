@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+"""
+Columnar atom and residue tables, and a streaming PDB reader that
+fills them.
+
+An AtomTable holds one numpy array per attribute instead of one
+Python object per atom, so that a structure costs a few tens of
+bytes per atom and every stage of RenderedSoup can work on whole
+columns at once. The objid of an atom is its row in the table.
+"""
+
+
+import os
+
+import numpy as np
+
+import profiling
+
+
+default_res_color = [0.4, 1.0, 0.4]
+
+
+class AtomTable():
+  """
+  Struct-of-arrays table of a structure. Atom columns have one row
+  per atom, residue columns one row per residue, and the atoms of
+  residue i are the rows res_starts[i]:res_starts[i+1].
+  """
+  def __init__(self, n_atom=0, n_res=0, n_chain=0):
+    # atom columns
+    self.positions = np.zeros((n_atom, 3), dtype=np.float64)
+    self.atom_types = np.zeros(n_atom, dtype='S4')
+    self.elements = np.zeros(n_atom, dtype='S2')
+    self.alt_confs = np.zeros(n_atom, dtype='S1')
+    self.res_indices = np.zeros(n_atom, dtype=np.int32)
+    self.objids = np.arange(n_atom, dtype=np.int32)
+
+    # residue columns
+    self.res_starts = np.zeros(n_res+1, dtype=np.int64)
+    self.res_types = np.zeros(n_res, dtype='S4')
+    self.res_nums = np.zeros(n_res, dtype=np.int32)
+    self.res_inserts = np.zeros(n_res, dtype='S1')
+    self.chain_indices = np.zeros(n_res, dtype=np.int32)
+    self.ss = np.full(n_res, '-', dtype='S1')
+    self.colors = np.tile(default_res_color, (n_res, 1))
+
+    # chain columns
+    self.chain_ids = np.zeros(n_chain, dtype='S1')
+
+  def get_n_atom(self):
+    return len(self.positions)
+
+  def get_n_res(self):
+    return len(self.res_types)
+
+  def get_n_byte(self):
+    """
+    Returns the number of bytes held by all the columns.
+    """
+    return sum(a.nbytes for a in self.__dict__.values()
+               if isinstance(a, np.ndarray))
+
+  def get_columns(self):
+    """
+    Returns a dict of every column array by name.
+    """
+    return dict(
+        (name, value) for name, value in self.__dict__.items()
+        if isinstance(value, np.ndarray))
+
+  def find_res_atoms(self, atom_type):
+    """
+    Returns the index of the atom of atom_type in every residue,
+    or -1 for residues without one.
+    """
+    i_atoms = np.nonzero(self.atom_types == atom_type)[0]
+    result = np.full(self.get_n_res(), -1, dtype=np.int64)
+    result[self.res_indices[i_atoms]] = i_atoms
+    return result
+
+  def get_res_tags(self):
+    """
+    Returns the 'chain:num<insert>' tag of every residue.
+    """
+    tags = []
+    chain_ids = self.chain_ids[self.chain_indices]
+    for chain_id, res_num, res_insert in zip(
+        chain_ids.tolist(), self.res_nums.tolist(),
+        self.res_inserts.tolist()):
+      tag = ''
+      if chain_id.strip():
+        tag += chain_id + ':'
+      tags.append(tag + str(res_num) + res_insert.strip())
+    return tags
+
+  def get_atom_labels(self):
+    """
+    Returns the 'tag-res_type-atom_type' label of every atom.
+    """
+    prefixes = np.array([
+        '%s-%s-' % (tag, res_type)
+        for tag, res_type in zip(self.get_res_tags(), self.res_types)])
+    if len(prefixes) == 0:
+      return np.zeros(0, dtype='S1')
+    return np.char.add(prefixes[self.res_indices], self.atom_types)
+
+
+
+def table_from_columns(columns):
+  """
+  Returns an AtomTable that wraps the arrays of get_columns, such
+  as read-only memory-mapped ones. Only ss and colors, which
+  RenderedSoup writes to, are copied.
+  """
+  table = AtomTable()
+  for name, value in columns.items():
+    setattr(table, name, value)
+  table.ss = np.array(table.ss)
+  table.colors = np.array(table.colors)
+  return table
+
+
+
+##################################################
+# Streaming PDB reader
+
+
+def get_column(lines, i, j):
+  """
+  Returns column [i, j) of the (n, 80) char array lines as an
+  array of strings.
+  """
+  return np.ascontiguousarray(lines[:,i:j]).view('S%d' % (j-i)).ravel()
+
+
+def strip_column(strs):
+  """
+  Returns strs with whitespace stripped, stripping each distinct
+  value only once.
+  """
+  uniques, inverse = np.unique(strs, return_inverse=True)
+  return np.char.strip(uniques)[inverse]
+
+
+def parse_ints(strs):
+  try:
+    return strs.astype(np.int64)
+  except ValueError:
+    # hybrid-36 or other non-decimal fields
+    ints = np.zeros(len(strs), dtype=np.int64)
+    for i, s in enumerate(strs.tolist()):
+      try:
+        ints[i] = int(s)
+      except ValueError:
+        pass
+    return ints
+
+
+def guess_elements(elements, atom_types):
+  """
+  Fills in blank elements from the first letter of the atom type.
+  """
+  is_blank = elements == ''
+  if not is_blank.any():
+    return elements
+  elements = elements.copy()
+  for atom_type in np.unique(atom_types[is_blank]).tolist():
+    letters = [c for c in atom_type if c.isalpha()]
+    element = letters[0].upper() if letters else ''
+    elements[is_blank & (atom_types == atom_type)] = element
+  return elements
+
+
+def parse_floats(lines, i, j, n_decimal=3):
+  """
+  Returns column [i, j) of the (n, 80) char array lines as floats.
+  Fields written as '%8.3f' are converted by integer arithmetic on 
+  the digits, which rounds exactly like float(); any other layout
+  falls back to a string conversion.
+  """
+  chars = np.ascontiguousarray(lines[:,i:j]).view(np.uint8)
+  i_dot = j - i - n_decimal - 1
+  digits = np.delete(chars, i_dot, axis=1).astype(np.int64) - ord('0')
+  is_digit = (digits >= 0) & (digits <= 9)
+  is_minus = digits == ord('-') - ord('0')
+  is_space = digits == ord(' ') - ord('0')
+  if (chars[:,i_dot] != ord('.')).any() or \
+      not (is_digit | is_minus | is_space).all() or \
+      (is_minus.sum(axis=1) > 1).any():
+    return get_column(lines, i, j).astype(np.float64)
+  powers = 10**np.arange(digits.shape[1]-1, -1, -1)
+  values = (np.where(is_digit, digits, 0)*powers).sum(axis=1)/10.0**n_decimal
+  return np.where(is_minus.any(axis=1), -values, values)
+
+
+def split_lines(text, width=80):
+  """
+  Returns the lines of text as an (n, width) char array, cut or 
+  padded with spaces to width, without a Python loop over lines.
+  """
+  chars = np.frombuffer(text, dtype=np.uint8)
+  ends = np.nonzero(chars == ord('\n'))[0]
+  starts = np.append(0, ends[:-1] + 1)
+  # drop the carriage return of DOS line endings
+  if len(ends) and (chars[ends - 1] == ord('\r')).any():
+    ends = ends - (chars[ends - 1] == ord('\r'))
+  n_line = len(ends)
+  lengths = ends - starts
+  stride = starts[1] - starts[0] if n_line > 1 else len(chars)
+  if n_line and (lengths == lengths[0]).all() and \
+      (starts == stride*np.arange(n_line)).all():
+    # every line has the same length, as in most PDB files
+    lines = chars[:n_line*stride].reshape(n_line, stride)[:,:min(width, lengths[0])]
+    if lengths[0] < width:
+      padding = np.full((n_line, width - lengths[0]), ord(' '), dtype=np.uint8)
+      lines = np.hstack([lines, padding])
+    return np.ascontiguousarray(lines).view('S1')
+  # gather each line clamped to its end, then blank out the padding
+  indices = starts[:,np.newaxis] + np.arange(width, dtype=starts.dtype)
+  is_inside = indices < ends[:,np.newaxis]
+  lines = chars[np.minimum(indices, ends[:,np.newaxis])]
+  lines[~is_inside] = ord(' ')
+  return lines.view('S1')
+
+
+def iter_atom_blocks(f, block_size=2**22, is_all_models=False):
+  """
+  Yields (lines, i_models) for the ATOM and HETATM records in the 
+  open file f, reading about block_size bytes at a time, where 
+  lines is an (n, 80) char array and i_models holds the model index
+  of each line. Only the first model is read unless is_all_models.
+  """
+  remainder = ''
+  i_model = 0
+  while True:
+    block = f.read(block_size)
+    if not block:
+      if not remainder:
+        return
+      block = '\n'
+    text = remainder + block
+    i_end = text.rfind('\n') + 1
+    text, remainder = text[:i_end], text[i_end:]
+    if not text:
+      continue
+    lines = split_lines(text)
+    records = get_column(lines, 0, 6)
+    is_endmdl = records == 'ENDMDL'
+    is_last = not is_all_models and is_endmdl.any()
+    if is_last:
+      n_line = np.nonzero(is_endmdl)[0][0]
+      lines, records, is_endmdl = \
+          lines[:n_line], records[:n_line], is_endmdl[:n_line]
+    is_atom = (records == 'ATOM  ') | (records == 'HETATM')
+    if is_atom.any():
+      i_models = i_model + np.cumsum(is_endmdl)
+      yield lines[is_atom], i_models[is_atom]
+    if is_last:
+      return
+    i_model += is_endmdl.sum()
+
+
+def count_models(fname, block_size=2**22):
+  """
+  Returns the number of models in the PDB file fname, counted from
+  the ENDMDL records without parsing any atoms.
+  """
+  n_model = 0
+  remainder = ''
+  with open(fname) as f:
+    while True:
+      block = f.read(block_size)
+      if not block:
+        break
+      text = remainder + block
+      i_end = text.rfind('\n')
+      n_model += text[:max(i_end, 0)].count('\nENDMDL')
+      remainder = text[max(i_end, 0):]
+  n_model += remainder.count('\nENDMDL')
+  return max(1, n_model)
+
+
+def read_columns(fname, block_size=2**22, is_all_models=False):
+  """
+  Returns a dict of the raw per-line columns of the atom records in
+  the PDB file fname, or None if there are none.
+  """
+  blocks = []
+  with open(fname) as f:
+    for lines, i_models in iter_atom_blocks(f, block_size, is_all_models):
+      blocks.append({
+        'positions': np.array([
+            parse_floats(lines, 30, 38),
+            parse_floats(lines, 38, 46),
+            parse_floats(lines, 46, 54)]).T,
+        'atom_types': strip_column(get_column(lines, 12, 16)),
+        'type_keys': get_column(lines, 12, 16).view(np.uint32),
+        'alt_confs': get_column(lines, 16, 17),
+        'res_types': strip_column(get_column(lines, 17, 21)),
+        'res_keys': get_column(lines, 21, 27),
+        'chain_ids': get_column(lines, 21, 22),
+        'res_nums': get_column(lines, 22, 26),
+        'res_inserts': get_column(lines, 26, 27),
+        'elements': strip_column(get_column(lines, 76, 78)),
+        'i_models': i_models,
+      })
+  if not blocks:
+    return None
+  return dict(
+      (key, np.concatenate([b[key] for b in blocks])) for key in blocks[0])
+
+
+def build_table(columns):
+  """
+  Returns (table, is_kept) for the raw columns of one model, where
+  is_kept marks the lines that became atoms of the AtomTable. Like
+  pdbremix, only the first atom of each type in a residue is kept,
+  which drops the alternate conformations.
+  """
+  n_line = len(columns['res_keys'])
+
+  # a new residue starts whenever chain, number or insertion changes
+  res_keys = columns['res_keys']
+  is_res_start = np.ones(n_line, dtype=bool)
+  is_res_start[1:] = res_keys[1:] != res_keys[:-1]
+  i_res_starts = np.nonzero(is_res_start)[0]
+  res_indices = np.cumsum(is_res_start) - 1
+
+  # keep the first atom of each type in a residue
+  keys = (res_indices.astype(np.int64) << 32) | columns['type_keys']
+  is_kept = np.zeros(n_line, dtype=bool)
+  is_kept[np.unique(keys, return_index=True)[1]] = True
+
+  res_chain_ids = columns['chain_ids'][i_res_starts]
+  is_chain_start = np.ones(len(i_res_starts), dtype=bool)
+  is_chain_start[1:] = res_chain_ids[1:] != res_chain_ids[:-1]
+
+  n_atom = is_kept.sum()
+  table = AtomTable(n_atom, len(i_res_starts), is_chain_start.sum())
+  table.positions[:] = columns['positions'][is_kept]
+  table.atom_types[:] = columns['atom_types'][is_kept]
+  table.alt_confs[:] = columns['alt_confs'][is_kept]
+  table.res_indices[:] = res_indices[is_kept]
+  table.elements[:] = guess_elements(
+      np.char.upper(columns['elements'][is_kept]), table.atom_types)
+
+  table.res_starts[:-1] = np.searchsorted(
+      table.res_indices, np.arange(table.get_n_res()))
+  table.res_starts[-1] = n_atom
+  table.res_types[:] = columns['res_types'][i_res_starts]
+  table.res_nums[:] = parse_ints(columns['res_nums'][i_res_starts])
+  table.res_inserts[:] = columns['res_inserts'][i_res_starts]
+  table.chain_indices[:] = np.cumsum(is_chain_start) - 1
+  table.chain_ids[:] = res_chain_ids[is_chain_start]
+  return table, is_kept
+
+
+def read_pdb(fname, block_size=2**22):
+  """
+  Returns an AtomTable of the first model in the PDB file fname.
+  The file is streamed in blocks, split into lines with numpy and 
+  every fixed-width column is converted with one call per block.
+  """
+  with profiling.span('parse', fname=fname) as span:
+    columns = read_columns(fname, block_size)
+    if columns is None:
+      return AtomTable()
+    table = build_table(columns)[0]
+    span.count('atoms', table.get_n_atom())
+    span.count('file_bytes', os.path.getsize(fname))
+  return table
+
+
+def read_pdb_models(fname, block_size=2**22):
+  """
+  Returns (table, frames) for the PDB file fname, where table is
+  the AtomTable of the first model and frames is an (n_model, 
+  n_atom, 3) array of the atom positions in every model. Raises
+  ValueError unless all models hold the same atoms in the same
+  order, as in NMR ensembles and morphs.
+  """
+  with profiling.span('parse', fname=fname) as span:
+    columns = read_columns(fname, block_size, is_all_models=True)
+    span.count('file_bytes', os.path.getsize(fname))
+  if columns is None:
+    return AtomTable(), np.zeros((1, 0, 3))
+  i_models = columns['i_models']
+  is_first = i_models == 0
+  table, is_kept = build_table(
+      dict((key, value[is_first]) for key, value in columns.items()))
+
+  n_line = is_first.sum()
+  n_model = len(i_models)//max(n_line, 1)
+  type_keys = columns['type_keys']
+  if n_model*n_line != len(i_models) or \
+      (np.bincount(i_models) != n_line).any() or \
+      (type_keys.reshape(n_model, n_line) != type_keys[:n_line]).any():
+    raise ValueError('%s has models with different atoms' % fname)
+  frames = columns['positions'].reshape(n_model, n_line, 3)[:,is_kept]
+  return table, frames
@@ -0,0 +1,742 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Headless benchmarks of the pyball geometry pipeline.
+
+    python benchmark.py [section ...]
+
+Runs every section if none are given.
+"""
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import resource
+import multiprocessing
+
+import numpy as np
+
+import meshbuild
+import meshcache
+import atomtable
+import profiling
+import trajectory
+
+try:
+  from pdbremix import pdbatoms
+except ImportError:
+  pdbatoms = None
+
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+bundled_pdbs = ['hairpin.pdb', '1cph.pdb', '1be9.pdb', '1qlp.pdb', '1ssx.pdb']
+
+
+def timeit(fn, *args):
+  start = time.time()
+  result = fn(*args)
+  return time.time() - start, result
+
+
+##################################################
+# Secondary structure
+
+
+def legacy_assign_ss(n_res, partner_lists):
+  """
+  The original O(n_res^2) residue scan of find_ss_by_bb_hbonds,
+  kept as the reference for assign_ss_by_hbonds.
+  """
+  def is_hb(i_res, j_res):
+    if not (0 <= i_res <= n_res - 1):
+      return False
+    return j_res in partner_lists[i_res]
+
+  ss = ['C' for i in range(n_res)]
+  for i_res1 in range(n_res):
+    if is_hb(i_res1, i_res1+4) and is_hb(i_res1+1, i_res1+5):
+      for i_res in range(i_res1+1, i_res1+5):
+        ss[i_res] = 'H'
+    if is_hb(i_res1, i_res1+3) and is_hb(i_res1+1, i_res1+4):
+      for i_res in range(i_res1+1, i_res1+4):
+        ss[i_res] = 'H'
+    for i_res2 in range(n_res):
+      if abs(i_res1-i_res2) > 5:
+        if is_hb(i_res1, i_res2):
+          beta_residues = []
+          if is_hb(i_res1-2, i_res2-2):
+            beta_residues.extend(
+                [i_res1-2, i_res1-1, i_res1, i_res2-2, i_res2-1, i_res2])
+          if is_hb(i_res1+2, i_res2+2):
+            beta_residues.extend(
+                [i_res1+2, i_res1+1, i_res1, i_res2+2, i_res2+1, i_res2])
+          if is_hb(i_res1-2, i_res2+2):
+            beta_residues.extend(
+                [i_res1-2, i_res1-1, i_res1, i_res2+2, i_res2+1, i_res2])
+          if is_hb(i_res1+2, i_res2-2):
+            beta_residues.extend(
+                [i_res1+2, i_res1+1, i_res1, i_res2-2, i_res2-1, i_res2])
+          for i_res in beta_residues:
+            ss[i_res] = 'E'
+  return ss
+
+
+def make_synthetic_hbonds(n_res, seed=1):
+  """
+  Returns the CSR H-bond pattern of a synthetic chain of n_res
+  residues made of helices, hairpins of anti-parallel strands and
+  some random contacts.
+  """
+  random = np.random.RandomState(seed)
+  i_pairs = []
+  j_pairs = []
+  i_res = 0
+  while i_res < n_res - 40:
+    if random.rand() < 0.5:
+      n = random.randint(8, 20)
+      for i in range(i_res, i_res+n):
+        i_pairs.append(i)
+        j_pairs.append(i + random.choice([3, 4]))
+    else:
+      n = random.randint(5, 10)
+      i_strand2 = i_res + 2*n + 4
+      for k in range(0, n, 2):
+        i_pairs.append(i_res + k)
+        j_pairs.append(i_strand2 - k)
+    i_res += 2*n + 6
+  n_random = n_res//10
+  i_pairs.extend(random.randint(0, n_res, n_random))
+  j_pairs.extend(random.randint(0, n_res, n_random))
+  i_pairs = np.array(i_pairs)
+  j_pairs = np.array(j_pairs)
+  is_inside = j_pairs < n_res
+  return meshbuild.get_symmetric_csr(
+      i_pairs[is_inside], j_pairs[is_inside], n_res)
+
+
+def compare_ss(name, n_res, indptr, partners, is_legacy=True):
+  t_new, ss = timeit(meshbuild.assign_ss_by_hbonds, n_res, indptr, partners)
+  line = "%-24s %7d residues  new %8.4fs" % (name, n_res, t_new)
+  if is_legacy:
+    partner_lists = [
+        list(partners[indptr[i]:indptr[i+1]]) for i in range(n_res)]
+    t_old, old_ss = timeit(legacy_assign_ss, n_res, partner_lists)
+    is_same = ss.tolist() == old_ss
+    line += "  legacy %8.4fs  x%-7.0f %s" % (
+        t_old, t_old/max(t_new, 1e-9), 'same' if is_same else 'DIFFERENT')
+  print line
+
+
+def bench_ss():
+  print "Secondary structure assignment"
+  for pdb in bundled_pdbs:
+    atoms = atomtable.read_pdb(os.path.join(this_dir, pdb))
+    rendered_soup = meshbuild.RenderedSoup(atoms)
+    n_res = len(rendered_soup.trace.points)
+    compare_ss(pdb, n_res, rendered_soup.hb_indptr, rendered_soup.hb_partners)
+  for n_res in [2000, 5000]:
+    indptr, partners = make_synthetic_hbonds(n_res)
+    compare_ss('synthetic', n_res, indptr, partners)
+  for n_res in [100000, 1000000]:
+    indptr, partners = make_synthetic_hbonds(n_res)
+    compare_ss('synthetic', n_res, indptr, partners, is_legacy=False)
+
+
+##################################################
+# Bond perception
+
+
+def legacy_find_bonds(positions, elements, alt_confs, d=2):
+  """
+  The original per-pair loop of RenderedSoup.find_bonds with a flat
+  cutoff d, kept as the reference timing for find_covalent_bonds.
+  """
+  from pdbremix import v3numpy as v3
+  from spacehash import SpaceHash
+  bonds = []
+  i_pairs, j_pairs, dists = SpaceHash(positions, div=d).close_pair_arrays(d)
+  for i, j in zip(i_pairs, j_pairs):
+    if elements[i] == 'H' or elements[j] == 'H':
+      continue
+    if alt_confs[i] != " " and alt_confs[j] != " ":
+      if alt_confs[i] != alt_confs[j]:
+        continue
+    tangent = positions[j] - positions[i]
+    up = v3.cross(positions[i], tangent)
+    bonds.append((i, j, tangent, up, v3.distance(positions[i], positions[j])))
+  return bonds
+
+
+def get_bond_arrays(pdb, n_copy=1):
+  """
+  Returns (positions, elements, alt_confs, i_residues) of the heavy
+  atoms in pdb, tiled n_copy times along x to make larger 
+  structures. Hydrogens are left out, as in RenderedSoup.find_bonds 
+  and legacy_find_bonds, so that both find the same bonds.
+  """
+  atoms = atomtable.read_pdb(os.path.join(this_dir, pdb))
+  i_atoms = np.nonzero(atoms.elements != 'H')[0]
+  positions = atoms.positions[i_atoms]
+  span = positions[:,0].max() - positions[:,0].min() + 10.0
+  n_res = atoms.get_n_res()
+  res_indices = atoms.res_indices[i_atoms]
+  return (
+      np.concatenate([positions + [span*i, 0, 0] for i in range(n_copy)]),
+      atoms.elements[i_atoms].tolist()*n_copy,
+      atoms.alt_confs[i_atoms].tolist()*n_copy,
+      np.concatenate([res_indices + n_res*i for i in range(n_copy)]))
+
+
+def bench_bonds():
+  print "Bond perception"
+  for pdb, n_copy in [('1ssx.pdb', 1), ('1qlp.pdb', 1), ('1qlp.pdb', 30)]:
+    positions, elements, alt_confs, i_residues = get_bond_arrays(pdb, n_copy)
+    t_new, bonds = timeit(
+        meshbuild.find_covalent_bonds, positions, elements, alt_confs, i_residues)
+    t_old, old_bonds = timeit(
+        legacy_find_bonds, positions, elements, alt_confs)
+    print "%-24s %7d atoms  new %8.4fs  legacy %8.4fs  x%-5.0f %d vs %d bonds" % (
+        "%s x%d" % (pdb, n_copy), len(positions), t_new, t_old, 
+        t_old/max(t_new, 1e-9), len(bonds), len(old_bonds))
+
+
+##################################################
+# Structure loading
+
+
+def get_rss():
+  """
+  Returns the resident memory of this process in bytes, or 0 if
+  /proc is not available.
+  """
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError):
+    return 0
+
+
+def write_synthetic_pdb(fname, n_atom, pdb='1qlp.pdb'):
+  """
+  Writes a PDB file of about n_atom atoms made of copies of pdb
+  shifted along x, with one chain id per copy.
+  """
+  lines = [
+      l for l in open(os.path.join(this_dir, pdb))
+      if l.startswith('ATOM') or l.startswith('HETATM')]
+  xs = [float(l[30:38]) for l in lines]
+  span = max(xs) - min(xs) + 10.0
+  chain_ids = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+  n_copy = max(1, n_atom//len(lines))
+  with open(fname, 'w') as f:
+    for i_copy in range(n_copy):
+      shift = span*(i_copy % 50)
+      chain_id = chain_ids[i_copy % len(chain_ids)]
+      y = 80.0*(i_copy//50)
+      for line, x in zip(lines, xs):
+        f.write('%s%s%s%8.3f%8.3f%s' % (
+            line[:21], chain_id, line[22:30], x + shift,
+            float(line[38:46]) + y, line[46:]))
+    f.write('END\n')
+
+
+def load_with(name, fn, fname, n_atom):
+  rss = get_rss()
+  t, result = timeit(fn, fname)
+  n_byte = get_rss() - rss
+  print "  %-10s %8.3fs  %7.1f MB rss  %6.0f bytes/atom" % (
+      name, t, n_byte/1e6, n_byte/float(n_atom))
+  return result
+
+
+def bench_load():
+  print "Structure loading"
+  tmp_dir = tempfile.mkdtemp()
+  synthetic = os.path.join(tmp_dir, 'synthetic.pdb')
+  write_synthetic_pdb(synthetic, 1000000)
+  for fname in [os.path.join(this_dir, '1ssx.pdb'), synthetic]:
+    atoms = atomtable.read_pdb(fname)
+    n_atom = atoms.get_n_atom()
+    print "%s: %d atoms, %d residues, AtomTable columns %.1f MB (%.0f bytes/atom)" % (
+        os.path.basename(fname), n_atom, atoms.get_n_res(), 
+        atoms.get_n_byte()/1e6, atoms.get_n_byte()/float(n_atom))
+    del atoms
+    atoms = load_with('AtomTable', atomtable.read_pdb, fname, n_atom)
+    t, rendered_soup = timeit(meshbuild.RenderedSoup, atoms)
+    print "  %-10s %8.3fs" % ('Rendered', t)
+    del atoms, rendered_soup
+    if pdbatoms is not None:
+      soup = load_with('Soup', pdbatoms.Soup, fname, n_atom)
+      del soup
+  os.remove(synthetic)
+  os.rmdir(tmp_dir)
+
+
+def bench_struct_file():
+  print "Struct file"
+  tmp_dir = tempfile.mkdtemp()
+  synthetic = os.path.join(tmp_dir, 'synthetic.pdb')
+  write_synthetic_pdb(synthetic, 1000000)
+  pyb = os.path.join(tmp_dir, 'structure.pyb')
+  for fname in [os.path.join(this_dir, '1ssx.pdb'), synthetic]:
+    n_atom = atomtable.read_pdb(fname).get_n_atom()
+    t_convert, result = timeit(meshbuild.convert_pdb, fname, pyb)
+    t_parse, result = timeit(meshbuild.load_meshes, fname)
+    del result
+    rss = get_rss()
+    t_open, (meshes, tables, info) = timeit(meshbuild.load_meshes, pyb)
+    n_byte = get_rss() - rss
+    print "%s: %d atoms, %.1f MB file, convert %.3fs" % (
+        os.path.basename(fname), n_atom, os.path.getsize(pyb)/1e6, t_convert)
+    print "  open %.4fs (%.1f MB rss) vs parse and build %.3fs  x%.0f" % (
+        t_open, n_byte/1e6, t_parse, t_parse/max(t_open, 1e-9))
+    del meshes, tables
+  for fname in [synthetic, pyb]:
+    os.remove(fname)
+  os.rmdir(tmp_dir)
+
+
+def bench_parallel():
+  print "Parallel mesh building, cartoon in processes, %d cores" % (
+      multiprocessing.cpu_count())
+  tmp_dir = tempfile.mkdtemp()
+  synthetic = os.path.join(tmp_dir, 'synthetic.pdb')
+  write_synthetic_pdb(synthetic, 200000)
+  rendered_soup = meshbuild.RenderedSoup(atomtable.read_pdb(synthetic))
+  os.remove(synthetic)
+  os.rmdir(tmp_dir)
+  print "%d atoms, %d chains, %d pieces" % (
+      rendered_soup.atoms.get_n_atom(), len(rendered_soup.atoms.chain_ids),
+      len(rendered_soup.pieces))
+  t_serial, meshes = timeit(meshbuild.build_meshes, rendered_soup)
+  print "  %2d workers %8.3fs" % (1, t_serial)
+  for n_worker in [2, 4, 8]:
+    pool = multiprocessing.Pool(n_worker)
+    try:
+      t, parallel_meshes = timeit(
+          meshbuild.build_meshes, rendered_soup, meshbuild.mesh_params, pool)
+    finally:
+      pool.terminate()
+      pool.join()
+    is_same = all(
+        np.array_equal(meshes[name].data, parallel_meshes[name].data) and
+        np.array_equal(meshes[name].indices, parallel_meshes[name].indices)
+        for name in meshes)
+    print "  %2d workers %8.3fs  x%.2f  %s" % (
+        n_worker, t, t_serial/max(t, 1e-9), 'same' if is_same else 'DIFFERENT')
+
+
+##################################################
+# Multi-model playback
+
+
+def write_synthetic_ensemble(fname, n_res, n_model, pdb='1qlp.pdb'):
+  """
+  Writes a multi-model PDB file of n_model models of about n_res 
+  residues, made of copies of pdb shifted along x, where every 
+  model bends the copies by a different smooth displacement.
+  """
+  lines = [
+      l for l in open(os.path.join(this_dir, pdb))
+      if l.startswith('ATOM') or l.startswith('HETATM')]
+  positions = np.array(
+      [[float(l[30:38]), float(l[38:46]), float(l[46:54])] for l in lines])
+  span = positions[:,0].max() - positions[:,0].min() + 10.0
+  n_copy = max(1, n_res//len(set(l[21:27] for l in lines)))
+  chain_ids = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+  with open(fname, 'w') as f:
+    for i_model in range(n_model):
+      f.write('MODEL     %4d\n' % (i_model + 1))
+      amplitude = 0.5*np.sin(2*np.pi*i_model/n_model)
+      for i_copy in range(n_copy):
+        copy = positions + [span*i_copy, 0, 0]
+        copy += amplitude*np.sin(0.2*copy[:,[1,2,0]])
+        for line, (x, y, z) in zip(lines, copy):
+          f.write('%s%s%s%8.3f%8.3f%8.3f%s' % (
+              line[:21], chain_ids[i_copy % len(chain_ids)], line[22:30],
+              x, y, z, line[54:]))
+      f.write('ENDMDL\n')
+    f.write('END\n')
+
+
+def bench_frames():
+  print "Multi-model playback"
+  tmp_dir = tempfile.mkdtemp()
+  ensemble = os.path.join(tmp_dir, 'ensemble.pdb')
+  write_synthetic_ensemble(ensemble, 5000, 10)
+  def load_player(fname):
+    return meshbuild.ModelPlayer(*atomtable.read_pdb_models(fname))
+  t_load, player = timeit(load_player, ensemble)
+  atoms = player.rendered_soup.atoms
+  print "%d models, %d atoms, %d residues, loaded in %.3fs" % (
+      player.get_n_frame(), atoms.get_n_atom(), atoms.get_n_res(), t_load)
+
+  names = ['ballstick', 'arrows', 'cartoon']
+  is_same = True
+  for name in names:
+    vertices, normals = player.get_geometry(name)
+    data = player.meshes.get(name).data
+    is_same &= np.array_equal(vertices, data['a_position'])
+    is_same &= np.array_equal(normals, data['a_normal'])
+  print "  frame 0 geometry %s the built meshes" % (
+      'matches' if is_same else 'DIFFERS from')
+
+  n_frame = player.get_n_frame()
+  times = dict((name, 0.0) for name in ['positions'] + names)
+  for i_frame in range(1, n_frame + 1):
+    t, result = timeit(player.set_frame, i_frame)
+    times['positions'] += t
+    for name in names:
+      t, result = timeit(player.get_geometry, name)
+      times[name] += t
+  for name in ['positions'] + names:
+    print "  %-10s %8.4fs/frame" % (name, times[name]/n_frame)
+  for label, frame_names in [
+      ('all', names), ('no sidechains', ['arrows', 'cartoon'])]:
+    t = (times['positions'] + sum(times[n] for n in frame_names))/n_frame
+    print "  %-14s %8.4fs/frame  %6.1f fps" % (label, t, 1.0/max(t, 1e-9))
+  t_rebuild, result = timeit(meshbuild.build_meshes, player.rendered_soup)
+  print "  full rebuild   %8.4fs/frame" % t_rebuild
+  os.remove(ensemble)
+  os.rmdir(tmp_dir)
+
+
+def bench_verlet():
+  print "Per-frame H-bonds and secondary structure"
+  tmp_dir = tempfile.mkdtemp()
+  fname = os.path.join(tmp_dir, 'synthetic.pdb')
+  write_synthetic_ensemble(fname, 5000, 1)
+  atoms = atomtable.read_pdb(fname)
+  os.remove(fname)
+  os.rmdir(tmp_dir)
+  start_positions = atoms.positions.copy()
+
+  # a slow smooth motion with thermal jitter, 100 frames a period
+  n_frame = 100
+  random = np.random.RandomState(1)
+  field = np.sin(0.2*start_positions[:,[1,2,0]])
+  def get_frame(i_frame):
+    amplitude = np.sin(2*np.pi*i_frame/n_frame)
+    return start_positions + amplitude*field + \
+        random.normal(0, 0.02, start_positions.shape)
+
+  for hbond_mode in ['distance', 'dssp']:
+    for skin in [1.0, 2.0]:
+      atoms.positions[:] = start_positions
+      rendered_soup = meshbuild.RenderedSoup(atoms, hbond_mode, skin)
+      neighbours = rendered_soup.hbond_neighbours
+      n_build = neighbours.n_build
+      t_verlet = t_hash = 0.0
+      n_change = 0
+      is_same = True
+      for i_frame in range(1, n_frame + 1):
+        rendered_soup.set_positions(get_frame(i_frame))
+        rendered_soup.hbond_neighbours = neighbours
+        t, is_changed = timeit(rendered_soup.update_ss)
+        t_verlet += t
+        n_change += is_changed
+        partners = rendered_soup.hb_partners
+        rendered_soup.hbond_neighbours = None
+        t, result = timeit(rendered_soup.update_ss)
+        t_hash += t
+        is_same &= np.array_equal(partners, rendered_soup.hb_partners)
+      print "%-8s skin %.1f: %d residues  verlet %.4fs/frame  spacehash %.4fs/frame  x%.1f" % (
+          hbond_mode, skin, rendered_soup.atoms.get_n_res(), 
+          t_verlet/n_frame, t_hash/n_frame, t_hash/max(t_verlet, 1e-9))
+      print "  %d rebuilds in %d frames, ss changed in %d, H-bonds %s" % (
+          neighbours.n_build - n_build, n_frame, n_change, 
+          'same' if is_same else 'DIFFERENT')
+
+
+def bench_traj():
+  print "Trajectory streaming"
+  tmp_dir = tempfile.mkdtemp()
+  n_atom, n_frame = 200000, 100
+  random = np.random.RandomState(1)
+  frames = random.rand(n_frame, n_atom, 3).astype(np.float32)
+  fnames = [os.path.join(tmp_dir, 'traj.dcd'), os.path.join(tmp_dir, 'traj.f32')]
+  trajectory.write_dcd(fnames[0], frames, np.ones((n_frame, 6)))
+  trajectory.write_raw(fnames[1], frames)
+  del frames
+  for fname in fnames:
+    t_open, traj = timeit(trajectory.Trajectory, fname, n_atom)
+    print "%s: %d frames of %d atoms, %.0f MB, open %.4fs" % (
+        os.path.basename(fname), len(traj), n_atom, 
+        os.path.getsize(fname)/1e6, t_open)
+
+    prefetcher = trajectory.FramePrefetcher(traj)
+    n_shown = 0
+    max_poll = 0.0
+    start = time.time()
+    while n_shown < n_frame:
+      t_poll, frame = timeit(prefetcher.next_frame)
+      max_poll = max(max_poll, t_poll)
+      if frame is not None:
+        n_shown += 1
+    t_play = time.time() - start
+    prefetcher.close()
+    print "  prefetched %.0f frames/s, %.0f MB/s, longest poll %.5fs" % (
+        n_frame/t_play, n_frame*n_atom*12/t_play/1e6, max_poll)
+    del traj, prefetcher
+  for fname in fnames:
+    os.remove(fname)
+  os.rmdir(tmp_dir)
+
+
+##################################################
+# Lazy mesh building
+
+
+def get_peak_rss():
+  # ru_maxrss is in kB on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+def run_startup(queue, load):
+  rss = get_peak_rss()
+  start = time.time()
+  load()
+  queue.put((time.time() - start, get_peak_rss() - rss))
+
+
+def time_startup(label, load):
+  """
+  Runs load in a child process, so that its peak memory is not
+  hidden by the peak of an earlier run.
+  """
+  queue = multiprocessing.Queue()
+  process = multiprocessing.Process(target=run_startup, args=(queue, load))
+  process.start()
+  t, n_byte = queue.get()
+  process.join()
+  print "  %-28s %8.3fs  %7.1f MB peak" % (label, t, n_byte/1e6)
+
+
+def bench_lazy():
+  print "Startup, eager vs lazy mesh building"
+  tmp_dir = tempfile.mkdtemp()
+  synthetic = os.path.join(tmp_dir, 'synthetic.pdb')
+  write_synthetic_pdb(synthetic, 200000)
+  cache = meshcache.MeshCache(
+      meshbuild.mesh_builder_version, os.path.join(tmp_dir, 'cache'))
+  def eager(cache=None):
+    meshbuild.load_meshes(synthetic, cache)
+  def lazy(names, cache=None):
+    registry, tables, info = meshbuild.load_mesh_registry(synthetic, cache)
+    registry.get_meshes(names)
+  print "%d atoms" % atomtable.read_pdb(synthetic).get_n_atom()
+  time_startup('eager, all meshes', eager)
+  time_startup(
+      'lazy, sidechains', lambda: lazy(['ballstick', 'arrows', 'cartoon']))
+  time_startup('lazy, no sidechains', lambda: lazy(['arrows', 'cartoon']))
+  eager(cache)
+  lazy(['ballstick', 'arrows', 'cartoon'], cache)
+  time_startup('eager, cached', lambda: eager(cache))
+  time_startup(
+      'lazy, no sidechains, cached', lambda: lazy(['arrows', 'cartoon'], cache))
+  os.remove(synthetic)
+  shutil.rmtree(tmp_dir)
+
+
+##################################################
+# Progressive loading
+
+
+def bench_progressive():
+  print "Time to first mesh, progressive vs blocking load"
+  tmp_dir = tempfile.mkdtemp()
+  synthetic = os.path.join(tmp_dir, 'synthetic.pdb')
+  write_synthetic_pdb(synthetic, 200000)
+  t_block, result = timeit(meshbuild.load_meshes, synthetic)
+  del result
+  names = ['arrows', 'cartoon', 'ballstick']
+  start = time.time()
+  loader = meshbuild.MeshLoader(
+      lambda: meshbuild.open_structure(synthetic), names)
+  times = {}
+  while len(times) < len(names) + 1:
+    for result in loader.get_results():
+      if result[0] == 'structure':
+        times['structure'] = time.time() - start
+      elif result[0] == 'mesh':
+        times[result[1]] = time.time() - start
+    time.sleep(0.001)
+  loader.close()
+  print "%d atoms, blocking load %.3fs" % (
+      atomtable.read_pdb(synthetic).get_n_atom(), t_block)
+  for name in ['structure'] + names:
+    print "  %-10s %8.3fs" % (name, times[name])
+  os.remove(synthetic)
+  os.rmdir(tmp_dir)
+
+
+##################################################
+# Idle redraw
+
+
+def run_events(canvas, duration):
+  """
+  Runs the event loop of canvas for duration seconds, and returns
+  the fraction of a core used and the draws per second.
+  """
+  import pyball
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  cpu = usage.ru_utime + usage.ru_stime
+  n_draw = canvas.n_draw
+  start = time.time()
+  while time.time() - start < duration:
+    pyball.app.process_events()
+    time.sleep(0.005)
+  wall = time.time() - start
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  cpu = usage.ru_utime + usage.ru_stime - cpu
+  return cpu/wall, (canvas.n_draw - n_draw)/wall
+
+
+def bench_idle():
+  print "Idle CPU of an open window"
+  try:
+    import pyball
+    pyball.app.use_app()
+  except Exception as e:
+    print "  skipped, no GL backend: %s" % e
+    return
+  canvas = pyball.MolecularViewerCanvas(os.path.join(this_dir, '1ssx.pdb'))
+  canvas.show()
+  start = time.time()
+  while (canvas.meshes is None or canvas.requested) and \
+      time.time() - start < 60:
+    pyball.app.process_events()
+    time.sleep(0.01)
+  run_events(canvas, 1.0)
+  cpu, fps = run_events(canvas, 3.0)
+  print "  %-18s %5.1f%% CPU  %6.1f draws/s" % ('redraw on change', 100*cpu, fps)
+  # the old render loop, which asked for a draw after every draw
+  canvas.events.draw.connect(lambda event: canvas.update())
+  canvas.update()
+  cpu, fps = run_events(canvas, 3.0)
+  print "  %-18s %5.1f%% CPU  %6.1f draws/s" % ('continuous', 100*cpu, fps)
+  canvas.close()
+
+
+##################################################
+# Ray picking
+
+
+def brute_force_ray_pick(positions, objids, radius, origin, direction):
+  diff = positions - origin
+  bs = diff.dot(direction)
+  discs = bs*bs - (diff*diff).sum(axis=1) + radius*radius
+  is_hit = (discs >= 0) & (bs + np.sqrt(np.maximum(discs, 0)) >= 0)
+  if not np.any(is_hit):
+    return -1
+  ts = np.where(is_hit, np.maximum(bs - np.sqrt(np.maximum(discs, 0)), 0), np.inf)
+  return int(objids[np.lexsort((np.arange(len(ts)), ts))[0]])
+
+
+def bench_pick():
+  print "CPU ray picking"
+  tmp_dir = tempfile.mkdtemp()
+  synthetic = os.path.join(tmp_dir, 'synthetic.pdb')
+  write_synthetic_pdb(synthetic, 200000)
+  rendered_soup = meshbuild.RenderedSoup(atomtable.read_pdb(synthetic))
+  tables = rendered_soup.get_picking_tables()
+  positions = tables['atom_positions']
+  draw_objids = tables['draw_objids']
+  radius = meshbuild.ray_pick_radii['atoms']
+  t_build, ray_picker = timeit(
+      meshbuild.RayPicker, positions[draw_objids], draw_objids, radius)
+  print "%d atoms, grid built in %.3fs" % (len(draw_objids), t_build)
+
+  # rays from outside through random atoms
+  random = np.random.RandomState(1)
+  center = positions.mean(axis=0)
+  n_ray = 50
+  targets = positions[random.choice(draw_objids, n_ray)]
+  origins = center + 500.0*random.normal(size=(n_ray, 3))
+  directions = targets - origins
+  directions /= np.sqrt((directions*directions).sum(axis=1))[:,np.newaxis]
+  t_ray = t_brute = 0.0
+  n_same = 0
+  for origin, direction in zip(origins, directions):
+    t, objid = timeit(meshbuild.pick_by_ray, [ray_picker], origin, direction)
+    t_ray += t
+    t, brute_objid = timeit(
+        brute_force_ray_pick, positions[draw_objids], draw_objids, radius,
+        origin, direction)
+    t_brute += t
+    n_same += objid == brute_objid
+  print "  ray march %8.5fs/pick, all atoms %8.5fs/pick, %d/%d picks match" % (
+      t_ray/n_ray, t_brute/n_ray, n_same, n_ray)
+  os.remove(synthetic)
+  os.rmdir(tmp_dir)
+
+
+##################################################
+# Profiling
+
+
+def time_spans(n):
+  start = time.time()
+  for i in xrange(n):
+    with profiling.span('bench') as span:
+      span.count('n', 1)
+  return (time.time() - start)/n
+
+
+def bench_profile():
+  print "Per-phase profile of loading a structure"
+  n = 100000
+  profiling.disable()
+  t_off = time_spans(n)
+  profiling.enable()
+  t_on = time_spans(n)
+  profiling.reset()
+  print "  span overhead %.2fus off, %.2fus on" % (1e6*t_off, 1e6*t_on)
+
+  tmp_dir = tempfile.mkdtemp()
+  synthetic = os.path.join(tmp_dir, 'synthetic.pdb')
+  write_synthetic_pdb(synthetic, 200000)
+  profiling.disable()
+  t_off, result = timeit(meshbuild.load_meshes, synthetic)
+  del result
+  profiling.enable()
+  t_on, result = timeit(meshbuild.load_meshes, synthetic)
+  del result
+  profiling.disable()
+  print "  load %.3fs off, %.3fs on" % (t_off, t_on)
+  profiling.print_summary()
+  trace = os.path.join(tmp_dir, 'trace.json')
+  profiling.write_chrome_trace(trace)
+  print "  %d bytes of Chrome trace" % os.path.getsize(trace)
+  profiling.reset()
+  shutil.rmtree(tmp_dir)
+
+
+sections = [
+  ('ss', bench_ss),
+  ('bonds', bench_bonds),
+  ('load', bench_load),
+  ('structfile', bench_struct_file),
+  ('parallel', bench_parallel),
+  ('frames', bench_frames),
+  ('verlet', bench_verlet),
+  ('traj', bench_traj),
+  ('lazy', bench_lazy),
+  ('progressive', bench_progressive),
+  ('idle', bench_idle),
+  ('pick', bench_pick),
+  ('profile', bench_profile),
+]
+
+
+if __name__ == '__main__':
+  names = sys.argv[1:]
+  for name, fn in sections:
+    if not names or name in names:
+      fn()
+      print
@@ -0,0 +1,1796 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless half of pyball: the trace, H-bonds, bonds and secondary
+structure of a structure, the mesh builders, and the serialization,
+caching and loading of meshes and picking tables. Nothing here
+needs a GL context or a windowing toolkit, so that precompute.py
+runs on machines without either; only the buffer methods of
+TriangleStore import vispy, when they are called.
+"""
+
+
+import sys
+import time
+import threading
+import Queue
+import traceback
+import collections
+
+import numpy as np
+
+import render
+import atomtable
+import structfile
+import trajectory
+import profiling
+from spacehash import SpaceHash, VerletList
+from meshcache import hash_file
+
+from pdbremix import v3numpy as v3
+from pdbremix.data import backbone_atoms
+
+
+#########################################################
+# Convert PDB structure into smooth pieces of secondary 
+# structure and geometrial objects that use
+# render functions to turn into polygon
+
+
+class Trace:
+  def __init__(self, n=None):
+    if n is not None:
+      self.points = np.zeros((n,3), dtype=np.float32)
+      self.ups = np.zeros((n,3), dtype=np.float32)
+      self.tangents = np.zeros((n,3), dtype=np.float32)
+      self.objids = np.zeros(n, dtype=np.int32)
+      self.i_residues = np.zeros(n, dtype=np.int64)
+      self.ss = np.full(n, '-', dtype='S1')
+      self.colors = np.zeros((n,3))
+
+  def get_prev_point(self, i):
+    if i > 0:
+      return self.points[i-1]
+    else:
+      return self.points[i] - self.tangents[i]
+
+  def get_next_point(self, i):
+    if i < len(self.points)-1:
+      return self.points[i+1]
+    else:
+      return self.points[i] + self.tangents[i]
+
+  def get_prev_up(self, i):
+    if i > 0:
+      return self.ups[i-1]
+    else:
+      return self.ups[i]
+
+  def get_next_up(self, i):
+    if i < len(self.points)-1:
+      return self.ups[i+1]
+    else:
+      return self.ups[i]
+
+
+class SubTrace(Trace):
+  def __init__(self, trace, i, j):
+    self.points = trace.points[i:j]
+    self.ups = trace.ups[i:j]
+    self.tangents = trace.tangents[i:j]
+    self.objids = trace.objids[i:j]
+    self.i_residues = trace.i_residues[i:j]
+    self.ss = trace.ss[i:j]
+    self.colors = trace.colors[i:j]
+
+
+def catmull_rom_spline(t, p1, p2, p3, p4):
+  """
+  Returns a point at fraction t between p2 and p3.
+  """
+  return \
+      0.5 * (   t*((2-t)*t    - 1)  * p1
+              + (t*t*(3*t - 5) + 2) * p2
+              + t*((4 - 3*t)*t + 1) * p3
+              + (t-1)*t*t           * p4 )
+
+
+def catmull_rom_basis(t):
+  """
+  Returns the (n, 4) weights of p1, p2, p3 and p4 in 
+  catmull_rom_spline for each fraction in the array t.
+  """
+  t = np.asarray(t, dtype=np.float64)
+  return np.array([
+      t*((2-t)*t    - 1),
+      (t*t*(3*t - 5) + 2),
+      t*((4 - 3*t)*t + 1),
+      (t-1)*t*t          ]).T
+
+
+def catmull_rom_segments(controls, t):
+  """
+  Returns an (n_segment, n_t, 3) array of the spline points at the
+  fractions t for every segment of the (n_segment+3, 3) array of
+  control points, where segment i lies between controls[i+1]
+  and controls[i+2].
+  """
+  weights = catmull_rom_basis(t).astype(controls.dtype)[:,:,np.newaxis]
+  return \
+      0.5 * (   weights[:,0] * controls[:-3,np.newaxis]
+              + weights[:,1] * controls[1:-2,np.newaxis]
+              + weights[:,2] * controls[2:-1,np.newaxis]
+              + weights[:,3] * controls[3:,np.newaxis] )
+
+
+class SplineTrace(Trace):
+  """
+  SplineTrace expands the points in a Trace using
+  a spline interpolation.
+  """
+  def __init__(self, trace, n_division):
+    Trace.__init__(self, n_division*(len(trace.points)-1) + 1)
+
+    delta = 1/float(n_division)
+
+    n_trace_point = len(trace.points)
+    if n_trace_point > 1:
+      t = np.arange(n_division+1)*delta
+
+      # pad the ends with the same control points as
+      # get_prev_point/get_next_point and get_prev_up/get_next_up
+      points = np.concatenate([
+          [trace.points[0] - trace.tangents[0]],
+          trace.points,
+          [trace.points[-1] + trace.tangents[-1]]])
+      ups = np.concatenate([trace.ups[:1], trace.ups, trace.ups[-1:]])
+
+      # last division includes the very last trace point
+      n = n_division
+      for spline, controls in [(self.points, points), (self.ups, ups)]:
+        segments = catmull_rom_segments(controls, t)
+        spline[:-1] = segments[:,:n].reshape(-1, 3)
+        spline[-1] = segments[-1,n]
+
+      is_first_half = np.arange(n)/float(n) < 0.5
+      objids = np.where(
+          is_first_half, trace.objids[:-1,np.newaxis], trace.objids[1:,np.newaxis])
+      self.objids[:-(n+1)] = objids[:-1].ravel()
+      is_first_half = np.arange(n+1)/float(n+1) < 0.5
+      self.objids[-(n+1):] = np.where(
+          is_first_half, trace.objids[-2], trace.objids[-1])
+
+    self.tangents[1:-1] = self.points[2:] - self.points[:-2]
+    self.tangents[-1] = trace.tangents[-1]
+    self.tangents[0] = trace.tangents[0]
+
+
+def get_symmetric_csr(i_rows, j_cols, n):
+  """
+  Returns CSR arrays (indptr, indices) of the symmetric n x n
+  sparse pattern holding every (i, j) and (j, i) pair, with 
+  duplicates removed and the indices of each row sorted.
+  """
+  i_rows = np.asarray(i_rows, dtype=np.int64)
+  j_cols = np.asarray(j_cols, dtype=np.int64)
+  keys = np.unique(np.concatenate([i_rows*n + j_cols, j_cols*n + i_rows]))
+  indptr = np.zeros(n+1, dtype=np.int64)
+  indptr[1:] = np.cumsum(np.bincount(keys//n, minlength=n))
+  return indptr, keys%n
+
+
+def find_close_pairs(vertices, cutoff, neighbours=None):
+  """
+  Returns arrays (i, j, d) of the vertex pairs closer than cutoff,
+  from neighbours, a VerletList kept across calls, if given. 
+  """
+  if neighbours is None:
+    return SpaceHash(vertices, div=cutoff).close_pair_arrays(cutoff)
+  if neighbours.cutoff != cutoff:
+    raise ValueError(
+        "Neighbour list cutoff %s is not %s" % (neighbours.cutoff, cutoff))
+  return neighbours.close_pair_arrays(vertices)
+
+
+def find_bb_hbond_pairs(
+    positions, i_residues, is_acceptors, n_res, d=3.5, neighbours=None):
+  """
+  Returns the symmetric residue-residue H-bond pattern as CSR
+  arrays (indptr, partners) for backbone N and O atoms, where 
+  positions, i_residues and the is_acceptors type mask (O is True)
+  hold one entry per atom. An H-bond is any N-O pair closer 
+  than d. Candidate pairs come from the VerletList neighbours, 
+  if given, to reuse them across frames.
+  """
+  positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+  i_residues = np.asarray(i_residues, dtype=np.int64)
+  is_acceptors = np.asarray(is_acceptors, dtype=bool)
+  i_pairs, j_pairs, dists = find_close_pairs(positions, d, neighbours)
+  is_hb = is_acceptors[i_pairs] != is_acceptors[j_pairs]
+  return get_symmetric_csr(
+      i_residues[i_pairs[is_hb]], i_residues[j_pairs[is_hb]], n_res)
+
+
+def find_dssp_hbond_pairs(
+    n_positions, c_positions, o_positions, is_prolines, 
+    cutoff=5.2, max_energy=-0.5, neighbours=None):
+  """
+  Returns the symmetric residue-residue H-bond pattern as CSR
+  arrays (indptr, partners) using the electrostatic N-H...O=C
+  energy of Kabsch & Sander (DSSP), from the (n_res, 3) backbone 
+  positions of consecutive residues, NaN where an atom is missing.
+
+  The amide H of a residue is placed 1.0 A from N, opposite the C=O 
+  of the previous residue, unless the residue is a proline or 
+  is not peptide-bonded to the previous residue. Candidate N-O 
+  pairs come from one SpaceHash cutoff query, and all of their 
+  energies are computed as a single array expression. An H-bond 
+  is any candidate with an energy below max_energy in kcal/mol.
+  The candidates come from the VerletList neighbours, if given, 
+  which holds every N and O so that it stays valid while the amide
+  H atoms come and go between frames.
+  """
+  n_positions = np.asarray(n_positions, dtype=np.float64).reshape(-1, 3)
+  c_positions = np.asarray(c_positions, dtype=np.float64).reshape(-1, 3)
+  o_positions = np.asarray(o_positions, dtype=np.float64).reshape(-1, 3)
+  n_res = len(n_positions)
+
+  def mag(v):
+    return np.sqrt((v*v).sum(axis=-1))
+
+  h_positions = np.full((n_res, 3), np.nan)
+  has_h = np.zeros(n_res, dtype=bool)
+  if n_res > 1:
+    co = c_positions[:-1] - o_positions[:-1]
+    h_positions[1:] = n_positions[1:] + co/mag(co)[:,np.newaxis]
+    with np.errstate(invalid='ignore'):
+      is_bonded = mag(n_positions[1:] - c_positions[:-1]) < 2.0
+    has_h[1:] = is_bonded & ~np.asarray(is_prolines, dtype=bool)[1:]
+  has_o = np.isfinite(o_positions).all(axis=1) 
+  has_o &= np.isfinite(c_positions).all(axis=1)
+  has_n = np.isfinite(n_positions).all(axis=1)
+
+  i_donors = np.nonzero(has_n)[0]
+  i_acceptors = np.nonzero(has_o)[0]
+  n_donor = len(i_donors)
+  vertices = np.concatenate(
+      [n_positions[i_donors], o_positions[i_acceptors]])
+  i_pairs, j_pairs, dists = find_close_pairs(vertices, cutoff, neighbours)
+  is_n_o = (i_pairs < n_donor) & (j_pairs >= n_donor)
+  i_donors = i_donors[i_pairs[is_n_o]]
+  i_acceptors = i_acceptors[j_pairs[is_n_o] - n_donor]
+  is_h = has_h[i_donors]
+  i_donors, i_acceptors = i_donors[is_h], i_acceptors[is_h]
+  is_apart = np.abs(i_donors - i_acceptors) >= 2
+  i_donors, i_acceptors = i_donors[is_apart], i_acceptors[is_apart]
+
+  n = n_positions[i_donors]
+  h = h_positions[i_donors]
+  c = c_positions[i_acceptors]
+  o = o_positions[i_acceptors]
+  energies = 0.42*0.20*332*(
+      1.0/mag(o - n) + 1.0/mag(c - h) - 1.0/mag(o - h) - 1.0/mag(c - n))
+
+  is_hb = energies < max_energy
+  return get_symmetric_csr(i_donors[is_hb], i_acceptors[is_hb], n_res)
+
+
+# Single-bond covalent radii in angstroms (Cordero et al. 2008)
+covalent_radii = {
+  'H': 0.31, 'B': 0.84, 'C': 0.76, 'N': 0.71, 'O': 0.66, 'F': 0.57,
+  'NA': 1.66, 'MG': 1.41, 'AL': 1.21, 'SI': 1.11, 'P': 1.07, 'S': 1.05,
+  'CL': 1.02, 'K': 2.03, 'CA': 1.76, 'MN': 1.39, 'FE': 1.32, 'CO': 1.26,
+  'NI': 1.24, 'CU': 1.32, 'ZN': 1.22, 'SE': 1.20, 'BR': 1.20, 'SR': 1.95,
+  'CD': 1.44, 'I': 1.39, 'PT': 1.36, 'AU': 1.36, 'HG': 1.32,
+}
+default_covalent_radius = 0.76
+
+metal_elements = [
+  'NA', 'MG', 'AL', 'K', 'CA', 'MN', 'FE', 'CO', 'NI', 'CU', 'ZN',
+  'SR', 'CD', 'PT', 'AU', 'HG',
+]
+
+
+def find_covalent_bonds(
+    positions, elements, alt_confs, i_residues, tolerance=0.45, 
+    min_dist=0.4):
+  """
+  Returns the covalent bonds as an (n_bond, 2) int32 array of atom 
+  indices i < j, for atoms given as (n_atom, 3) positions and 
+  per-atom elements, altloc characters and residue indices. Atoms 
+  are bonded when closer than the sum of their covalent radii plus
+  tolerance. Atoms in different alternate conformations are never 
+  bonded, and metals only bond within their own residue, so that 
+  coordination contacts to ions are not drawn as bonds. Hydrogens 
+  are bonded like any other atom, so leave them out of the input, 
+  as get_draw_atom_indices does, if they are not to be drawn.
+  """
+  positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+  alt_confs = np.asarray(alt_confs, dtype='S1')
+  i_residues = np.asarray(i_residues, dtype=np.int64)
+  if len(positions) == 0:
+    return np.zeros((0, 2), dtype=np.int32)
+
+  unique_elements, i_elements = np.unique(elements, return_inverse=True)
+  unique_elements = [e.strip().upper() for e in unique_elements]
+  radii = np.array([
+      covalent_radii.get(e, default_covalent_radius) 
+      for e in unique_elements])[i_elements]
+  is_metals = np.array([e in metal_elements for e in unique_elements])[i_elements]
+
+  cutoff = 2*radii.max() + tolerance
+  i_pairs, j_pairs, dists = SpaceHash(
+      positions, div=cutoff).close_pair_arrays(cutoff)
+
+  is_bond = dists < radii[i_pairs] + radii[j_pairs] + tolerance
+  is_bond &= dists > min_dist
+  alt_i, alt_j = alt_confs[i_pairs], alt_confs[j_pairs]
+  is_bond &= (alt_i == ' ') | (alt_j == ' ') | (alt_i == alt_j)
+  is_bond &= ~(is_metals[i_pairs] | is_metals[j_pairs]) | \
+      (i_residues[i_pairs] == i_residues[j_pairs])
+  return np.array([i_pairs[is_bond], j_pairs[is_bond]], dtype=np.int32).T
+
+
+color_by_ss = {
+  '-': (0.5, 0.5, 0.5),
+  'C': (0.5, 0.5, 0.5),
+  'H': (0.8, 0.4, 0.4),
+  'E': (0.4, 0.4, 0.8)
+}
+
+
+class HbondLookup():
+  """
+  Vectorized membership test on a CSR H-bond pattern, using the 
+  sorted keys i*n_res + j of all its pairs.
+  """
+  def __init__(self, n_res, indptr, partners):
+    self.n_res = n_res
+    i_rows = np.repeat(np.arange(n_res), np.diff(indptr))
+    self.keys = i_rows*n_res + np.asarray(partners, dtype=np.int64)
+
+  def is_hb(self, i_res, j_res):
+    i_res = np.asarray(i_res, dtype=np.int64)
+    j_res = np.asarray(j_res, dtype=np.int64)
+    n = self.n_res
+    is_valid = (0 <= i_res) & (i_res < n) & (0 <= j_res) & (j_res < n)
+    if len(self.keys) == 0:
+      return np.zeros(is_valid.shape, dtype=bool)
+    keys = i_res*n + j_res
+    i_keys = np.minimum(np.searchsorted(self.keys, keys), len(self.keys)-1)
+    return is_valid & (self.keys[i_keys] == keys)
+
+
+def assign_ss_by_hbonds(n_res, indptr, partners):
+  """
+  Returns an array of 'H', 'E' or 'C' for every residue from the
+  symmetric CSR H-bond pattern (indptr, partners).
+
+  Helices need two consecutive (i, i+4) or (i, i+3) H-bonds, found
+  with shifted boolean arrays. Sheets need an H-bond (i, j) with 
+  |i-j| > 5 plus a parallel or anti-parallel neighbouring pair, 
+  and only the actual H-bonds are checked. When residues match 
+  several patterns, the result is the one of the last match in 
+  the order of a scan over i, with helices tested before sheets
+  for the same i.
+  """
+  lookup = HbondLookup(n_res, indptr, partners)
+  is_hb = lookup.is_hb
+
+  # every match is stamped with its scan time, 2*i for helices
+  # and 2*i + 1 for sheets, and the latest stamp wins
+  last_helix = np.full(n_res, -1, dtype=np.int64)
+  last_sheet = np.full(n_res, -1, dtype=np.int64)
+
+  i_res = np.arange(n_res)
+  for n_turn in [4, 3]:
+    is_start = is_hb(i_res, i_res+n_turn) & is_hb(i_res+1, i_res+n_turn+1)
+    starts = i_res[is_start]
+    for offset in range(1, n_turn+1):
+      last_helix[starts+offset] = np.maximum(
+          last_helix[starts+offset], 2*starts)
+
+  i_res1 = np.repeat(i_res, np.diff(indptr))
+  i_res2 = np.asarray(partners, dtype=np.int64)
+  is_far = np.abs(i_res1 - i_res2) > 5
+  i_res1, i_res2 = i_res1[is_far], i_res2[is_far]
+  for d1, d2 in [(-2, -2), (2, 2), (-2, 2), (2, -2)]:
+    # parallel beta sheet pairs, then anti-parallel pairs
+    is_pair = is_hb(i_res1+d1, i_res2+d2)
+    res1, res2 = i_res1[is_pair], i_res2[is_pair]
+    for d in [0, d1//2, d1]:
+      np.maximum.at(last_sheet, res1+d, 2*res1 + 1)
+    for d in [0, d2//2, d2]:
+      np.maximum.at(last_sheet, res2+d, 2*res1 + 1)
+
+  ss = np.full(n_res, 'C', dtype='S1')
+  ss[last_helix > last_sheet] = 'H'
+  ss[last_sheet > last_helix] = 'E'
+  return ss
+
+
+def get_draw_atom_indices(atoms):
+  """
+  Returns the indices of the atoms of an AtomTable that are drawn
+  as balls and sticks: all but the hydrogens and the backbone.
+  """
+  # keep CA so that sidechains connect to the trace, without
+  # changing the shared backbone_atoms list
+  skip_types = [t for t in backbone_atoms if t != 'CA']
+  is_drawn = ~np.in1d(atoms.atom_types, skip_types) & (atoms.elements != 'H')
+  return np.nonzero(is_drawn)[0]
+
+
+class RenderedSoup():
+  """
+  Trace, pieces, bonds and secondary structure of the structure in 
+  an atomtable.AtomTable. The objid of an atom is its row in the 
+  table, and the ss and colors residue columns are filled in here.
+  With is_bonds False, bonds are left as None until find_bonds, 
+  which only the ball-and-stick mesh needs, so that the trace 
+  meshes can be built first. With a skin, the H-bond candidates are
+  kept in a VerletList for update_ss, which only pays off when the
+  atoms move.
+  """
+  def __init__(self, atoms, hbond_mode='distance', skin=None, is_bonds=True):
+    self.atoms = atoms
+    self.hbond_mode = hbond_mode
+    if skin is None:
+      self.hbond_neighbours = None
+    else:
+      self.hbond_neighbours = VerletList(
+          5.2 if hbond_mode == 'dssp' else 3.5, skin)
+
+    with profiling.span('build_trace') as span:
+      self.build_trace()
+      span.count('residues', len(self.trace.points))
+
+    self.pieces = []
+    with profiling.span('find_pieces') as span:
+      self.find_pieces()
+      span.count('pieces', len(self.pieces))
+
+    # self.find_ss_by_zhang_skolnick()
+    with profiling.span('find_bb_hbonds') as span:
+      self.find_bb_hbonds()
+      span.count('hbond_partners', len(self.hb_partners))
+    with profiling.span('find_ss_by_bb_hbonds'):
+      self.find_ss_by_bb_hbonds()
+
+    self.bonds = None
+    if is_bonds:
+      self.find_bonds()
+
+  def get_picking_tables(self):
+    """
+    Returns arrays, indexed by objid, of the atom positions and the
+    labels shown when hovering over an atom, and the objids that 
+    the trace meshes and the ball-and-stick mesh are made of.
+    """
+    return {
+      'atom_positions': self.atoms.positions.astype(np.float32),
+      'atom_labels': self.atoms.get_atom_labels(),
+      'trace_objids': self.trace.objids.astype(np.int32),
+      'draw_objids': self.atoms.objids[get_draw_atom_indices(self.atoms)],
+    }
+
+  def build_trace(self):
+    atoms = self.atoms
+    atoms.ss[:] = '-'
+    atoms.colors[:] = atomtable.default_res_color
+
+    i_cas = atoms.find_res_atoms('CA')
+    i_cs = atoms.find_res_atoms('C')
+    i_os = atoms.find_res_atoms('O')
+    is_trace = (i_cas >= 0) & (i_cs >= 0) & (i_os >= 0)
+    self.res_objids = np.where(is_trace, i_cas, atoms.res_starts[:-1])
+
+    i_residues = np.nonzero(is_trace)[0]
+    self.trace_atom_indices = \
+        (i_cas[i_residues], i_cs[i_residues], i_os[i_residues])
+    self.trace = Trace(len(i_residues))
+    self.trace.i_residues[:] = i_residues
+    self.trace.objids[:] = self.res_objids[i_residues]
+    self.trace.colors[:] = atoms.colors[i_residues]
+    self.set_trace_points()
+
+    # find geometrical center of points
+    self.center = v3.get_center(self.trace.points)
+    centered_points = self.trace.points - self.center
+
+    self.scale = 1.0/centered_points.max()
+
+  def set_trace_points(self):
+    """
+    Sets the trace points to the CA positions and the raw ups to 
+    the C-O vectors, flipped to point in the same direction.
+    """
+    positions = self.atoms.positions
+    i_cas, i_cs, i_os = self.trace_atom_indices
+    self.trace.points[:] = positions[i_cas]
+    ups = self.trace.ups
+    ups[:] = positions[i_cs] - positions[i_os]
+    dots = (ups[:-1]*ups[1:]).sum(axis=1)
+    signs = np.cumprod(np.where(dots < 0, -1, 1))
+    ups[1:] *= signs[:,np.newaxis]
+
+  def set_positions(self, positions):
+    """
+    Moves the atoms to the (n_atom, 3) positions, such as another
+    model of an ensemble, and recomputes the trace, the tangents and
+    ups of the pieces, and the bond ups. Bonds, pieces, secondary 
+    structure and colors are kept, so that the meshes only change
+    in their vertex positions and normals.
+    """
+    self.atoms.positions[:] = positions
+    self.set_trace_points()
+    self.orient_pieces()
+    self.orient_bonds()
+
+  def get_trace_positions(self, atom_type):
+    """
+    Returns the (n_res, 3) positions of atom_type in the trace 
+    residues, with NaN for residues without one.
+    """
+    i_atoms = self.atoms.find_res_atoms(atom_type)[self.trace.i_residues]
+    positions = np.full((len(i_atoms), 3), np.nan)
+    positions[i_atoms >= 0] = self.atoms.positions[i_atoms[i_atoms >= 0]]
+    return positions
+
+  def update_ss(self):
+    """
+    Reassigns the H-bonds and secondary structure, and the residue 
+    colors, at the current positions, such as after set_positions. 
+    With a skin, the H-bond candidates are kept in a VerletList, so
+    frames of a trajectory mostly skip the spatial hashing. Returns
+    True if the secondary structure has changed.
+    """
+    ss = self.trace.ss.copy()
+    self.set_bb_hbonds()
+    self.set_ss_by_bb_hbonds()
+    return not np.array_equal(ss, self.trace.ss)
+
+  def find_bb_hbonds(self):
+    print "Find H-Bonds..."
+    self.set_bb_hbonds()
+
+  def set_bb_hbonds(self):
+    n_res = len(self.trace.points)
+    n_positions = self.get_trace_positions('N')
+    o_positions = self.get_trace_positions('O')
+    if self.hbond_mode == 'dssp':
+      c_positions = self.get_trace_positions('C')
+      is_prolines = self.atoms.res_types[self.trace.i_residues] == 'PRO'
+      self.hb_indptr, self.hb_partners = find_dssp_hbond_pairs(
+          n_positions, c_positions, o_positions, is_prolines, 
+          neighbours=self.hbond_neighbours)
+    elif self.hbond_mode == 'distance':
+      i_residues = np.arange(n_res)
+      has_o = np.isfinite(o_positions[:,0])
+      has_n = np.isfinite(n_positions[:,0])
+      self.hb_indptr, self.hb_partners = find_bb_hbond_pairs(
+          np.concatenate([o_positions[has_o], n_positions[has_n]]),
+          np.concatenate([i_residues[has_o], i_residues[has_n]]),
+          np.arange(has_o.sum() + has_n.sum()) < has_o.sum(),
+          n_res, neighbours=self.hbond_neighbours)
+    else:
+      raise ValueError("Unknown H-bond mode '%s'" % self.hbond_mode)
+
+  def get_hb_partners(self, i_res):
+    return self.hb_partners[self.hb_indptr[i_res]:self.hb_indptr[i_res+1]]
+
+  def find_ss_by_bb_hbonds(self):
+    print "Find Secondary Structure..."
+    self.set_ss_by_bb_hbonds()
+
+  def set_ss_by_bb_hbonds(self):
+    ss = assign_ss_by_hbonds(
+        len(self.trace.points), self.hb_indptr, self.hb_partners)
+    self.trace.ss[:] = ss
+    for code, color in color_by_ss.items():
+      self.trace.colors[ss == code] = color
+    self.atoms.ss[self.trace.i_residues] = ss
+    self.atoms.colors[self.trace.i_residues] = self.trace.colors
+
+  def find_pieces(self, cutoff=5.5):
+    """
+    Splits the trace into pieces wherever consecutive points are 
+    further apart than cutoff, and orients the pieces.
+    """
+    trace = self.trace
+    points = trace.points
+    n_point = len(points)
+    self.pieces = []
+    self.piece_starts = self.piece_ends = np.zeros(0, dtype=np.int64)
+    if n_point == 0:
+      return
+
+    steps = points[1:] - points[:-1]
+    is_break = np.sqrt((steps*steps).sum(axis=1)) > cutoff
+    self.piece_ends = np.append(np.nonzero(is_break)[0] + 1, n_point)
+    self.piece_starts = np.append(0, self.piece_ends[:-1])
+    self.orient_pieces()
+
+    for i, j in zip(self.piece_starts.tolist(), self.piece_ends.tolist()):
+      self.pieces.append(SubTrace(trace, i, j))
+
+  def orient_pieces(self):
+    """
+    Sets the tangents and smoothed ups of every piece with array 
+    operations over the whole trace.
+    """
+    def mag(v):
+      return np.sqrt((v*v).sum(axis=1))[:,np.newaxis]
+
+    trace = self.trace
+    points = trace.points
+    n_point = len(points)
+    if n_point == 0:
+      return
+
+    starts, ends = self.piece_starts, self.piece_ends
+    firsts = np.repeat(starts, ends - starts)
+    lasts = np.repeat(ends - 1, ends - starts)
+    k = np.arange(n_point)
+
+    # central differences inside a piece, one-sided at its ends
+    i_nexts = np.where((k == lasts) & (k != firsts), k, k+1)
+    i_prevs = np.where(k == firsts, k, k-1)
+    tangents = points[np.minimum(i_nexts, n_point-1)] - points[i_prevs]
+    trace.tangents[:] = tangents/mag(tangents)
+
+    # smooth then rotate
+    ups = trace.ups.copy()
+    is_after_first = k > firsts
+    ups[is_after_first] += trace.ups[k[is_after_first] - 1]
+    is_first = ~is_after_first & (k < lasts)
+    ups[is_first] += trace.ups[k[is_first] + 1]
+    tangents = trace.tangents
+    lengths = mag(tangents)
+    dots = (ups*tangents).sum(axis=1)[:,np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+      parallels = np.where(lengths > 0, dots/lengths/lengths*tangents, 0)
+    ups = ups - parallels
+    trace.ups[:] = ups/mag(ups)
+
+  def find_bonds(self):
+    print "Finding bonds..."
+    atoms = self.atoms
+    with profiling.span('find_bonds') as span:
+      self.draw_atom_indices = get_draw_atom_indices(atoms)
+      i_atoms = self.draw_atom_indices
+      self.bonds = find_covalent_bonds(
+          atoms.positions[i_atoms],
+          atoms.elements[i_atoms],
+          atoms.alt_confs[i_atoms],
+          atoms.res_indices[i_atoms])
+      self.orient_bonds()
+      span.count('bonds', len(self.bonds))
+
+  def orient_bonds(self):
+    if self.bonds is None:
+      return
+    positions = self.atoms.positions[self.draw_atom_indices]
+    self.bond_tangents = positions[self.bonds[:,1]] - positions[self.bonds[:,0]]
+    self.bond_ups = np.cross(positions[self.bonds[:,0]], self.bond_tangents)
+
+
+# radii of the spheres hit by ray picking, about the half-width of
+# the cartoon, and a sphere with half of its bonds
+ray_pick_radii = {'trace': 0.8, 'atoms': 0.4}
+
+
+class RayPicker():
+  """
+  Picks without drawing, by casting a ray through a SpaceHash of 
+  the positions of objids, each a sphere of the same radius.
+  """
+  def __init__(self, positions, objids, radius, div=3.0):
+    self.objids = np.asarray(objids)
+    self.radius = radius
+    self.space_hash = SpaceHash(positions, div)
+
+  def pick(self, origin, direction):
+    """
+    Returns (objid, t) of the first sphere hit by the ray origin +
+    t*direction, or (-1, inf).
+    """
+    i, t = self.space_hash.query_ray(origin, direction, self.radius)
+    if i < 0:
+      return -1, t
+    return int(self.objids[i]), t
+
+
+def pick_by_ray(ray_pickers, origin, direction):
+  """
+  Returns the objid of the nearest hit of any of ray_pickers, or -1.
+  """
+  objid, t_min = -1, np.inf
+  for ray_picker in ray_pickers:
+    hit_objid, t = ray_picker.pick(origin, direction)
+    if t < t_min:
+      objid, t_min = hit_objid, t
+  return objid
+
+
+def encode_objids(objids):
+  """
+  Returns objids+1 split into 16-bit halves, (..., 2) float32 that
+  are exact however many objids there are, unlike a single float,
+  which loses integers past 2**24. 0 is left for the background.
+  """
+  objids = np.asarray(objids, dtype=np.int64) + 1
+  return np.stack([objids & 0xffff, objids >> 16], axis=-1).astype(np.float32)
+
+
+class TriangleStore:
+  """
+  Vertex and triangle index storage for one mesh. Both arrays are 
+  allocated up front: vertices are written in place and indices 
+  use uint16 when every vertex can be addressed by it. Objids are
+  stored as in encode_objids.
+  """
+  def __init__(self, n_vertex, n_index=0):
+    self.data = np.zeros(
+      n_vertex, 
+      [('a_position', np.float32, 3),
+       ('a_normal', np.float32, 3),
+       ('a_color', np.float32, 3),
+       ('a_objid', np.float32, 2)])
+    self.i_vertex = 0
+    self.n_vertex = n_vertex
+    if n_vertex <= 2**16:
+      index_dtype = np.uint16
+    else:
+      index_dtype = np.uint32
+    self.indices = np.zeros(n_index, dtype=index_dtype)
+    self.i_index = 0
+
+  def add_vertex(self, vertex, normal, color, objid):
+    self.data[self.i_vertex] = (vertex, normal, color, encode_objids(objid))
+    self.i_vertex += 1
+
+  def add_vertices(self, vertices, normals, colors, objids):
+    """
+    Adds a block of vertices with one slice assignment per
+    attribute; colors and objids may be single values.
+    """
+    i = self.i_vertex
+    j = i + len(vertices)
+    self.data['a_position'][i:j] = vertices
+    self.data['a_normal'][i:j] = normals
+    self.data['a_color'][i:j] = colors
+    self.data['a_objid'][i:j] = encode_objids(objids)
+    self.i_vertex = j
+
+  def add_indices(self, template, base=None):
+    """
+    Adds the triangle indices in template offset by base, which
+    defaults to self.i_vertex. If base is an array, a copy of
+    template is added for every offset in base.
+    """
+    if base is None:
+      base = self.i_vertex
+    indices = np.add.outer(base, template).ravel()
+    i = self.i_index
+    j = i + len(indices)
+    if j > len(self.indices):
+      # only reached if n_index was underestimated
+      grown = np.zeros(max(j, 2*len(self.indices)), dtype=self.indices.dtype)
+      grown[:i] = self.indices[:i]
+      self.indices = grown
+    self.indices[i:j] = indices
+    self.i_index = j
+
+  def setup_next_strip(self, indices):
+    """
+    Add triangular indices relative to self.i_vertex
+    """
+    self.add_indices(indices)
+
+  def finalize(self):
+    """
+    Trims the vertex and index arrays to what has been added.
+    """
+    self.data = self.data[:self.i_vertex]
+    self.n_vertex = self.i_vertex
+    self.indices = self.indices[:self.i_index]
+    return self
+
+  def vertex_buffer(self):
+    self.finalize()
+    from vispy import gloo
+    return gloo.VertexBuffer(self.data) 
+
+  def attribute_buffers(self):
+    """
+    Returns a dict of one VertexBuffer per attribute, so that
+    positions and normals can be updated without the rest.
+    """
+    from vispy import gloo
+    self.finalize()
+    return dict(
+        (name, gloo.VertexBuffer(np.ascontiguousarray(self.data[name])))
+        for name in self.data.dtype.names)
+  
+  def index_buffer(self):
+    self.finalize()
+    from vispy import gloo
+    return gloo.IndexBuffer(self.indices) 
+
+
+def merge_triangle_stores(triangle_stores):
+  """
+  Returns one TriangleStore holding the meshes of triangle_stores
+  one after the other, with their indices offset to the merged
+  vertices, the same as building them into one store in order.
+  """
+  n_vertex = sum(t.n_vertex for t in triangle_stores)
+  n_index = sum(len(t.indices) for t in triangle_stores)
+  merged = TriangleStore(n_vertex, n_index)
+  for t in triangle_stores:
+    merged.add_indices(t.indices.astype(np.int64))
+    merged.data[merged.i_vertex:merged.i_vertex + t.n_vertex] = t.data
+    merged.i_vertex += t.n_vertex
+  return merged.finalize()
+
+
+def triangle_store_from_arrays(data, indices):
+  """
+  Wraps finished vertex and index arrays, such as those loaded
+  from the mesh cache, in a TriangleStore.
+  """
+  triangle_store = TriangleStore(0)
+  triangle_store.data = data
+  triangle_store.n_vertex = triangle_store.i_vertex = len(data)
+  triangle_store.indices = indices
+  triangle_store.i_index = len(indices)
+  return triangle_store
+
+
+
+def get_calpha_arrow_geometry(
+    trace, length=0.7, width=0.35, thickness=0.3):
+  """
+  Returns the (n_vertex, 3) vertices and normals of the arrows of
+  make_calpha_arrow_mesh.
+  """
+  arrow = render.Arrow(length, width, thickness)
+  orientates = render.get_xy_face_rotations(trace.tangents, trace.ups, 1.0)
+  vertices = render.transform_templates(orientates, arrow.points)
+  vertices = vertices + trace.points[:,np.newaxis,:]
+  normals = render.transform_templates(orientates, arrow.normals)
+  return vertices.reshape(-1, 3), normals.reshape(-1, 3)
+
+
+def make_calpha_arrow_mesh(
+    trace, length=0.7, width=0.35, thickness=0.3):
+  arrow = render.Arrow(length, width, thickness)
+
+  n_point = len(trace.points)
+  n_arrow_vertex = len(arrow.points)
+  triangle_store = TriangleStore(
+      n_point*n_arrow_vertex, n_point*len(arrow.face_indices))
+
+  vertices, normals = get_calpha_arrow_geometry(
+      trace, length, width, thickness)
+  colors = trace.colors
+
+  triangle_store.add_indices(
+      arrow.face_indices, n_arrow_vertex*np.arange(n_point))
+  triangle_store.add_vertices(
+      vertices,
+      normals,
+      np.repeat(colors, n_arrow_vertex, axis=0),
+      np.repeat(trace.objids, n_arrow_vertex))
+
+  return triangle_store.finalize()
+
+
+
+def get_cylinder_trace_halves(pieces):
+  """
+  Returns (starts, tangents, ups, colors, objids) of the 
+  half-cylinders of make_cylinder_trace_mesh.
+  """
+  # every segment is drawn as a half-cylinder from either end, 
+  # interleaved in segment order
+  starts = []
+  tangents = []
+  ups = []
+  colors = []
+  objids = []
+  for piece in pieces:
+    points = piece.points
+    if len(points) < 2:
+      continue
+    tangent = 0.5*(points[1:] - points[:-1])
+    up = piece.ups[:-1] + piece.ups[1:]
+    color = piece.colors
+    starts.append(np.stack([points[:-1], points[1:]], axis=1))
+    tangents.append(np.stack([tangent, -tangent], axis=1))
+    ups.append(np.stack([up, up], axis=1))
+    colors.append(np.stack([color[:-1], color[1:]], axis=1))
+    objids.append(np.stack([piece.objids[:-1], piece.objids[1:]], axis=1))
+
+  if starts:
+    starts, tangents, ups, colors = [
+        np.concatenate(a).reshape(-1, 3)
+        for a in [starts, tangents, ups, colors]]
+    objids = np.concatenate(objids).ravel()
+  else:
+    starts = tangents = ups = colors = np.zeros((0, 3), dtype=np.float32)
+    objids = np.zeros(0, dtype=np.int32)
+  return starts, tangents, ups, colors, objids
+
+
+def get_cylinder_geometry(cylinder, starts, tangents, ups, radius):
+  """
+  Returns the (n_vertex, 3) vertices and normals of a copy of the
+  cylinder template for every start, tangent and up.
+  """
+  orientates = cylinder.get_orientates(tangents, ups, radius)
+  vertices = render.transform_templates(orientates, cylinder.points)
+  vertices = vertices + starts[:,np.newaxis,:]
+  normals = render.transform_templates(orientates, cylinder.normals)
+  return vertices.reshape(-1, 3), normals.reshape(-1, 3)
+
+
+def get_cylinder_trace_geometry(pieces, coil_detail=4, radius=0.3):
+  starts, tangents, ups, colors, objids = get_cylinder_trace_halves(pieces)
+  return get_cylinder_geometry(
+      render.Cylinder(coil_detail), starts, tangents, ups, radius)
+
+
+def make_cylinder_trace_mesh(pieces, coil_detail=4, radius=0.3):
+  cylinder = render.Cylinder(coil_detail)
+  starts, tangents, ups, colors, objids = get_cylinder_trace_halves(pieces)
+
+  n_half = len(starts)
+  triangle_store = TriangleStore(
+      n_half*cylinder.n_vertex, n_half*len(cylinder.indices))
+
+  vertices, normals = get_cylinder_geometry(
+      cylinder, starts, tangents, ups, radius)
+
+  triangle_store.add_indices(
+      cylinder.indices, cylinder.n_vertex*np.arange(n_half))
+  triangle_store.add_vertices(
+      vertices,
+      normals,
+      np.repeat(colors, cylinder.n_vertex, axis=0),
+      np.repeat(objids, cylinder.n_vertex))
+
+  return triangle_store.finalize()
+
+
+def make_carton_builders(
+    pieces, coil_detail=5, spline_detail=3, 
+    width=1.6, thickness=0.2):
+  """
+  Returns the TubeBuilders of the cartoon, one for every run of
+  the same secondary structure in a piece.
+  """
+  rect = render.RectProfile(width, 0.15)
+  circle = render.CircleProfile(coil_detail, 0.3)
+
+  builders = []
+  for piece in pieces:
+    spline = SplineTrace(piece, 2*spline_detail)
+
+    n_point = len(piece.points)
+
+    i_point = 0
+    j_point = 1
+    while i_point < n_point:
+
+      ss = piece.ss[i_point]
+      color = piece.colors[i_point]
+      color = [min(1.0, 1.2*c) for c in color]
+      profile = circle if ss == "C" else rect  
+
+      while j_point < n_point and piece.ss[j_point] == ss:
+        j_point += 1
+
+      i_spline = 2*i_point*spline_detail - spline_detail
+      if i_spline < 0:
+        i_spline = 0
+      j_spline = (j_point-1) * 2*spline_detail + spline_detail + 1
+      if j_spline > len(spline.points) - 1:
+        j_spline = len(spline.points) - 1
+
+      sub_spline = SubTrace(spline, i_spline, j_spline)
+
+      builders.append(render.TubeBuilder(sub_spline, profile, color))
+
+      i_point = j_point
+      j_point = i_point + 1
+
+  return builders
+
+
+def get_carton_geometry(
+    pieces, coil_detail=5, spline_detail=3, 
+    width=1.6, thickness=0.2):
+  """
+  Returns the (n_vertex, 3) vertices and normals of the cartoon of
+  make_carton_mesh.
+  """
+  return render.get_tube_geometries(make_carton_builders(
+      pieces, coil_detail, spline_detail, width, thickness))
+
+
+def make_carton_mesh(
+    pieces, coil_detail=5, spline_detail=3, 
+    width=1.6, thickness=0.2):
+
+  builders = make_carton_builders(
+      pieces, coil_detail, spline_detail, width, thickness)
+
+  n_vertex = sum(r.n_vertex for r in builders)
+  n_index = sum(r.n_index for r in builders)
+  triangle_store = TriangleStore(n_vertex, n_index)
+
+  for r in builders:
+      r.build_triangles(triangle_store)
+
+  return triangle_store.finalize()
+
+
+
+def get_ball_and_stick_geometry(
+    atom_positions, bonds, bond_ups, 
+    sphere_stack=5, sphere_arc=5, radius=0.2):
+  """
+  Returns the (n_vertex, 3) vertices and normals of the spheres 
+  and then the half-cylinders of build_ball_and_stick_store.
+  """
+  sphere = render.Sphere(sphere_stack, sphere_arc)
+  cylinder = render.Cylinder(4)
+
+  atom_positions = np.asarray(atom_positions).reshape(-1, 3)
+  bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+  bond_ups = np.asarray(bond_ups).reshape(-1, 3)
+  n_atom = len(atom_positions)
+
+  orientate = sphere.get_orientate(radius)[np.newaxis,:3,:3]
+  points = np.array(sphere.points)
+  sphere_vertices = render.transform_templates(orientate, points)
+  sphere_vertices = sphere_vertices + atom_positions[:,np.newaxis,:]
+  sphere_normals = np.tile(points, (n_atom, 1)) # same as normal!
+
+  # each bond is drawn as a half-cylinder from either atom, 
+  # interleaved as (atom1, atom2) in bond order
+  tangents = 0.5*(atom_positions[bonds[:,1]] - atom_positions[bonds[:,0]])
+  tangents = np.stack([tangents, -tangents], axis=1).reshape(-1, 3)
+  ups = np.repeat(bond_ups, 2, axis=0)
+  bond_vertices, bond_normals = get_cylinder_geometry(
+      cylinder, atom_positions[bonds.ravel()], tangents, ups, radius)
+
+  return (
+      np.concatenate([sphere_vertices.reshape(-1, 3), bond_vertices]),
+      np.concatenate([sphere_normals, bond_normals]))
+
+
+def build_ball_and_stick_store(
+    atom_positions, atom_colors, atom_objids, bonds, bond_ups,
+    sphere_stack=5, sphere_arc=5, radius=0.2):
+  """
+  Returns a TriangleStore of a sphere for every atom and two 
+  half-cylinders for every bond, where bonds is an (n_bond, 2) 
+  array of indices into the atom arrays. The sphere and cylinder
+  templates are broadcast over all atoms and bonds at once.
+  """
+  sphere = render.Sphere(sphere_stack, sphere_arc)
+  cylinder = render.Cylinder(4)
+
+  atom_positions = np.asarray(atom_positions).reshape(-1, 3)
+  atom_colors = np.asarray(atom_colors).reshape(-1, 3)
+  atom_objids = np.asarray(atom_objids)
+  bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+  bond_ups = np.asarray(bond_ups).reshape(-1, 3)
+
+  n_atom = len(atom_positions)
+  n_half_bond = 2*len(bonds)
+  n_vertex = n_atom*sphere.n_vertex + n_half_bond*cylinder.n_vertex
+  n_index = n_atom*len(sphere.indices) + n_half_bond*len(cylinder.indices)
+  triangle_store = TriangleStore(n_vertex, n_index)
+
+  vertices, normals = get_ball_and_stick_geometry(
+      atom_positions, bonds, bond_ups, sphere_stack, sphere_arc, radius)
+  triangle_store.add_indices(
+      sphere.indices, sphere.n_vertex*np.arange(n_atom))
+  triangle_store.add_indices(
+      cylinder.indices, 
+      n_atom*sphere.n_vertex + cylinder.n_vertex*np.arange(n_half_bond))
+
+  i_atoms = bonds.ravel()
+  triangle_store.add_vertices(
+      vertices,
+      normals,
+      np.concatenate([
+          np.repeat(atom_colors, sphere.n_vertex, axis=0),
+          np.repeat(atom_colors[i_atoms], cylinder.n_vertex, axis=0)]),
+      np.concatenate([
+          np.repeat(atom_objids, sphere.n_vertex),
+          np.repeat(atom_objids[i_atoms], cylinder.n_vertex)]))
+
+  return triangle_store
+
+
+def make_ball_and_stick_mesh(
+    rendered_soup, sphere_stack=5, sphere_arc=5, 
+    tube_arc=5, radius=0.2):
+
+  atoms = rendered_soup.atoms
+  i_atoms = rendered_soup.draw_atom_indices
+  return build_ball_and_stick_store(
+      atoms.positions[i_atoms],
+      atoms.colors[atoms.res_indices[i_atoms]],
+      atoms.objids[i_atoms],
+      rendered_soup.bonds,
+      rendered_soup.bond_ups,
+      sphere_stack, sphere_arc, radius)
+
+
+def get_mesh_geometry(rendered_soup, name, params):
+  """
+  Returns the (n_vertex, 3) vertices and normals of the mesh name 
+  of build_meshes for the current atom positions of rendered_soup, 
+  in the same vertex order. Colors, objids and indices are left 
+  out as they do not change when the atoms move.
+  """
+  if name == 'arrows':
+    return get_calpha_arrow_geometry(rendered_soup.trace, **params)
+  if name == 'cylinder_trace':
+    return get_cylinder_trace_geometry(rendered_soup.pieces, **params)
+  if name == 'cartoon':
+    return get_carton_geometry(rendered_soup.pieces, **params)
+  if name == 'ballstick':
+    i_atoms = rendered_soup.draw_atom_indices
+    return get_ball_and_stick_geometry(
+        rendered_soup.atoms.positions[i_atoms], 
+        rendered_soup.bonds, 
+        rendered_soup.bond_ups,
+        params['sphere_stack'], params['sphere_arc'], params['radius'])
+  raise ValueError("Unknown mesh '%s'" % name)
+
+
+
+# Bump whenever the output of the mesh builders changes, 
+# to invalidate the meshes in the on-disk cache
+mesh_builder_version = 4
+
+mesh_params = {
+  'arrows': {'length': 0.7, 'width': 0.35, 'thickness': 0.3},
+  'cylinder_trace': {'coil_detail': 4, 'radius': 0.3},
+  'cartoon': {
+      'coil_detail': 5, 'spline_detail': 3, 
+      'width': 1.6, 'thickness': 0.2},
+  'ballstick': {
+      'sphere_stack': 5, 'sphere_arc': 5, 
+      'tube_arc': 5, 'radius': 0.2},
+}
+
+
+def build_mesh(rendered_soup, name, params, pieces=None):
+  """
+  Returns the finished TriangleStore of the mesh name, where the
+  trace meshes are built from pieces, by default all of them.
+  """
+  if pieces is None:
+    pieces = rendered_soup.pieces
+  if name == 'arrows':
+    make_mesh, args = make_calpha_arrow_mesh, (rendered_soup.trace,)
+  elif name == 'cylinder_trace':
+    make_mesh, args = make_cylinder_trace_mesh, (pieces,)
+  elif name == 'cartoon':
+    make_mesh, args = make_carton_mesh, (pieces,)
+  elif name == 'ballstick':
+    if rendered_soup.bonds is None:
+      rendered_soup.find_bonds()
+    make_mesh, args = make_ball_and_stick_mesh, (rendered_soup,)
+  else:
+    raise ValueError("Unknown mesh '%s'" % name)
+  with profiling.span(make_mesh.__name__, mesh=name) as span:
+    triangle_store = make_mesh(*args, **params)
+    span.count('vertices', triangle_store.n_vertex)
+    span.count('indices', len(triangle_store.indices))
+    span.count('mesh_bytes', get_mesh_n_byte(triangle_store))
+  return triangle_store
+
+
+mesh_build_messages = [
+  ('arrows', 'Building arrows...'),
+  ('cylinder_trace', 'Building cylindrical trace...'),
+  ('cartoon', 'Building cartoon...'),
+  ('ballstick', 'Building ball&sticks...'),
+]
+
+
+def split_pieces(pieces, n_part):
+  """
+  Returns the (i, j) ranges that split pieces into at most n_part
+  runs of consecutive pieces with about the same number of points.
+  """
+  if not pieces:
+    return [(0, 0)]
+  sizes = np.cumsum([len(piece.points) for piece in pieces])
+  targets = sizes[-1]*np.arange(1, n_part)/float(n_part)
+  bounds = np.unique(np.concatenate(
+      [[0], np.searchsorted(sizes, targets) + 1, [len(pieces)]]))
+  bounds = np.minimum(bounds, len(pieces))
+  return [(i, j) for i, j in zip(bounds[:-1], bounds[1:]) if i < j]
+
+
+# runs of pieces that the cartoon is split into for a pool, enough
+# to keep the processes of any likely pool busy
+n_cartoon_part = 32
+
+
+def build_cartoon_part(task):
+  """
+  Builds the cartoon of a run of pieces in a pool process, returning
+  the vertex and index arrays.
+  """
+  pieces, params = task
+  triangle_store = make_carton_mesh(pieces, **params)
+  return triangle_store.data, triangle_store.indices
+
+
+def build_meshes(rendered_soup, params=mesh_params, pool=None, names=None):
+  """
+  Returns a dict of the finished TriangleStore of every mesh, or
+  only of the meshes in names. With a multiprocessing pool, the
+  cartoon is split into runs of pieces that are built by the pool
+  processes and merged back in order, while the other meshes are
+  built in the calling thread. The cartoon builders loop over
+  thousands of short secondary-structure runs in Python, which
+  holds the GIL, and so need processes. The pieces are pickled to
+  the processes, so the pool can be made once, before any other
+  thread is started, as in pyball.main. Only numpy arrays are made,
+  so GL buffers are still created by the caller on its own thread.
+  """
+  if names is None:
+    names = [name for name, message in mesh_build_messages]
+  cartoon_parts = None
+  if pool is not None and 'cartoon' in names:
+    print "Building cartoon in processes..."
+    pieces = rendered_soup.pieces
+    cartoon_parts = pool.map_async(build_cartoon_part, [
+        (pieces[i:j], params['cartoon'])
+        for i, j in split_pieces(pieces, n_cartoon_part)])
+  meshes = {}
+  for name, message in mesh_build_messages:
+    if name == 'cartoon' and cartoon_parts is not None:
+      continue
+    if name in names:
+      print message
+      meshes[name] = build_mesh(rendered_soup, name, params[name])
+  if cartoon_parts is not None:
+    with profiling.span('make_carton_mesh', mesh='cartoon') as span:
+      triangle_store = merge_triangle_stores([
+          triangle_store_from_arrays(data, indices)
+          for data, indices in cartoon_parts.get()])
+      span.count('vertices', triangle_store.n_vertex)
+      span.count('indices', len(triangle_store.indices))
+      span.count('mesh_bytes', get_mesh_n_byte(triangle_store))
+    meshes['cartoon'] = triangle_store
+  return meshes
+
+
+def meshes_to_arrays(meshes, tables):
+  """
+  Flattens meshes and picking tables into one dict of arrays, 
+  with mesh arrays named '<mesh>.vertices' and '<mesh>.indices'.
+  """
+  arrays = dict(tables)
+  for name, triangle_store in meshes.items():
+    arrays[name + '.vertices'] = triangle_store.data
+    arrays[name + '.indices'] = triangle_store.indices
+  return arrays
+
+
+def arrays_to_meshes(arrays):
+  """
+  Inverse of meshes_to_arrays, returns (meshes, tables).
+  """
+  meshes = {}
+  tables = {}
+  for name in arrays:
+    if name.endswith('.vertices'):
+      mesh_name = name[:-len('.vertices')]
+      meshes[mesh_name] = triangle_store_from_arrays(
+          arrays[name], arrays[mesh_name + '.indices'])
+    elif '.' not in name:
+      tables[name] = arrays[name]
+  return meshes, tables
+
+
+def get_info(rendered_soup):
+  return {
+    'center': [float(x) for x in rendered_soup.center],
+    'scale': float(rendered_soup.scale),
+  }
+
+
+def make_meshes(
+    atoms, params=mesh_params, hbond_mode='distance', pool=None):
+  """
+  Returns (rendered_soup, meshes, tables, info) for an AtomTable,
+  building the meshes as in build_meshes, with pool if given.
+  """
+  rendered_soup = RenderedSoup(atoms, hbond_mode)
+  meshes = build_meshes(rendered_soup, params, pool)
+  tables = rendered_soup.get_picking_tables()
+  return rendered_soup, meshes, tables, get_info(rendered_soup)
+
+
+def structure_to_arrays(rendered_soup, meshes=None, tables=None):
+  """
+  Returns the arrays stored in a struct file: the atom table 
+  columns, with the secondary structure, as 'atoms.<column>', the 
+  bonds as pairs of atom indices in 'bonds.atoms' and, if given, 
+  the meshes and picking tables as in meshes_to_arrays.
+  """
+  arrays = {}
+  if meshes is not None:
+    arrays.update(meshes_to_arrays(meshes, tables))
+  for name, column in rendered_soup.atoms.get_columns().items():
+    arrays['atoms.' + name] = column
+  i_atoms = rendered_soup.draw_atom_indices
+  arrays['bonds.atoms'] = i_atoms[rendered_soup.bonds].astype(np.int32)
+  return arrays
+
+
+def get_mesh_counts(meshes, tables):
+  """
+  Returns the numbers of atoms, and of vertices and indices of 
+  meshes, as a dict of n_atom, n_vertex and n_index.
+  """
+  return {
+    'n_atom': len(tables['atom_positions']),
+    'n_vertex': sum(m.n_vertex for m in meshes.values()),
+    'n_index': sum(len(m.indices) for m in meshes.values()),
+  }
+
+
+def convert_pdb(
+    pdb, fname, params=mesh_params, hbond_mode='distance', is_mesh=True):
+  """
+  Converts the PDB file pdb to the struct file fname, which holds 
+  the atom table, bonds and secondary structure and, unless 
+  is_mesh is False, the built meshes and picking tables. Returns
+  the get_mesh_counts of the stored meshes.
+  """
+  rendered_soup, meshes, tables, info = make_meshes(
+      atomtable.read_pdb(pdb), params, hbond_mode)
+  counts = get_mesh_counts(meshes if is_mesh else {}, tables)
+  if not is_mesh:
+    meshes = tables = None
+  meta = {
+    'info': info,
+    'hbond_mode': hbond_mode,
+    'mesh_builder_version': mesh_builder_version,
+    'mesh_params': params if is_mesh else None,
+  }
+  structfile.write_struct_file(
+      fname, structure_to_arrays(rendered_soup, meshes, tables), meta)
+  return counts
+
+
+def is_stored_mesh_match(meta, params, hbond_mode):
+  """
+  Returns True if the meshes of a struct file with meta were built
+  the same way that params, hbond_mode and this version would.
+  """
+  return meta['mesh_params'] == params and \
+      meta['hbond_mode'] == hbond_mode and \
+      meta['mesh_builder_version'] == mesh_builder_version
+
+
+def table_from_struct_arrays(arrays):
+  columns = dict(
+      (name[len('atoms.'):], array) for name, array in arrays.items()
+      if name.startswith('atoms.'))
+  return atomtable.table_from_columns(columns)
+
+
+def load_struct_meshes(
+    fname, params=mesh_params, hbond_mode='distance', pool=None):
+  """
+  Returns (meshes, tables, info) from a struct file written by 
+  convert_pdb. Stored meshes are memory-mapped if they were built 
+  with the same params, H-bond mode and builder version, otherwise 
+  they are rebuilt from the stored atom table.
+  """
+  arrays, meta = structfile.read_struct_file(fname)
+  if is_stored_mesh_match(meta, params, hbond_mode):
+    print "Loading stored meshes..."
+    meshes, tables = arrays_to_meshes(arrays)
+    return meshes, tables, meta['info']
+  atoms = table_from_struct_arrays(arrays)
+  rendered_soup, meshes, tables, info = make_meshes(
+      atoms, params, hbond_mode, pool)
+  return meshes, tables, info
+
+
+def load_meshes(
+    fname, cache=None, params=mesh_params, hbond_mode='distance', 
+    pool=None):
+  """
+  Returns (meshes, tables, info) for the PDB or struct file fname, 
+  where meshes is a dict of TriangleStores, tables holds the 
+  picking arrays of get_picking_tables, and info holds the center
+  and scale of the structure. With a cache, a hit memory-maps the
+  stored arrays and skips parsing and RenderedSoup entirely. Meshes
+  are built as in build_meshes, with pool if given.
+  """
+  if structfile.is_struct_file(fname):
+    return load_struct_meshes(fname, params, hbond_mode, pool)
+
+  if cache is not None:
+    key = cache.get_key(fname, {'meshes': params, 'hbond_mode': hbond_mode})
+    entry = cache.load(key)
+    if entry is not None:
+      print "Loading cached meshes..."
+      arrays, info = entry
+      meshes, tables = arrays_to_meshes(arrays)
+      return meshes, tables, info
+
+  rendered_soup, meshes, tables, info = make_meshes(
+      atomtable.read_pdb(fname), params, hbond_mode, pool)
+
+  if cache is not None:
+    cache.save(key, meshes_to_arrays(meshes, tables), info)
+
+  return meshes, tables, info
+
+
+def get_mesh_n_byte(triangle_store):
+  return triangle_store.data.nbytes + triangle_store.indices.nbytes
+
+
+class MeshRegistry():
+  """
+  Meshes that are built the first time they are asked for and kept
+  after that. load_meshes(names) returns a dict of the named
+  TriangleStores. If max_bytes is given, the least recently asked
+  for meshes are released when the loaded meshes outgrow it, but
+  never the ones of the current request.
+  """
+  def __init__(self, load_meshes, max_bytes=None):
+    self.load_meshes = load_meshes
+    self.max_bytes = max_bytes
+    self.meshes = collections.OrderedDict()
+    self.n_load = 0
+
+  def get_meshes(self, names):
+    missing = [name for name in names if name not in self.meshes]
+    if missing:
+      self.meshes.update(self.load_meshes(missing))
+      self.n_load += 1
+    result = {}
+    for name in names:
+      # move to the most recently used end
+      result[name] = self.meshes.pop(name)
+      self.meshes[name] = result[name]
+    if self.max_bytes is not None:
+      for name in list(self.meshes.keys()):
+        if self.get_n_byte() <= self.max_bytes:
+          break
+        if name not in result:
+          self.release(name)
+    return result
+
+  def get(self, name):
+    return self.get_meshes([name])[name]
+
+  def is_loaded(self, name):
+    return name in self.meshes
+
+  def get_loaded_names(self):
+    return list(self.meshes.keys())
+
+  def release(self, name):
+    if name in self.meshes:
+      del self.meshes[name]
+
+  def get_n_byte(self):
+    return sum(get_mesh_n_byte(m) for m in self.meshes.values())
+
+
+class MeshSource():
+  """
+  Loads the meshes of one PDB or struct file for a MeshRegistry,
+  one representation at a time. Each mesh has its own cache entry,
+  and the file is only parsed, and the RenderedSoup only made, when
+  a mesh is neither cached nor stored in the struct file.
+  """
+  def __init__(
+      self, fname, cache=None, params=mesh_params, hbond_mode='distance',
+      pool=None):
+    self.fname = fname
+    self.cache = cache
+    self.params = params
+    self.hbond_mode = hbond_mode
+    self.pool = pool
+    self.rendered_soup = None
+    self.stored_meshes = {}
+    self.struct_arrays = None
+    self.file_hasher = None
+    if structfile.is_struct_file(fname):
+      with profiling.span('read_struct_file', fname=fname):
+        arrays, meta = structfile.read_struct_file(fname)
+      self.struct_arrays = arrays
+      if is_stored_mesh_match(meta, params, hbond_mode):
+        self.stored_meshes, self.tables = arrays_to_meshes(arrays)
+        self.info = meta['info']
+        return
+      self.cache = None
+    elif cache is not None:
+      with profiling.span('hash_file', fname=fname):
+        self.file_hasher = hash_file(fname)
+    self.tables, self.info = self.load_tables()
+
+  def get_key(self, params):
+    params = dict(params, hbond_mode=self.hbond_mode)
+    return self.cache.get_key(self.fname, params, self.file_hasher)
+
+  def get_rendered_soup(self):
+    if self.rendered_soup is None:
+      if self.struct_arrays is not None:
+        atoms = table_from_struct_arrays(self.struct_arrays)
+      else:
+        atoms = atomtable.read_pdb(self.fname)
+      self.rendered_soup = RenderedSoup(
+          atoms, self.hbond_mode, is_bonds=False)
+    return self.rendered_soup
+
+  def load_tables(self):
+    if self.cache is not None:
+      key = self.get_key({'tables': True})
+      entry = self.cache.load(key)
+      if entry is not None:
+        return entry
+    rendered_soup = self.get_rendered_soup()
+    tables = rendered_soup.get_picking_tables()
+    info = get_info(rendered_soup)
+    if self.cache is not None:
+      self.cache.save(key, tables, info)
+    return tables, info
+
+  def __call__(self, names):
+    meshes = {}
+    missing = []
+    for name in names:
+      if name in self.stored_meshes:
+        meshes[name] = self.stored_meshes[name]
+        continue
+      if self.cache is not None:
+        with profiling.span('load_cached_mesh', mesh=name):
+          entry = self.cache.load(self.get_key(
+              {'mesh': name, 'params': self.params[name]}))
+          if entry is not None:
+            meshes.update(arrays_to_meshes(entry[0])[0])
+        if entry is not None:
+          print "Loading cached %s mesh..." % name
+          continue
+      missing.append(name)
+    if missing:
+      built = build_meshes(
+          self.get_rendered_soup(), self.params, self.pool, missing)
+      for name, triangle_store in built.items():
+        if self.cache is not None:
+          key = self.get_key({'mesh': name, 'params': self.params[name]})
+          self.cache.save(
+              key, meshes_to_arrays({name: triangle_store}, {}), {})
+      meshes.update(built)
+    return meshes
+
+
+def load_mesh_registry(
+    fname, cache=None, params=mesh_params, hbond_mode='distance',
+    pool=None, max_bytes=None):
+  """
+  Returns (registry, tables, info) as in load_meshes, except that
+  registry is a MeshRegistry that builds, or loads from the cache
+  or struct file, each mesh only when it is first asked for.
+  """
+  source = MeshSource(fname, cache, params, hbond_mode, pool)
+  return MeshRegistry(source, max_bytes), source.tables, source.info
+
+
+class ModelPlayer():
+  """
+  Plays frames of the atoms in an AtomTable, such as the models of
+  an NMR ensemble or the frames of a trajectory.Trajectory, where
+  frames is indexed by frame to give (n_atom, 3) positions. The 
+  bonds, pieces, objids and triangle indices all come from the
+  atoms as given, so a frame only recomputes the vertex positions
+  and normals of the meshes. The secondary structure, and the
+  colors that follow it, are kept too, unless is_update_ss, when
+  they are reassigned every frame and the meshes are rebuilt
+  whenever they change. self.meshes is a MeshRegistry, so meshes
+  that are first asked for during playback are built in the
+  current frame.
+  """
+  def __init__(
+      self, atoms, frames, params=mesh_params, hbond_mode='distance',
+      pool=None, max_bytes=None, is_update_ss=False):
+    self.frames = frames
+    self.params = params
+    self.pool = pool
+    self.is_update_ss = is_update_ss
+    self.rendered_soup = RenderedSoup(
+        atoms, hbond_mode, skin=1.0 if is_update_ss else None)
+    self.meshes = MeshRegistry(self.build_meshes, max_bytes)
+    self.tables = self.rendered_soup.get_picking_tables()
+    self.info = get_info(self.rendered_soup)
+    self.i_frame = 0
+
+  def build_meshes(self, names):
+    return build_meshes(
+        self.rendered_soup, self.params, self.pool, names)
+
+  def get_n_frame(self):
+    return len(self.frames)
+
+  def set_frame(self, i_frame, positions=None):
+    """
+    Moves to frame i_frame, with positions if they have already 
+    been read, such as by a trajectory.FramePrefetcher. Returns
+    True if the secondary structure has changed, when all meshes
+    are out of date and are released, to be built again when next
+    asked for.
+    """
+    self.i_frame = i_frame % self.get_n_frame()
+    if positions is None:
+      positions = self.frames[self.i_frame]
+    self.rendered_soup.set_positions(positions)
+    if not self.is_update_ss:
+      return False
+    with profiling.span('update_ss') as span:
+      is_changed = self.rendered_soup.update_ss()
+      span.count('ss_changes', int(is_changed))
+    if is_changed:
+      # the cartoon follows the secondary structure, and every mesh
+      # is colored by it
+      for name in self.meshes.get_loaded_names():
+        self.meshes.release(name)
+    return is_changed
+
+  def get_geometry(self, name):
+    """
+    Returns the vertices and normals of the mesh name in the 
+    current frame, as float32 arrays ready for upload.
+    """
+    vertices, normals = get_mesh_geometry(
+        self.rendered_soup, name, self.params[name])
+    return vertices.astype(np.float32), normals.astype(np.float32)
+
+
+def open_structure(
+    fname, cache=None, hbond_mode='distance', traj=None, pool=None,
+    max_bytes=None, is_update_ss=False):
+  """
+  Returns (meshes, tables, info, player) for fname, where meshes is
+  a MeshRegistry. Trajectories and multi-model PDB files are played 
+  as frames by player, a ModelPlayer, which is otherwise None.
+  """
+  if traj is not None:
+    atoms = atomtable.read_pdb(fname)
+    frames = trajectory.Trajectory(traj, atoms.get_n_atom())
+  elif not structfile.is_struct_file(fname) and \
+      atomtable.count_models(fname) > 1:
+    atoms, frames = atomtable.read_pdb_models(fname)
+  else:
+    meshes, tables, info = load_mesh_registry(
+        fname, cache, hbond_mode=hbond_mode, pool=pool,
+        max_bytes=max_bytes)
+    return meshes, tables, info, None
+  player = ModelPlayer(
+      atoms, frames, hbond_mode=hbond_mode, pool=pool,
+      max_bytes=max_bytes, is_update_ss=is_update_ss)
+  return player.meshes, player.tables, player.info, player
+
+
+class MeshLoader():
+  """
+  Opens a structure with open_structure, and loads its meshes, on a
+  worker thread, so that the window is up before anything is parsed.
+  The meshes in names are loaded in order, then any that are asked
+  for with request. For a player, request_frame moves to a frame,
+  or stays with i_frame None, and sends back the geometry of the
+  named meshes. Results are handed to the GL thread, which makes
+  the buffers, through a queue drained by get_results:
+
+      ('progress', message)     shown while loading, '' when done
+      ('structure', meshes, tables, info, player)
+      ('mesh', name, triangle_store)
+      ('released', name)        dropped by the registry
+      ('frame', i_frame, positions, {name: (vertices, normals)})
+
+  The MeshRegistry and the player are only used from the worker
+  thread, which reports the meshes that are released. Requests are
+  handled in order, so a mesh is built in the frame of the last
+  ('frame', ...) result before it, or before any frame.
+  """
+  def __init__(self, open_structure, names=()):
+    self.open_structure = open_structure
+    self.requests = Queue.Queue()
+    self.results = Queue.Queue()
+    for name in names:
+      self.request(name)
+    self.thread = threading.Thread(target=self.load)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def request(self, name):
+    self.requests.put(name)
+
+  def request_frame(self, i_frame, positions, names):
+    self.requests.put(('frame', i_frame, positions, names))
+
+  def load(self):
+    messages = dict(mesh_build_messages)
+    try:
+      self.results.put(('progress', 'Reading structure...'))
+      meshes, tables, info, player = self.open_structure()
+      self.results.put(('structure', meshes, tables, info, player))
+      is_loading = True
+      while True:
+        if is_loading and self.requests.empty():
+          self.results.put(('progress', ''))
+          is_loading = False
+        request = self.requests.get()
+        if request is None:
+          return
+        if isinstance(request, tuple):
+          self.load_frame(meshes, player, *request[1:])
+          continue
+        name = request
+        is_loading = True
+        self.results.put(('progress', messages[name]))
+        loaded = set(meshes.get_loaded_names())
+        self.results.put(('mesh', name, meshes.get(name)))
+        for released in loaded - set(meshes.get_loaded_names()):
+          self.results.put(('released', released))
+    except Exception as e:
+      traceback.print_exc()
+      self.results.put(('progress', 'Error: %s' % e))
+
+  def load_frame(self, meshes, player, i_frame, positions, names):
+    """
+    Moves player to frame i_frame and sends the geometry of the
+    named meshes or, if the secondary structure of the frame has
+    changed, sends the frame without geometry, then rebuilds the
+    named meshes and reports the other meshes released.
+    """
+    loaded = meshes.get_loaded_names()
+    is_changed = i_frame is not None and player.set_frame(i_frame, positions)
+    geometries = {}
+    if not is_changed:
+      for name in names:
+        geometries[name] = player.get_geometry(name)
+    positions = player.rendered_soup.atoms.positions.astype(np.float32)
+    self.results.put(('frame', player.i_frame, positions, geometries))
+    if is_changed:
+      for name in loaded:
+        if name not in names:
+          self.results.put(('released', name))
+      rebuilt = meshes.get_meshes(names)
+      for name in names:
+        self.results.put(('mesh', name, rebuilt[name]))
+
+  def get_results(self):
+    results = []
+    while True:
+      try:
+        results.append(self.results.get_nowait())
+      except Queue.Empty:
+        return results
+
+  def close(self):
+    self.request(None)
+    self.thread.join()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content-hashed on-disk cache of named numpy arrays, used to skip
+parsing and mesh building for structures that have been seen
+before.
+
+Every entry is a directory of uncompressed .npy files plus a
+meta.json, so that arrays can be memory-mapped on load. Entries are
+keyed by the file contents, the build parameters and a builder
+version. The least recently used entries are evicted when the
+cache grows past max_bytes.
+"""
+
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pyball')
+default_max_bytes = 2*1024**3
+
+
+def hash_file(fname, hasher=None, block_size=2**20):
+  if hasher is None:
+    hasher = hashlib.sha1()
+  with open(fname, 'rb') as f:
+    while True:
+      block = f.read(block_size)
+      if not block:
+        break
+      hasher.update(block)
+  return hasher
+
+
+def get_dir_size(dirname):
+  size = 0
+  for base in os.listdir(dirname):
+    fname = os.path.join(dirname, base)
+    if os.path.isfile(fname):
+      size += os.path.getsize(fname)
+  return size
+
+
+class MeshCache():
+  def __init__(self, version, cache_dir=None, max_bytes=None):
+    self.version = version
+    if cache_dir is None:
+      cache_dir = os.environ.get('PYBALL_CACHE_DIR', default_cache_dir)
+    self.cache_dir = cache_dir
+    if max_bytes is None:
+      max_bytes = int(os.environ.get('PYBALL_CACHE_BYTES', default_max_bytes))
+    self.max_bytes = max_bytes
+    if not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+
+  def get_key(self, fname, params, file_hasher=None):
+    """
+    Returns a key that changes whenever the contents of fname, the
+    JSON-able build params or the builder version change. Pass the
+    hash_file of fname as file_hasher to make several keys for one
+    file without reading it again.
+    """
+    if file_hasher is None:
+      hasher = hash_file(fname)
+    else:
+      hasher = file_hasher.copy()
+    hasher.update(json.dumps(params, sort_keys=True))
+    hasher.update(str(self.version))
+    return hasher.hexdigest()
+
+  def get_entry_dir(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def read_meta(self, entry_dir):
+    try:
+      with open(os.path.join(entry_dir, 'meta.json')) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def load(self, key):
+    """
+    Returns (arrays, meta) for key, with every array memory-mapped
+    read-only, or None if there is no valid entry.
+    """
+    entry_dir = self.get_entry_dir(key)
+    if not os.path.isdir(entry_dir):
+      return None
+    meta = self.read_meta(entry_dir)
+    if meta is None or meta.get('version') != self.version:
+      shutil.rmtree(entry_dir, ignore_errors=True)
+      return None
+    try:
+      arrays = {}
+      for name in meta['arrays']:
+        fname = os.path.join(entry_dir, name + '.npy')
+        arrays[name] = np.load(fname, mmap_mode='r')
+    except (IOError, ValueError):
+      shutil.rmtree(entry_dir, ignore_errors=True)
+      return None
+    # mark as most recently used
+    os.utime(entry_dir, None)
+    return arrays, meta['meta']
+
+  def save(self, key, arrays, meta):
+    """
+    Stores the dict of arrays and the JSON-able meta under key. The
+    entry is written to a temporary directory first, so that readers
+    never see a partial entry.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+    try:
+      for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), np.asarray(array))
+      with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': self.version,
+            'arrays': sorted(arrays.keys()),
+            'meta': meta}, f)
+      entry_dir = self.get_entry_dir(key)
+      if os.path.isdir(entry_dir):
+        shutil.rmtree(entry_dir, ignore_errors=True)
+      os.rename(tmp_dir, entry_dir)
+    except OSError:
+      # another process got there first
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+    self.evict()
+
+  def evict(self):
+    """
+    Removes entries from older builder versions, then the least
+    recently used entries until the cache fits in max_bytes.
+    """
+    entries = []
+    for key in os.listdir(self.cache_dir):
+      entry_dir = self.get_entry_dir(key)
+      if key.startswith('.tmp-') or not os.path.isdir(entry_dir):
+        continue
+      meta = self.read_meta(entry_dir)
+      if meta is None or meta.get('version') != self.version:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        continue
+      entries.append(
+          (os.path.getmtime(entry_dir), get_dir_size(entry_dir), entry_dir))
+    entries.sort()
+    total = sum(size for mtime, size, entry_dir in entries)
+    for mtime, size, entry_dir in entries:
+      if total <= self.max_bytes:
+        break
+      shutil.rmtree(entry_dir, ignore_errors=True)
+      total -= size
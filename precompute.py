@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Headless batch precompute of pyball meshes.
+
+Runs RenderedSoup and the mesh builders of meshbuild over PDB files
+in a pool of worker processes, without importing vispy or OpenGL, and
+writes the meshes and picking tables of every structure to a
+compressed .npz file, or with --pyb to a memory-mappable struct
+file that pyball.py opens directly. Failures are reported per file
+and do not stop the batch.
+
+    python precompute.py -o meshes -j 8 pdb_dir more.pdb ...
+"""
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+
+import numpy as np
+
+import meshbuild
+
+
+pdb_exts = ['.pdb', '.ent']
+
+
+def find_pdbs(paths):
+  pdbs = []
+  for path in paths:
+    if os.path.isdir(path):
+      for base in sorted(os.listdir(path)):
+        if os.path.splitext(base)[1].lower() in pdb_exts:
+          pdbs.append(os.path.join(path, base))
+    else:
+      pdbs.append(path)
+  return pdbs
+
+
+def get_mesh_fname(out_dir, pdb, ext='.npz'):
+  base = os.path.splitext(os.path.basename(pdb))[0]
+  return os.path.join(out_dir, base + ext)
+
+
+def check_mesh_fnames(pdbs, mesh_fnames):
+  """
+  Raises ValueError if two different PDB files would be written to
+  the same mesh file, such as 1abc.pdb in two directories, or
+  1abc.pdb and 1abc.ent in one.
+  """
+  pdb_by_fname = {}
+  clashes = []
+  for pdb, mesh_fname in zip(pdbs, mesh_fnames):
+    other = pdb_by_fname.setdefault(mesh_fname, pdb)
+    if other != pdb:
+      clashes.append("%s and %s -> %s" % (other, pdb, mesh_fname))
+  if clashes:
+    raise ValueError(
+        "Several files map to one mesh file:\n  " + "\n  ".join(clashes))
+
+
+def save_meshes(fname, meshes, tables, info):
+  arrays = meshbuild.meshes_to_arrays(meshes, tables)
+  arrays['info'] = np.array(json.dumps(info))
+  tmp_fname = fname + '.tmp.npz'
+  np.savez_compressed(tmp_fname, **arrays)
+  os.rename(tmp_fname, fname)
+
+
+def load_mesh_file(fname):
+  """
+  Returns (meshes, tables, info) from a file written by save_meshes.
+  """
+  arrays = dict(np.load(fname).items())
+  info = json.loads(str(arrays.pop('info')))
+  meshes, tables = meshbuild.arrays_to_meshes(arrays)
+  return meshes, tables, info
+
+
+def silence_worker():
+  sys.stdout = open(os.devnull, 'w')
+
+
+def precompute(job):
+  pdb, mesh_fname, hbond_mode, is_pyb = job
+  result = {
+    'pdb': pdb,
+    'mesh_fname': mesh_fname,
+    'error': None,
+  }
+  start = time.time()
+  try:
+    if is_pyb:
+      result.update(meshbuild.convert_pdb(
+          pdb, mesh_fname, hbond_mode=hbond_mode))
+    else:
+      meshes, tables, info = meshbuild.load_meshes(pdb, hbond_mode=hbond_mode)
+      save_meshes(mesh_fname, meshes, tables, info)
+      result.update(meshbuild.get_mesh_counts(meshes, tables))
+    result['n_byte'] = os.path.getsize(mesh_fname)
+  except Exception:
+    result['error'] = traceback.format_exc()
+  result['time'] = time.time() - start
+  return result
+
+
+def run_batch(
+    pdbs, out_dir, n_worker=None, is_skip_existing=False,
+    hbond_mode='distance', is_pyb=False):
+  # the same file given twice is only built once
+  seen = set()
+  unique_pdbs = []
+  for pdb in pdbs:
+    if os.path.realpath(pdb) not in seen:
+      seen.add(os.path.realpath(pdb))
+      unique_pdbs.append(pdb)
+  pdbs = unique_pdbs
+  mesh_fnames = [
+      get_mesh_fname(out_dir, pdb, '.pyb' if is_pyb else '.npz')
+      for pdb in pdbs]
+  check_mesh_fnames(pdbs, mesh_fnames)
+  if not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+  jobs = []
+  for pdb, mesh_fname in zip(pdbs, mesh_fnames):
+    if is_skip_existing and os.path.isfile(mesh_fname):
+      continue
+    jobs.append((pdb, mesh_fname, hbond_mode, is_pyb))
+
+  results = []
+  start = time.time()
+  pool = multiprocessing.Pool(n_worker, initializer=silence_worker)
+  try:
+    for result in pool.imap_unordered(precompute, jobs):
+      results.append(result)
+      if result['error']:
+        print "FAIL %7.2fs %s" % (result['time'], result['pdb'])
+        print result['error']
+      else:
+        print "ok   %7.2fs %s: %d atoms, %d vertices, %d indices, %d bytes" % (
+            result['time'], result['pdb'], result['n_atom'],
+            result['n_vertex'], result['n_index'], result['n_byte'])
+  finally:
+    pool.close()
+    pool.join()
+  wall_time = time.time() - start
+
+  done = [r for r in results if not r['error']]
+  n_atom = sum(r['n_atom'] for r in done)
+  cpu_time = sum(r['time'] for r in results)
+  print "%d files, %d ok, %d failed, %d skipped" % (
+      len(pdbs), len(done), len(results) - len(done), len(pdbs) - len(jobs))
+  if wall_time > 0:
+    print "%.2fs wall, %.2fs in workers, %.2f files/s, %.0f atoms/s" % (
+        wall_time, cpu_time, len(results)/wall_time, n_atom/wall_time)
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Precompute pyball meshes without a window')
+  parser.add_argument('paths', nargs='+', help='PDB files or directories')
+  parser.add_argument(
+      '-o', '--out-dir', default='meshes', help='output directory [meshes]')
+  parser.add_argument(
+      '-j', '--workers', type=int, default=None,
+      help='worker processes [number of cores]')
+  parser.add_argument(
+      '--skip-existing', action='store_true',
+      help='skip files whose mesh file already exists')
+  parser.add_argument(
+      '--dssp', action='store_true',
+      help='find H-bonds by DSSP electrostatic energy, not N-O distance')
+  parser.add_argument(
+      '--pyb', action='store_true',
+      help='write memory-mappable .pyb struct files instead of .npz')
+  args = parser.parse_args()
+  try:
+    results = run_batch(
+        find_pdbs(args.paths), args.out_dir, args.workers, args.skip_existing,
+        'dssp' if args.dssp else 'distance', args.pyb)
+  except ValueError as e:
+    parser.error(str(e))
+  if any(r['error'] for r in results):
+    sys.exit(1)
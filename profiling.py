@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timing of the phases of loading and drawing a structure.
+
+Named spans time a block of code, and counts (atoms, bonds,
+vertices, bytes...) are attached to the span they were taken in
+and summed over the run:
+
+    with profiling.span('find_bonds') as span:
+      bonds = ...
+      span.count('bonds', len(bonds))
+
+Profiling is off until enable is called, and while it is off span
+returns one shared do-nothing span, so instrumented code costs a
+function call and a global lookup per span. Spans are recorded from
+any thread, and are written out as JSON with write_json, or in the
+Chrome trace event format, for chrome://tracing or Perfetto, with
+write_chrome_trace.
+
+Every span goes into the per-name totals of get_summary, but only
+the last max_events_per_name spans of each name are kept as events,
+so that spans taken every frame, such as draw, use bounded memory
+in a long session while one-off loading spans are never dropped.
+"""
+
+
+import os
+import json
+import time
+import threading
+import collections
+
+
+max_events_per_name = 1000
+
+is_enabled = False
+spans = {}
+totals = {}
+counts = {}
+lock = threading.Lock()
+start_time = time.time()
+
+
+def enable():
+  global is_enabled
+  is_enabled = True
+
+
+def disable():
+  global is_enabled
+  is_enabled = False
+
+
+def reset():
+  global start_time
+  with lock:
+    spans.clear()
+    totals.clear()
+    counts.clear()
+  start_time = time.time()
+
+
+class Span(object):
+  def __init__(self, name, args):
+    self.name = name
+    self.args = args
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    end = time.time()
+    with lock:
+      if self.name not in spans:
+        spans[self.name] = collections.deque(maxlen=max_events_per_name)
+        totals[self.name] = {'n': 0, 'total': 0.0, 'max': 0.0}
+      spans[self.name].append({
+        'name': self.name,
+        'thread': threading.current_thread().name,
+        'tid': threading.current_thread().ident,
+        'start': self.start - start_time,
+        'time': end - self.start,
+        'args': self.args,
+      })
+      entry = totals[self.name]
+      entry['n'] += 1
+      entry['total'] += end - self.start
+      entry['max'] = max(entry['max'], end - self.start)
+    return False
+
+  def count(self, name, value):
+    self.args[name] = self.args.get(name, 0) + value
+    with lock:
+      counts[name] = counts.get(name, 0) + value
+
+
+class NullSpan(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    return False
+
+  def count(self, name, value):
+    pass
+
+
+null_span = NullSpan()
+
+
+def span(name, **args):
+  """
+  Returns a context manager that records the time of its block as
+  the span name, with args as extra fields, if profiling is on.
+  """
+  if not is_enabled:
+    return null_span
+  return Span(name, args)
+
+
+def get_summary():
+  """
+  Returns {name: {'n', 'total', 'mean', 'max', 'n_event'}} of all
+  the spans so far, with times in seconds, where n_event of the n
+  spans are still kept as events.
+  """
+  summary = {}
+  with lock:
+    for name, entry in totals.items():
+      summary[name] = dict(
+          entry, mean=entry['total']/entry['n'], n_event=len(spans[name]))
+  return summary
+
+
+def get_events():
+  """
+  Returns the kept spans of all names, in order of their start.
+  """
+  with lock:
+    events = [s for events in spans.values() for s in events]
+  return sorted(events, key=lambda s: s['start'])
+
+
+def print_summary():
+  summary = get_summary()
+  print "%-28s %6s %10s %10s %10s" % ('span', 'n', 'total', 'mean', 'max')
+  for name in sorted(summary, key=lambda n: -summary[n]['total']):
+    entry = summary[name]
+    print "%-28s %6d %9.4fs %9.4fs %9.4fs" % (
+        name, entry['n'], entry['total'], entry['mean'], entry['max'])
+  for name in sorted(counts):
+    print "%-28s %d" % (name, counts[name])
+
+
+def write_json(fname):
+  data = {
+    'spans': get_events(),
+    'summary': get_summary(),
+  }
+  with lock:
+    data['counts'] = dict(counts)
+  with open(fname, 'w') as f:
+    json.dump(data, f, indent=2, sort_keys=True)
+
+
+def write_chrome_trace(fname):
+  """
+  Writes the spans as complete ('X') events and the counts as a
+  counter ('C') event at the end, with times in microseconds.
+  """
+  pid = os.getpid()
+  events = []
+  end = 0.0
+  thread_names = {}
+  for s in get_events():
+    thread_names[s['tid']] = s['thread']
+    events.append({
+      'name': s['name'],
+      'ph': 'X',
+      'ts': 1e6*s['start'],
+      'dur': 1e6*s['time'],
+      'pid': pid,
+      'tid': s['tid'],
+      'args': s['args'],
+    })
+    end = max(end, s['start'] + s['time'])
+  for tid, thread in thread_names.items():
+    events.append({
+      'name': 'thread_name',
+      'ph': 'M',
+      'pid': pid,
+      'tid': tid,
+      'args': {'name': thread},
+    })
+  with lock:
+    if counts:
+      events.append({
+        'name': 'counts',
+        'ph': 'C',
+        'ts': 1e6*end,
+        'pid': pid,
+        'args': dict(counts),
+      })
+  with open(fname, 'w') as f:
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -11,353 +11,23 @@ from vispy.scene.visuals import Text
 from pprint import pprint
 import math
 import sys
+import time
+import argparse
+import multiprocessing
 
 import numpy as np
 import numpy.linalg as linalg
-import itertools
 
-import render
-from spacehash import SpaceHash
+import trajectory
+import profiling
+from meshcache import MeshCache
+from meshbuild import (
+    mesh_builder_version, get_mesh_n_byte, open_structure, MeshLoader,
+    ray_pick_radii, RayPicker, pick_by_ray)
 
 import OpenGL.GL as gl
 
-from ctypes import c_float
-
-from pdbremix import pdbatoms
-from pdbremix import v3numpy as v3
-from pdbremix.data import backbone_atoms
-
-
-#########################################################
-# Convert PDB structure into smooth pieces of secondary 
-# structure and geometrial objects that use
-# render functions to turn into polygon
-
-
-class Trace:
-  def __init__(self, n=None):
-    if n is not None:
-      self.points = np.zeros((n,3), dtype=np.float32)
-      self.ups = np.zeros((n,3), dtype=np.float32)
-      self.tangents = np.zeros((n,3), dtype=np.float32)
-      self.objids = np.zeros(n, dtype=np.float32)
-      self.residues = [None for i in xrange(n)]
-
-  def get_prev_point(self, i):
-    if i > 0:
-      return self.points[i-1]
-    else:
-      return self.points[i] - self.tangents[i]
-
-  def get_next_point(self, i):
-    if i < len(self.points)-1:
-      return self.points[i+1]
-    else:
-      return self.points[i] + self.tangents[i]
-
-  def get_prev_up(self, i):
-    if i > 0:
-      return self.ups[i-1]
-    else:
-      return self.ups[i]
-
-  def get_next_up(self, i):
-    if i < len(self.points)-1:
-      return self.ups[i+1]
-    else:
-      return self.ups[i]
-
-
-class SubTrace(Trace):
-  def __init__(self, trace, i, j):
-    self.points = trace.points[i:j]
-    self.ups = trace.ups[i:j]
-    self.tangents = trace.tangents[i:j]
-    self.objids = trace.objids[i:j]
-    self.residues = trace.residues[i:j]
-
-
-def catmull_rom_spline(t, p1, p2, p3, p4):
-  """
-  Returns a point at fraction t between p2 and p3.
-  """
-  return \
-      0.5 * (   t*((2-t)*t    - 1)  * p1
-              + (t*t*(3*t - 5) + 2) * p2
-              + t*((4 - 3*t)*t + 1) * p3
-              + (t-1)*t*t           * p4 )
-
-
-class SplineTrace(Trace):
-  """
-  SplineTrace expands the points in a Trace using
-  a spline interpolation.
-  """
-  def __init__(self, trace, n_division):
-    Trace.__init__(self, n_division*(len(trace.points)-1) + 1)
-
-    delta = 1/float(n_division)
-
-    offset = 0
-    n_trace_point = len(trace.points)
-    for i in range(n_trace_point - 1):
-      n = n_division
-      j = i+1
-      # last division includes the very last trace point
-      if j == n_trace_point - 1:
-        n += 1
-      for k in range(n):
-        l = offset + k
-        self.points[l,:] = catmull_rom_spline(
-            k*delta, 
-            trace.get_prev_point(i), 
-            trace.points[i],
-            trace.points[j], 
-            trace.get_next_point(j))
-        self.ups[l,:] = catmull_rom_spline(
-             k*delta, 
-             trace.get_prev_up(i), 
-             trace.ups[i], 
-             trace.ups[j], 
-             trace.get_next_up(j))
-        if k/float(n) < 0.5:
-          self.objids[l] = trace.objids[i]
-        else:
-          self.objids[l] = trace.objids[i+1]
-      offset += n
-
-    n_point = len(self.points)
-    for i in range(n_point):
-      if i == 0:
-        tangent = trace.tangents[0]
-      elif i == n_point-1:
-        tangent = trace.tangents[-1]
-      else:
-        tangent = self.points[i+1] - self.points[i-1]
-      self.tangents[i,:] = tangent
-
-
-class Bond():
-  def __init__(self, atom1, atom2):
-    self.atom1 = atom1
-    self.atom2 = atom2
-
-
-class RenderedSoup():
-  def __init__(self, soup):
-    self.soup = soup
-
-    self.atom_by_objid = {}
-    self.build_objids()
-
-    self.build_trace()
-
-    self.bonds = []
-    self.find_bonds()
-
-    self.pieces = []
-    self.find_pieces()
-
-    # self.find_ss_by_zhang_skolnick()
-    self.find_bb_hbonds()
-    self.find_ss_by_bb_hbonds()
-
-  def build_objids(self):
-    for i_atom, atom in enumerate(self.soup.atoms()):
-      self.atom_by_objid[i_atom] = atom
-      atom.objid = i_atom
-
-  def build_trace(self):
-    trace_residues = []
-    for residue in self.soup.residues():
-      residue.ss = '-'
-      residue.color = [0.4, 1.0, 0.4]
-      if residue.has_atom('CA') and residue.has_atom('C') and residue.has_atom('O'):
-        ca = residue.atom('CA')
-        trace_residues.append(residue)
-        res_objid = ca.objid
-      else:
-        res_objid = residue.atoms()[0].objid
-      residue.objid = res_objid
-      for atom in residue.atoms():
-        atom.residue = residue
-
-    self.trace = Trace(len(trace_residues))
-    for i, residue in enumerate(trace_residues):
-      ca = residue.atom('CA')
-      c = residue.atom('C')
-      o = residue.atom('O')
-      residue.i = i
-      self.trace.residues[i] = residue
-      self.trace.objids[i] = residue.objid
-      self.trace.points[i] = ca.pos
-      self.trace.ups[i] = c.pos - o.pos
-
-    # remove alternate conformation by looking for orphaned atoms
-    atoms = self.soup.atoms()
-    n = len(atoms)
-    for i in reversed(range(n)):
-      atom = atoms[i]
-      if not hasattr(atom, 'residue'):
-        del atoms[i]
-
-    # make ups point in the same direction
-    for i in range(1, len(self.trace.points)):
-      if v3.dot(self.trace.ups[i-1], self.trace.ups[i]) < 0:
-         self.trace.ups[i] = -self.trace.ups[i]
-
-    # find geometrical center of points
-    self.center = v3.get_center(self.trace.points)
-    centered_points = [p - self.center for p in self.trace.points]
-
-    self.scale = 1.0/max(map(max, centered_points))
-
-  def find_bb_hbonds(self):
-    print "Find H-Bonds..."
-    vertices = []
-    atoms = []
-    for residue in self.trace.residues:
-      if residue.has_atom('O'):
-        atom = residue.atom('O')  
-        atoms.append(atom)
-        vertices.append(atom.pos)
-      if residue.has_atom('N'):
-        atom = residue.atom('N')  
-        atoms.append(atom)
-        vertices.append(atom.pos)
-      residue.hb_partners = []
-    d = 3.5
-    for i, j in SpaceHash(vertices).close_pairs():
-      atom1 = atoms[i]
-      atom2 = atoms[j]
-      if atom1.type == atom2.type:
-        continue
-      if v3.distance(atom1.pos, atom2.pos) < d:
-        res1 = atom1.residue
-        res2 = atom2.residue
-        res1.hb_partners.append(res2.i)
-        res2.hb_partners.append(res1.i)
-
-  def find_ss_by_bb_hbonds(self):
-
-    def is_hb(i_res, j_res):
-      if not (0 <= i_res <= len(self.trace.residues) - 1):
-        return False
-      return j_res in self.trace.residues[i_res].hb_partners
-
-    print "Find Secondary Structure..."
-    for res in self.trace.residues:
-      res.ss = 'C'
-
-    n_res = len(self.trace.residues)
-    for i_res1 in range(n_res):
-
-      # alpha-helix
-      if is_hb(i_res1, i_res1+4) and is_hb(i_res1+1, i_res1+5):
-        for i_res in range(i_res1+1, i_res1+5):
-          self.trace.residues[i_res].ss = 'H'
-
-      # 3-10 helix
-      if is_hb(i_res1, i_res1+3) and is_hb(i_res1+1, i_res1+4):
-        for i_res in range(i_res1+1, i_res1+4):
-          self.trace.residues[i_res].ss = 'H'
-
-      for i_res2 in range(n_res):
-        if abs(i_res1-i_res2) > 5:
-          if is_hb(i_res1, i_res2):
-            beta_residues = []
-
-            # parallel beta sheet pairs
-            if is_hb(i_res1-2, i_res2-2):
-              beta_residues.extend(
-                  [i_res1-2, i_res1-1, i_res1, i_res2-2, i_res2-1, i_res2])
-            if is_hb(i_res1+2, i_res2+2):
-              beta_residues.extend(
-                  [i_res1+2, i_res1+1, i_res1, i_res2+2, i_res2+1, i_res2])
-
-            # anti-parallel beta sheet pairs
-            if is_hb(i_res1-2, i_res2+2):
-              beta_residues.extend(
-                  [i_res1-2, i_res1-1, i_res1, i_res2+2, i_res2+1, i_res2])
-            if is_hb(i_res1+2, i_res2-2):
-              beta_residues.extend(
-                  [i_res1+2, i_res1+1, i_res1, i_res2-2, i_res2-1, i_res2])
-
-            for i_res in beta_residues:
-              self.trace.residues[i_res].ss = 'E' 
-
-    color_by_ss = {
-      '-': (0.5, 0.5, 0.5),
-      'C': (0.5, 0.5, 0.5),
-      'H': (0.8, 0.4, 0.4),
-      'E': (0.4, 0.4, 0.8)
-    }
-    for residue in self.trace.residues:
-      residue.color = color_by_ss[residue.ss]
-
-  def find_pieces(self, cutoff=5.5):
-
-    self.pieces = []
-
-    i = 0
-    n_point = len(self.trace.points)
-
-    for j in range(1, n_point+1):
-      is_new_piece = False
-      if j == n_point:
-        is_new_piece = True
-      else:
-        dist = v3.distance(self.trace.points[j-1], self.trace.points[j]) 
-        if dist > cutoff:
-          is_new_piece = True
-
-      if is_new_piece:
-        for k in range(i, j):
-          if k == i:
-            tangent = self.trace.points[i+1] - self.trace.points[i]
-          elif k == j-1:
-            tangent = self.trace.points[k] - self.trace.points[k-1]
-          else:
-            tangent = self.trace.points[k+1] - self.trace.points[k-1]
-          self.trace.tangents[k] = v3.norm(tangent)
-
-        ups = []
-        # smooth then rotate
-        for k in range(i, j):
-          up = self.trace.ups[k]
-          if k > i:
-            up = up + self.trace.ups[k-1]
-          elif k < j-1:
-            up = up + self.trace.ups[k+1]
-          ups.append(v3.norm(v3.perpendicular(up, self.trace.tangents[k])))
-        self.trace.ups[i:j] = ups
-
-        self.pieces.append(SubTrace(self.trace, i, j))
-
-        i = j
-
-  def find_bonds(self):
-    self.draw_to_screen_atoms = self.soup.atoms()
-    backbone_atoms.remove('CA')
-    self.draw_to_screen_atoms = [a for a in self.draw_to_screen_atoms if a.type not in backbone_atoms and a.element!="H"]
-    vertices = [a.pos for a in self.draw_to_screen_atoms]
-    self.bonds = []
-    print "Finding bonds..."
-    for i, j in SpaceHash(vertices).close_pairs():
-      atom1 = self.draw_to_screen_atoms[i]
-      atom2 = self.draw_to_screen_atoms[j]
-      d = 2
-      if atom1.element == 'H' or atom2.element == 'H':
-        continue
-      if v3.distance(atom1.pos, atom2.pos) < d:
-        if atom1.alt_conform != " " and atom2.alt_conform != " ":
-          if atom1.alt_conform != atom2.alt_conform:
-            continue
-        bond = Bond(atom1, atom2)
-        bond.tangent = atom2.pos - atom1.pos
-        bond.up = v3.cross(atom1.pos, bond.tangent)
-        self.bonds.append(bond)
-
+from ctypes import c_void_p, memmove
 
 
 def identity():
@@ -414,210 +84,21 @@ class Camera():
     self.recalc_model()
 
 
-
-class TriangleStore:
-  def __init__(self, n_vertex):
-    self.data = np.zeros(
-      n_vertex, 
-      [('a_position', np.float32, 3),
-       ('a_normal', np.float32, 3),
-       ('a_color', np.float32, 3),
-       ('a_objid', np.float32, 1)])
-    self.i_vertex = 0
-    self.n_vertex = n_vertex
-    self.indices = []
-
-  def add_vertex(self, vertex, normal, color, objid):
-    self.data['a_position'][self.i_vertex,:] = vertex
-    self.data['a_normal'][self.i_vertex,:] = normal
-    self.data['a_color'][self.i_vertex,:] = color
-    self.data['a_objid'][self.i_vertex] = objid
-    self.i_vertex += 1
-
-  def vertex_buffer(self):
-    return gloo.VertexBuffer(self.data) 
-  
-  def index_buffer(self):
-    return gloo.IndexBuffer(self.indices) 
-
-  def setup_next_strip(self, indices):
-    """
-    Add triangular indices relative to self.i_vertex_in_buffer
-    """
-    indices = [i + self.i_vertex for i in indices]
-    self.indices.extend(indices)
-
-
-def group(lst, n):
-    """
-    Returns iterable of n-tuple from a list.Incomplete tuples discarded 
-    http://code.activestate.com/recipes/303060-group-a-list-into-sequential-n-tuples/
-    >>> list(group(range(10), 3))
-        [(0, 1, 2), (3, 4, 5), (6, 7, 8)]
-    """
-    return itertools.izip(*[itertools.islice(lst, i, None, n) for i in range(n)])
-
-
-
-def make_calpha_arrow_mesh(
-    trace, length=0.7, width=0.35, thickness=0.3):
-  arrow = render.Arrow(length, width, thickness)
-
-  n_point = len(trace.points)
-  triangle_store = TriangleStore(n_point*len(arrow.indices))
-
-  for i_point in range(n_point):
-
-    orientate = arrow.get_orientate(
-        trace.tangents[i_point], trace.ups[i_point], 1.0)
-
-    for indices in group(arrow.indices, 3):
-
-      points = [arrow.vertices[i] for i in indices]
-
-      normal = v3.cross(points[1] - points[0], points[0] - points[2])
-      normal = v3.transform(orientate, normal)
-
-      for point in points:
-        triangle_store.add_vertex(
-          v3.transform(orientate, point) + trace.points[i_point],
-          normal, 
-          trace.residues[i_point].color, 
-          trace.objids[i_point])
-
-  return triangle_store.vertex_buffer()
-
-
-
-def make_cylinder_trace_mesh(pieces, coil_detail=4, radius=0.3):
-  cylinder = render.Cylinder(coil_detail)
-
-  n_point = sum(len(piece.points) for piece in pieces)
-  triangle_store = TriangleStore(2 * n_point * cylinder.n_vertex)
-
-  for piece in pieces:
-    points = piece.points
-
-    for i_point in xrange(len(points) - 1):
-
-      tangent = 0.5*(points[i_point+1] - points[i_point])
-
-      up = piece.ups[i_point] + piece.ups[i_point+1]
-
-      orientate = cylinder.get_orientate(tangent, up, radius)
-      triangle_store.setup_next_strip(cylinder.indices)
-      for point, normal in zip(cylinder.points, cylinder.normals):
-        triangle_store.add_vertex(
-            v3.transform(orientate, point) + points[i_point],
-            v3.transform(orientate, normal), 
-            piece.residues[i_point].color, 
-            piece.objids[i_point])
-
-      orientate = cylinder.get_orientate(-tangent, up, radius)
-      triangle_store.setup_next_strip(cylinder.indices)
-      for point, normal in zip(cylinder.points, cylinder.normals):
-        triangle_store.add_vertex(
-            v3.transform(orientate, point) + points[i_point+1],
-            v3.transform(orientate, normal), 
-            piece.residues[i_point+1].color, 
-            piece.objids[i_point+1])
-
-  return triangle_store.index_buffer(), triangle_store.vertex_buffer()
-
-
-def make_carton_mesh(
-    pieces, coil_detail=5, spline_detail=3, 
-    width=1.6, thickness=0.2):
-
-  rect = render.RectProfile(width, 0.15)
-  circle = render.CircleProfile(coil_detail, 0.3)
-
-  builders = []
-  for piece in pieces:
-    spline = SplineTrace(piece, 2*spline_detail)
-
-    n_point = len(piece.points)
-
-    i_point = 0
-    j_point = 1
-    while i_point < n_point:
-
-      ss = piece.residues[i_point].ss
-      color = piece.residues[i_point].color
-      color = [min(1.0, 1.2*c) for c in color]
-      profile = circle if ss == "C" else rect  
-
-      while j_point < n_point and piece.residues[j_point].ss == ss:
-        j_point += 1
-
-      i_spline = 2*i_point*spline_detail - spline_detail
-      if i_spline < 0:
-        i_spline = 0
-      j_spline = (j_point-1) * 2*spline_detail + spline_detail + 1
-      if j_spline > len(spline.points) - 1:
-        j_spline = len(spline.points) - 1
-
-      sub_spline = SubTrace(spline, i_spline, j_spline)
-
-      builders.append(render.TubeBuilder(sub_spline, profile, color))
-
-      i_point = j_point
-      j_point = i_point + 1
-
-  n_vertex = sum(r.n_vertex for r in builders)
-  triangle_store = TriangleStore(n_vertex)
-
-  for r in builders:
-      r.build_triangles(triangle_store)
-
-  return triangle_store.index_buffer(), triangle_store.vertex_buffer()
-
-
-
-def make_ball_and_stick_mesh(
-    rendered_soup, sphere_stack=5, sphere_arc=5, 
-    tube_arc=5, radius=0.2):
-
-  sphere = render.Sphere(sphere_stack, sphere_arc)
-  cylinder = render.Cylinder(4)
-
-  n_vertex = len(rendered_soup.draw_to_screen_atoms)*sphere.n_vertex
-  n_vertex += 2*len(rendered_soup.bonds)*cylinder.n_vertex
-  triangle_store = TriangleStore(n_vertex)
-
-  for atom in rendered_soup.draw_to_screen_atoms:
-    triangle_store.setup_next_strip(sphere.indices)
-    orientate = sphere.get_orientate(radius)
-    for point in sphere.points:
-      triangle_store.add_vertex(
-          v3.transform(orientate, point) + atom.pos,
-          point, # same as normal!
-          atom.residue.color, 
-          atom.objid)
-
-  for bond in rendered_soup.bonds:
-    tangent = 0.5*bond.tangent
-
-    orientate = cylinder.get_orientate(tangent, bond.up, radius)
-    triangle_store.setup_next_strip(cylinder.indices)
-    for point, normal in zip(cylinder.points, cylinder.normals):
-      triangle_store.add_vertex(
-          v3.transform(orientate, point) + bond.atom1.pos,
-          v3.transform(orientate, normal), 
-          bond.atom1.residue.color, 
-          bond.atom1.objid)
-
-    orientate = cylinder.get_orientate(-tangent, bond.up, radius)
-    triangle_store.setup_next_strip(cylinder.indices)
-    for point, normal in zip(cylinder.points, cylinder.normals):
-      triangle_store.add_vertex(
-          v3.transform(orientate, point) + bond.atom2.pos,
-          v3.transform(orientate, normal), 
-          bond.atom2.residue.color, 
-          bond.atom2.objid)
-
-  return triangle_store.index_buffer(), triangle_store.vertex_buffer()
-
+def get_mouse_ray(camera, x, y):
+  """
+  Returns (origin, direction) in model space of the ray through the
+  window pixel x, y, from the near to the far clipping plane, by 
+  inverting the model, view and projection of camera.
+  """
+  transform = np.dot(np.dot(camera.model, camera.view), camera.projection)
+  x_ndc = 2.0*x/camera.width - 1.0
+  y_ndc = 1.0 - 2.0*y/camera.height
+  points = np.dot(
+      [[x_ndc, y_ndc, -1.0, 1.0], [x_ndc, y_ndc, 1.0, 1.0]],
+      linalg.inv(transform))
+  points = points[:,:3]/points[:,3:]
+  direction = points[1] - points[0]
+  return points[0], direction/np.sqrt((direction*direction).sum())
 
 
 semilight_vertex = """
@@ -629,7 +110,7 @@ uniform mat4 u_projection;
 attribute vec3  a_position;
 attribute vec3  a_normal;
 attribute vec3  a_color;
-attribute float a_objid;
+attribute vec2  a_objid;
 
 varying vec4 N;
 
@@ -691,9 +172,9 @@ uniform mat4 u_projection;
 attribute vec3 a_position;
 attribute vec3 a_normal;
 attribute vec3 a_color;
-attribute float a_objid;
+attribute vec2 a_objid;
 
-varying float objid;
+varying vec2 objid;
 
 void main(void) {
   gl_Position = u_projection * u_view * u_model * vec4(a_position, 1.0);
@@ -705,27 +186,123 @@ void main(void) {
 
 picking_fragment = """
 
-varying float objid;
-
-int int_mod(int x, int y) { 
-  int z = x / y;
-  return x - y*z;
-}
+varying vec2 objid;
 
 void main(void) {
-  // ints are only required to be 7bit...
-  int int_objid = int(objid + 0.5);
-  int red = int_mod(int_objid, 256);
-  int_objid /= 256;
-  int green = int_mod(int_objid, 256);
-  int_objid /= 256;
-  int blue = int_mod(int_objid, 256);
-  gl_FragColor = vec4(float(red), float(green), float(blue), 255.0)/255.0;
+  // floats, as ints are only required to be 7bit..., with the low 
+  // and high byte of each 16-bit half in (r, g) and (b, a)
+  vec2 halves = floor(objid + 0.5);
+  vec2 highs = floor(halves/256.0);
+  vec2 lows = halves - 256.0*highs;
+  gl_FragColor = vec4(lows.x, highs.x, lows.y, highs.y)/255.0;
 }
 
 """
 
 
+class PickBuffer():
+  """
+  Offscreen framebuffer that the objids are drawn into, kept from 
+  draw to draw, and a pixel buffer object that the whole image is
+  read back into without stalling: start_read only queues the copy
+  and finish_read, a tick later, maps the buffer once the GPU is 
+  done. Lookups come from the last image read, which holds objid+1
+  of every pixel as a 32-bit int, 0 for the background.
+  """
+  def __init__(self):
+    self.width = 0
+    self.height = 0
+    self.framebuffer = None
+    self.fence = None
+    self.is_reading = False
+    self.image = np.zeros((0, 0), dtype='<u4')
+
+  def resize(self, width, height):
+    if (width, height) == (self.width, self.height):
+      return
+    self.delete()
+    self.width, self.height = width, height
+    self.framebuffer = gl.glGenFramebuffers(1)
+    self.renderbuffers = gl.glGenRenderbuffers(2)
+    gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.framebuffer)
+    for renderbuffer, storage, attachment in zip(
+        self.renderbuffers, 
+        [gl.GL_RGBA8, gl.GL_DEPTH_COMPONENT24],
+        [gl.GL_COLOR_ATTACHMENT0, gl.GL_DEPTH_ATTACHMENT]):
+      gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, renderbuffer)
+      gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, storage, width, height)
+      gl.glFramebufferRenderbuffer(
+          gl.GL_FRAMEBUFFER, attachment, gl.GL_RENDERBUFFER, renderbuffer)
+    gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, 0)
+    gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+    self.pixel_buffer = gl.glGenBuffers(1)
+    gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pixel_buffer)
+    gl.glBufferData(
+        gl.GL_PIXEL_PACK_BUFFER, 4*width*height, None, gl.GL_STREAM_READ)
+    gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+    self.image = np.zeros((height, width), dtype='<u4')
+
+  def delete(self):
+    if self.framebuffer is None:
+      return
+    if self.is_reading:
+      gl.glDeleteSync(self.fence)
+      self.is_reading = False
+    gl.glDeleteFramebuffers(1, [self.framebuffer])
+    gl.glDeleteRenderbuffers(2, self.renderbuffers)
+    gl.glDeleteBuffers(1, [self.pixel_buffer])
+    self.framebuffer = None
+
+  def bind(self):
+    gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.framebuffer)
+
+  def unbind(self):
+    gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+
+  def start_read(self):
+    gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.framebuffer)
+    gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pixel_buffer)
+    gl.glReadPixels(
+        0, 0, self.width, self.height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+        c_void_p(0))
+    gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+    gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, 0)
+    self.fence = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+    self.is_reading = True
+
+  def finish_read(self, is_wait=True):
+    """
+    Copies the image out of the pixel buffer, returning False if 
+    the GPU is not done with it and is_wait is False.
+    """
+    if not self.is_reading:
+      return True
+    if not is_wait:
+      status = gl.glClientWaitSync(
+          self.fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, 0)
+      if status == gl.GL_TIMEOUT_EXPIRED:
+        return False
+    with profiling.span('pick_read') as span:
+      gl.glDeleteSync(self.fence)
+      gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pixel_buffer)
+      pointer = gl.glMapBuffer(gl.GL_PIXEL_PACK_BUFFER, gl.GL_READ_ONLY)
+      memmove(self.image.ctypes.data, pointer, self.image.nbytes)
+      gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+      gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+      span.count('pick_read_bytes', self.image.nbytes)
+    self.is_reading = False
+    return True
+
+  def lookup(self, x, y):
+    """
+    Returns the objid at window pixel x, y, or -1.
+    """
+    row = self.height - 1 - y # screen and OpenGL y coord flipped
+    if 0 <= x < self.width and 0 <= row < self.height:
+      return int(self.image[row, x]) - 1
+    return -1
+
+
 def get_polar(x, y):
   r = math.sqrt(x*x + y*y)
   if x != 0.0:
@@ -768,7 +345,10 @@ class Console():
 
 class MolecularViewerCanvas(app.Canvas):
 
-    def __init__(self, fname):
+    def __init__(
+        self, fname, cache=None, hbond_mode='distance', traj=None,
+        stride=1, fps=None, pool=None, draw_style='sidechains',
+        max_bytes=None, max_fps=None, pick_mode='gl', is_update_ss=False):
       app.Canvas.__init__(
           self, title='Molecular viewer')
 
@@ -782,38 +362,64 @@ class MolecularViewerCanvas(app.Canvas):
       self.program = gloo.Program(semilight_vertex, semilight_fragment)
       self.picking_program = gloo.Program(picking_vertex, picking_fragment)
 
-      soup = pdbatoms.Soup(fname)
-
-      rendered_soup = RenderedSoup(soup)
-      self.rendered_soup = rendered_soup
-
-      print "Building arrows..."
-      self.arrow_buffer = make_calpha_arrow_mesh(rendered_soup.trace)
-
-      print "Building cylindrical trace..."
-      self.cylinder_index_buffer, self.cylinder_vertex_buffer = \
-          make_cylinder_trace_mesh(rendered_soup.pieces)
-
-      print "Building cartoon..."
-      self.cartoon_index_buffer, self.cartoon_vertex_buffer = \
-          make_carton_mesh(rendered_soup.pieces)
-
-      print "Building ball&sticks..."
-      self.ballstick_index_buffer, self.ballstick_vertex_buffer = \
-          make_ball_and_stick_mesh(rendered_soup)
-
-      self.draw_style = 'sidechains'
+      # filled in by set_structure once the loader has read fname
+      self.meshes = None
+      self.player = None
+      self.prefetcher = None
+      self.stride = stride
+      self.fps = fps
+      self.atom_positions = np.zeros((0, 3), dtype=np.float32)
+      self.atom_labels = []
+      self.trace_objids = np.zeros(0, dtype=np.int32)
+      self.draw_objids = np.zeros(0, dtype=np.int32)
+      self.scale = 1.0
+      self.is_playing = False
+      # the last frame sent back by the loader, which moves the
+      # player, and the frame that the buffers of each mesh are in
+      self.i_frame = -1
+      self.n_frame_request = 0
+
+      # 'gl' looks up objids in pick_buffer, drawn again only once
+      # the view has changed, 'cpu' casts the mouse ray through 
+      # ray_pickers, made when first needed. Hovers are picked once
+      # per tick, at the last mouse position.
+      self.pick_mode = pick_mode
+      self.pick_buffer = PickBuffer()
+      self.is_pick_dirty = True
+      self.ray_pickers = None
+      self.hover_pos = None
 
       self.camera = Camera()
       self.camera.resize(*size)
-      self.camera.set_center(rendered_soup.center)
-      self.camera.rezoom(2.0/rendered_soup.scale)
 
       self.new_camera = Camera()
       self.n_step_animate = 0 
 
       self.console = Console(size)
       self.text = self.console.text
+      self.progress = ''
+
+      # meshes are loaded on the loader thread, in the order they 
+      # are drawn, and only given buffers once they arrive
+      self.draw_style = draw_style
+      self.vertex_buffers = {}
+      self.index_buffers = {}
+      self.mesh_frames = {}
+      self.requested = set(self.get_drawn_meshes())
+      self.released = set()
+      self.loader = MeshLoader(
+          lambda: open_structure(
+              fname, cache, hbond_mode, traj, pool, max_bytes,
+          is_update_ss),
+          self.get_drawn_meshes())
+
+      # drawn only when something has changed, at most max_fps 
+      # times a second, with uniforms only set when they change
+      self.max_fps = max_fps
+      self.is_dirty = False
+      self.last_draw_time = None
+      self.n_draw = 0
+      self.uniform_values = {}
 
       self.timer = app.Timer(1.0 / 30)  # change rendering speed here
       self.timer.connect(self.on_timer)
@@ -822,80 +428,304 @@ class MolecularViewerCanvas(app.Canvas):
     def on_initialize(self, event):
       gloo.set_state(depth_test=True, clear_color='black')
 
-    def draw_buffers(self, program):
+    def get_drawn_meshes(self):
+      """
+      Returns the meshes of the draw style, in the order they are
+      loaded, with the smallest and quickest first.
+      """
+      names = ['arrows', 'cartoon']
       if self.draw_style == 'sidechains':
-        program.bind(self.ballstick_vertex_buffer)
-        program.draw('triangles', self.ballstick_index_buffer)
-
-      program.bind(self.arrow_buffer)
-      program.draw('triangles')
-
-      program.bind(self.cartoon_vertex_buffer)
-      program.draw('triangles', self.cartoon_index_buffer)
-
-    def on_draw(self, event):
-      gloo.clear()
-      gloo.set_viewport(0, 0, self.camera.width, self.camera.height)
-
-      self.program['u_light_position'] = [100., 100., 500.]
-      self.program['u_is_lighting'] = True
-      self.program['u_model'] = self.camera.model
-      self.program['u_normal'] = self.camera.rotation 
-      self.program['u_view'] = self.camera.view
-      self.program['u_projection'] = self.camera.projection
-      self.program['u_is_fog'] = self.camera.is_fog
-      self.program['u_fog_far'] = self.camera.fog_far
-      self.program['u_fog_near'] = self.camera.fog_near
-      self.program['u_fog_color'] = self.camera.fog_color
-
-      gl.glEnable(gl.GL_BLEND)
-      gl.glEnable(gl.GL_DEPTH_TEST)
-      gl.glDepthFunc(gl.GL_LEQUAL)
-      gl.glCullFace(gl.GL_FRONT)
-      gl.glEnable(gl.GL_CULL_FACE)
-
-      self.draw_buffers(self.program)
-
-      gl.glDisable(gl.GL_BLEND)
-      gl.glDisable(gl.GL_DEPTH_TEST)
-      gl.glDisable(gl.GL_CULL_FACE)
-
-      self.console.draw()
-
-      self.last_draw = 'screen'
+        names.append('ballstick')
+      return names
+
+    def set_structure(self, meshes, tables, info, player):
+      self.meshes = meshes
+      self.atom_positions = tables['atom_positions']
+      self.atom_labels = tables['atom_labels']
+      self.trace_objids = tables['trace_objids']
+      self.draw_objids = tables['draw_objids']
+      self.scale = info['scale']
+      self.camera.set_center(np.array(info['center']))
+      self.camera.rezoom(2.0/self.scale)
+      self.player = player
+      if player is not None:
+        self.prefetcher = trajectory.FramePrefetcher(
+            player.frames, stride=self.stride, fps=self.fps)
+        self.is_playing = True
+
+    def show_progress(self, message):
+      self.progress = message
+      self.console.text.text = message
+      self.console.x = 0
+      self.console.y = 0
+
+    def receive_meshes(self):
+      """
+      Makes the buffers of the meshes that the loader has finished.
+      """
+      results = self.loader.get_results()
+      for result in results:
+        if result[0] == 'progress':
+          self.show_progress(result[1])
+        elif result[0] == 'structure':
+          self.set_structure(*result[1:])
+        elif result[0] == 'released':
+          self.released.add(result[1])
+        elif result[0] == 'mesh':
+          name, triangle_store = result[1:]
+          self.requested.discard(name)
+          self.released.discard(name)
+          with profiling.span('upload', mesh=name) as span:
+            self.vertex_buffers[name] = triangle_store.attribute_buffers()
+            self.index_buffers[name] = triangle_store.index_buffer()
+            span.count('upload_bytes', get_mesh_n_byte(triangle_store))
+          # built in the frame of the last frame result
+          self.mesh_frames[name] = self.i_frame
+          self.ray_pickers = None
+        elif result[0] == 'frame':
+          self.n_frame_request -= 1
+          self.upload_frame(*result[1:])
+      self.drop_released_buffers()
+      if results:
+        self.request_draw()
+
+    def make_buffers(self, names):
+      """
+      Asks the loader for the meshes in names that have no buffers
+      yet; their buffers, one per attribute so that frames only 
+      upload the positions and normals, are made in receive_meshes.
+      """
+      self.drop_released_buffers()
+      for name in names:
+        if name not in self.vertex_buffers and name not in self.requested:
+          self.requested.add(name)
+          self.loader.request(name)
+      # meshes that were hidden during playback catch up
+      if self.player is not None:
+        stale = [
+            name for name in names if name in self.vertex_buffers and
+            self.mesh_frames[name] != self.i_frame]
+        if stale:
+          self.request_frame(None, stale)
+
+    def request_frame(self, frame, names):
+      """
+      Asks the loader to move the player to frame, an (i_frame,
+      positions) of the prefetcher, or to stay if frame is None, and
+      to send back the geometry of the meshes in names.
+      """
+      i_frame, positions = (None, None) if frame is None else frame
+      self.loader.request_frame(i_frame, positions, names)
+      self.n_frame_request += 1
+
+    def drop_released_buffers(self):
+      """
+      Drops the buffers of the hidden meshes that the loader has 
+      reported as released by the registry.
+      """
+      drawn = self.get_drawn_meshes()
+      for name in list(self.released):
+        if name in drawn:
+          continue
+        self.released.discard(name)
+        if name in self.vertex_buffers:
+          del self.vertex_buffers[name]
+          del self.index_buffers[name]
+          del self.mesh_frames[name]
 
+    def draw_buffers(self, program):
+      for name in self.get_drawn_meshes():
+        if name not in self.vertex_buffers:
+          continue
+        for attribute, vertex_buffer in self.vertex_buffers[name].items():
+          program[attribute] = vertex_buffer
+        program.draw('triangles', self.index_buffers[name])
+
+    def upload_frame(self, i_frame, positions, geometries):
+      """
+      Uploads the vertices and normals of frame i_frame, made by the
+      loader, to the meshes in geometries that still have buffers.
+      """
+      self.i_frame = i_frame
+      with profiling.span('upload_frame', frame=i_frame) as span:
+        for name, (vertices, normals) in geometries.items():
+          if name not in self.vertex_buffers:
+            continue
+          self.vertex_buffers[name]['a_position'].set_subdata(vertices)
+          self.vertex_buffers[name]['a_normal'].set_subdata(normals)
+          self.mesh_frames[name] = i_frame
+          span.count('upload_bytes', vertices.nbytes + normals.nbytes)
+      self.atom_positions = positions
+      self.ray_pickers = None
+      self.request_draw()
+
+    def request_draw(self, is_view_changed=True):
+      """
+      Redraws the canvas, now or, if the last draw was less than 
+      1/max_fps ago, from on_timer once it is due. Unless only the
+      overlay has changed, the pick image is drawn again too.
+      """
+      if is_view_changed:
+        self.is_pick_dirty = True
+      self.is_dirty = True
+      if self.max_fps and self.last_draw_time is not None:
+        if time.time() - self.last_draw_time < 1.0/self.max_fps:
+          return
+      self.is_dirty = False
       self.update()
 
-    def pick_draw(self):
-      gloo.set_viewport(0, 0, self.camera.width, self.camera.height)
-      gl.glDisable(gl.GL_BLEND)
-      gl.glEnable(gl.GL_DEPTH_TEST)
-      gl.glDepthFunc(gl.GL_LEQUAL)
-      gl.glCullFace(gl.GL_FRONT)
-      gl.glEnable(gl.GL_CULL_FACE)
+    def set_uniforms(self, program, uniforms):
+      """
+      Sets the (name, value) uniforms of program whose values differ
+      from those it was last given.
+      """
+      values = self.uniform_values.setdefault(id(program), {})
+      for name, value in uniforms:
+        if name in values and np.array_equal(values[name], value):
+          continue
+        program[name] = value
+        values[name] = np.array(value, copy=True)
 
-      gl.glClearColor(0.0, 0.0, 0.0, 0.0)
-      gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
-
-      self.picking_program['u_model'] = self.camera.model
-      self.picking_program['u_view'] = self.camera.view
-      self.picking_program['u_projection'] = self.camera.projection
-
-      self.draw_buffers(self.picking_program)
-
-      self.last_draw = 'pick'
+    def on_draw(self, event):
+      with profiling.span('draw'):
+        gloo.clear()
+        gloo.set_viewport(0, 0, self.camera.width, self.camera.height)
+
+        self.set_uniforms(self.program, [
+            ('u_light_position', [100., 100., 500.]),
+            ('u_is_lighting', True),
+            ('u_model', self.camera.model),
+            ('u_normal', self.camera.rotation),
+            ('u_view', self.camera.view),
+            ('u_projection', self.camera.projection),
+            ('u_is_fog', self.camera.is_fog),
+            ('u_fog_far', self.camera.fog_far),
+            ('u_fog_near', self.camera.fog_near),
+            ('u_fog_color', self.camera.fog_color)])
+
+        gl.glEnable(gl.GL_BLEND)
+        gl.glEnable(gl.GL_DEPTH_TEST)
+        gl.glDepthFunc(gl.GL_LEQUAL)
+        gl.glCullFace(gl.GL_FRONT)
+        gl.glEnable(gl.GL_CULL_FACE)
+
+        self.draw_buffers(self.program)
+
+        gl.glDisable(gl.GL_BLEND)
+        gl.glDisable(gl.GL_DEPTH_TEST)
+        gl.glDisable(gl.GL_CULL_FACE)
+
+        self.console.draw()
+
+        self.last_draw_time = time.time()
+        self.n_draw += 1
+
+    def draw_pick_image(self):
+      """
+      Draws the objids into the pick buffer and starts reading it
+      back, which poll_pick picks up on a later tick.
+      """
+      if self.pick_buffer.is_reading:
+        self.pick_buffer.finish_read()
+      with profiling.span('pick_draw'):
+        self.pick_buffer.resize(self.camera.width, self.camera.height)
+        self.pick_buffer.bind()
+
+        gloo.set_viewport(0, 0, self.camera.width, self.camera.height)
+        gl.glDisable(gl.GL_BLEND)
+        gl.glEnable(gl.GL_DEPTH_TEST)
+        gl.glDepthFunc(gl.GL_LEQUAL)
+        gl.glCullFace(gl.GL_FRONT)
+        gl.glEnable(gl.GL_CULL_FACE)
+
+        gl.glClearColor(0.0, 0.0, 0.0, 0.0)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+
+        self.set_uniforms(self.picking_program, [
+            ('u_model', self.camera.model),
+            ('u_view', self.camera.view),
+            ('u_projection', self.camera.projection)])
+
+        self.draw_buffers(self.picking_program)
+
+        gl.glDisable(gl.GL_DEPTH_TEST)
+        gl.glDisable(gl.GL_CULL_FACE)
+        self.pick_buffer.unbind()
+        self.pick_buffer.start_read()
+        self.is_pick_dirty = False
+
+    def get_ray_pickers(self):
+      """
+      Returns RayPickers of the drawn meshes that have arrived, at
+      the current atom positions.
+      """
+      if self.ray_pickers is None:
+        self.ray_pickers = []
+        drawn = [n for n in self.get_drawn_meshes() if n in self.vertex_buffers]
+        if 'arrows' in drawn or 'cartoon' in drawn:
+          self.ray_pickers.append(RayPicker(
+              self.atom_positions[self.trace_objids], self.trace_objids,
+              ray_pick_radii['trace']))
+        if 'ballstick' in drawn:
+          self.ray_pickers.append(RayPicker(
+              self.atom_positions[self.draw_objids], self.draw_objids,
+              ray_pick_radii['atoms']))
+      return self.ray_pickers
+
+    def ray_pick(self, x, y):
+      with profiling.span('ray_pick'):
+        origin, direction = get_mouse_ray(self.camera, x, y)
+        return pick_by_ray(self.get_ray_pickers(), origin, direction)
 
     def pick(self, x, y):
-      if self.last_draw != 'pick':
-        self.pick_draw()
-
-      pixels = (c_float*4)()
-      y_screen = self.size[1] - y # screen and OpenGL y coord flipped
-      gl.glReadPixels(x, y_screen, 1, 1, gl.GL_RGBA, gl.GL_FLOAT, pixels)
-      
-      return int(pixels[2]*255*256*256) + \
-             int(pixels[1]*255*256) + \
-             int(pixels[0]*255)
+      """
+      Returns the objid at x, y, or -1, waiting for the pick image
+      if it is out of date.
+      """
+      if self.pick_mode == 'cpu':
+        return self.ray_pick(x, y)
+      if self.is_pick_dirty:
+        self.draw_pick_image()
+      self.pick_buffer.finish_read()
+      return self.pick_buffer.lookup(x, y)
+
+    def poll_pick(self, x, y):
+      """
+      Returns the objid at x, y from the last pick image, or None
+      while a new one is being drawn or read back.
+      """
+      if self.pick_mode == 'cpu':
+        return self.ray_pick(x, y)
+      if self.pick_buffer.is_reading:
+        if not self.pick_buffer.finish_read(is_wait=False):
+          return None
+      elif self.is_pick_dirty:
+        self.draw_pick_image()
+        return None
+      return self.pick_buffer.lookup(x, y)
+
+    def hover(self):
+      """
+      Shows the label of the atom at the last mouse position.
+      """
+      objid = self.poll_pick(*self.hover_pos)
+      if objid is None:
+        return
+      self.hover_pos = None
+      console = (self.console.text.text, self.console.x, self.console.y)
+      if objid < 0:
+        self.console.text.text = self.progress
+      else:
+        self.console.text.text = str(self.atom_labels[objid])
+        pos = np.append(self.atom_positions[objid], [1], 0)
+        pos = np.dot(pos, self.camera.model)
+        pos = np.dot(pos, self.camera.view)
+        pos = np.dot(pos, self.camera.projection)
+        pos = pos/pos[3]
+        self.console.x = pos[0]*self.size[0]*0.5
+        self.console.y = pos[1]*self.size[1]*0.5
+      if console != (self.console.text.text, self.console.x, self.console.y):
+        self.request_draw(is_view_changed=False)
 
     def on_key_press(self, event):
       if event.text == ' ':
@@ -908,18 +738,38 @@ class MolecularViewerCanvas(app.Canvas):
           self.draw_style = 'no-sidechains'
         else:
           self.draw_style = 'sidechains'
+        self.make_buffers(self.get_drawn_meshes())
+        self.ray_pickers = None
+        self.request_draw()
+      if event.text == 'p' and self.player is not None:
+        self.is_playing = not self.is_playing
 
     def on_timer(self, event):
+      if self.is_dirty:
+        self.request_draw()
+      self.receive_meshes()
+      if self.is_playing and self.n_frame_request == 0:
+        # frames are read on the prefetch thread, and their geometry
+        # made on the loader thread, so this never waits and skips
+        # ticks until a frame is ready
+        frame = self.prefetcher.next_frame()
+        if frame is not None:
+          self.request_frame(frame, [
+              name for name in self.get_drawn_meshes()
+              if name in self.vertex_buffers])
       if self.n_step_animate > 0:
         diff = self.new_camera.center - self.camera.center
         fraction = 1.0/float(self.n_step_animate)
         new_center = self.camera.center + fraction*diff
         self.camera.set_center(new_center)
         self.n_step_animate -= 1
-        self.update()
+        self.request_draw()
+      if self.hover_pos is not None:
+        self.hover()
 
     def on_resize(self, event):
       self.camera.resize(*event.size)
+      self.request_draw()
 
     def on_mouse_press(self, event):
       self.save_event = event
@@ -927,37 +777,24 @@ class MolecularViewerCanvas(app.Canvas):
 
     def on_mouse_release(self, event):
       objid = self.pick(*event.pos)
-      if self.save_objid == objid and objid > 0:
-        atom = self.rendered_soup.atom_by_objid[objid]
-        self.new_camera.center = atom.pos
+      if self.save_objid == objid and objid >= 0:
+        self.new_camera.center = self.atom_positions[objid]
         self.n_step_animate = 10
 
     def on_mouse_move(self, event):
-      objid = self.pick(*event.pos)
-      if objid <= 0:
-        self.console.text.text = ''
-      if objid > 0:
-        atom = self.rendered_soup.atom_by_objid[objid]
-        s = "%s-%s-%s" % (atom.res_tag(), atom.res_type, atom.type)
-        self.console.text.text = s
-        pos = np.append(atom.pos[:], [1], 0)
-        pos = np.dot(pos, self.camera.model)
-        pos = np.dot(pos, self.camera.view)
-        pos = np.dot(pos, self.camera.projection)
-        pos = pos/pos[3]
-        self.console.x = pos[0]*self.size[0]*0.5
-        self.console.y = pos[1]*self.size[1]*0.5
+      # picked in on_timer, however many moves come in a tick
+      self.hover_pos = event.pos
 
       if event.button == 1:
         x_diff = event.pos[0] - self.save_event.pos[0]
         y_diff = event.pos[1] - self.save_event.pos[1]
-        scale = self.rendered_soup.scale
+        scale = self.scale
         self.camera.rotate(
             x_diff/float(self.camera.width)*10/scale, 
             y_diff/float(self.camera.height)*10/scale, 
             0.0)
         self.save_event = event
-        self.update()
+        self.request_draw()
       elif event.button == 2:
         def get_event_polar(event):
           return get_polar(
@@ -968,19 +805,97 @@ class MolecularViewerCanvas(app.Canvas):
         self.camera.rezoom((r0-r)*500.)
         self.camera.rotate(0, 0, (psi - psi0)/math.pi*180)
         self.save_event = event
-        self.update()
-
-
-
-def main(fname):
-    mvc = MolecularViewerCanvas(fname)
-    mvc.show()
-    app.run()
+        self.request_draw()
+
+
+
+def main(
+    fname, cache=None, hbond_mode='distance', traj=None, stride=1, 
+    fps=None, n_worker=1, draw_style='sidechains', max_bytes=None,
+    max_fps=None, pick_mode='gl', profile_fname=None, trace_fname=None,
+    is_update_ss=False):
+    if profile_fname or trace_fname:
+      profiling.enable()
+    # forked before the loader, prefetch and GL threads start, so that
+    # no process inherits a lock held by one of them
+    pool = None if n_worker == 1 else multiprocessing.Pool(n_worker)
+    try:
+      mvc = MolecularViewerCanvas(
+          fname, cache, hbond_mode, traj, stride, fps, pool, draw_style,
+          max_bytes, max_fps, pick_mode, is_update_ss)
+      mvc.show()
+      app.run()
+    finally:
+      if pool is not None:
+        pool.terminate()
+        pool.join()
+    if profile_fname:
+      profiling.write_json(profile_fname)
+    if trace_fname:
+      profiling.write_chrome_trace(trace_fname)
+    if profile_fname or trace_fname:
+      profiling.print_summary()
 
 
 
 if __name__ == '__main__':
-  if len(sys.argv) < 2:
-    print 'Usage: pyball.py pdb'
+  parser = argparse.ArgumentParser(description='pyball protein viewer')
+  parser.add_argument('pdb')
+  parser.add_argument(
+      '--no-cache', action='store_true', 
+      help='always rebuild the meshes')
+  parser.add_argument(
+      '--cache-dir', 
+      help='mesh cache directory [$PYBALL_CACHE_DIR or ~/.cache/pyball]')
+  parser.add_argument(
+      '--dssp', action='store_true',
+      help='find H-bonds by DSSP electrostatic energy, not N-O distance')
+  parser.add_argument(
+      '--traj', 
+      help='play a DCD or raw float32 trajectory of the atoms in pdb')
+  parser.add_argument(
+      '--stride', type=int, default=1, 
+      help='play every n-th frame [1]')
+  parser.add_argument(
+      '--fps', type=float, default=None, 
+      help='maximum frames per second of playback')
+  parser.add_argument(
+      '-j', '--workers', type=int, default=1,
+      help='processes that build the cartoon while the other meshes are '
+           'built, or 0 for one per core [1]')
+  parser.add_argument(
+      '--no-sidechains', action='store_true',
+      help='start without sidechains, built when first shown with s')
+  parser.add_argument(
+      '--mesh-budget', type=float, default=None,
+      help='MB of meshes to keep once hidden [no limit]')
+  parser.add_argument(
+      '--max-fps', type=float, default=None,
+      help='maximum redraws per second [no limit]')
+  parser.add_argument(
+      '--pick', choices=['gl', 'cpu'], default='gl',
+      help='pick by reading back drawn objids, or by casting the mouse '
+           'ray through a grid of the atoms [gl]')
+  parser.add_argument(
+      '--update-ss', action='store_true',
+      help='reassign H-bonds and secondary structure in every frame '
+           'of playback, rebuilding the meshes when it changes')
+  parser.add_argument(
+      '--profile', metavar='JSON',
+      help='write the time and counts of each loading and drawing '
+           'phase to a JSON file on exit')
+  parser.add_argument(
+      '--trace', metavar='JSON',
+      help='write the phases as a Chrome trace, for chrome://tracing '
+           'or Perfetto, on exit')
+  args = parser.parse_args()
+  if args.no_cache:
+    cache = None
   else:
-    main(sys.argv[1])
+    cache = MeshCache(mesh_builder_version, args.cache_dir)
+  main(
+      args.pdb, cache, 'dssp' if args.dssp else 'distance', 
+      args.traj, args.stride, args.fps, args.workers or None,
+      'no-sidechains' if args.no_sidechains else 'sidechains',
+      None if args.mesh_budget is None else int(args.mesh_budget*1024**2),
+      args.max_fps, args.pick, args.profile, args.trace, args.update_ss)
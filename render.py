@@ -7,6 +7,7 @@ polygon triangle strips to form meshes for OpenGL display.
 
 
 import math
+import numpy as np
 from pdbremix import v3numpy as v3
 
 
@@ -20,6 +21,37 @@ def get_xy_face_transform(tangent, up, scale):
   return m
 
 
+def get_xy_face_rotations(tangents, ups, scale=1.0):
+  """
+  Returns an (n, 3, 3) array holding the rotation part of 
+  get_xy_face_transform for each pair in the (n, 3) arrays 
+  tangents and ups.
+  """
+  tangents = np.asarray(tangents)
+  ups = np.asarray(ups)
+  def norm(v):
+    return v/np.sqrt((v*v).sum(axis=-1))[..., np.newaxis]
+  m = np.zeros((len(tangents), 3, 3))
+  m[:,:,0] = scale*norm(np.cross(ups, tangents))
+  m[:,:,1] = scale*norm(ups)
+  m[:,:,2] = scale*norm(tangents)
+  return m
+
+
+def transform_templates(rotations, template):
+  """
+  Returns an (n, n_template, 3) array of the (n_template, 3) 
+  template vectors rotated by each of the (n, 3, 3) rotations,
+  computed as a single matrix product over all rotations.
+  """
+  rotations = np.asarray(rotations)
+  template = np.asarray(template, dtype=rotations.dtype).reshape(-1, 3)
+  n_template = len(template)
+  products = np.dot(rotations.reshape(-1, 3), template.T)
+  return np.ascontiguousarray(
+      products.reshape(-1, 3, n_template).transpose(0, 2, 1))
+
+
 
 ##################################################
 # Profiles and extrusions for cartoon view
@@ -67,6 +99,26 @@ class RectProfile():
 
 
 
+def get_cap_indices(n_arc):
+  indices = []
+  for i_arc in range((n_arc-1)/2):
+    indices.extend([i_arc, i_arc+1, n_arc-1-i_arc])
+    indices.extend([n_arc-1-i_arc, i_arc+1, n_arc-2-i_arc])
+  return np.array(indices)
+
+
+def get_ring_indices(n_arc):
+  """
+  Returns the (n_arc, 6) template of the two triangles joining 
+  each arc of a ring to the next ring of n_arc vertices.
+  """
+  i_arc = np.arange(n_arc)
+  j_arc = (i_arc + 1) % n_arc
+  return np.array([
+      i_arc, n_arc + i_arc, j_arc,
+      j_arc, n_arc + i_arc, n_arc + j_arc]).T
+
+
 class TubeBuilder():
   def __init__(self, trace, profile, color):
     self.trace = trace
@@ -75,72 +127,92 @@ class TubeBuilder():
     n_arc = len(self.profile.arcs)
     n_slice = len(self.trace.points)
     self.n_vertex = n_arc*(n_slice + 2)
+    self.n_index = 2*len(get_cap_indices(n_arc)) + 6*n_arc*(n_slice - 1)
 
-  def build_triangles(self, vertex_buffer):
-    n_point = len(self.trace.points)
+  def get_geometry(self):
+    """
+    Returns the (n_vertex, 3) vertices and normals of the tube,
+    which are all that changes when the trace moves.
+    """
     n_arc = len(self.profile.arcs)
 
-    # draw front face
-    indices = []
-    for i_arc in range((n_arc-1)/2):
-      indices.extend([i_arc, i_arc+1, n_arc-1-i_arc])
-      indices.extend([n_arc-1-i_arc, i_arc+1, n_arc-2-i_arc])
-    vertex_buffer.setup_next_strip(indices)
-
-    m = get_xy_face_transform(
-        self.trace.tangents[0], self.trace.ups[0], 1.0)
-    arcs = [
-        v3.transform(m, a) + self.trace.points[0] 
-        for a in self.profile.arcs]
-    normal = -self.trace.tangents[0]
-    for i_arc in range(n_arc):
-      vertex_buffer.add_vertex(
-          arcs[i_arc], normal, self.color, self.trace.objids[0])
-
-    # draw extrusion in tube
-    indices = []
-    for i_point in range(n_point-1):
-      i_slice_offset = i_point*n_arc
-      j_slice_offset = (i_point+1)*n_arc
-      for i_arc in range(n_arc):
-        j_arc = (i_arc+1) % n_arc
-        indices.append(i_slice_offset + i_arc)
-        indices.append(j_slice_offset + i_arc)
-        indices.append(i_slice_offset + j_arc)
-        indices.append(i_slice_offset + j_arc)
-        indices.append(j_slice_offset + i_arc)
-        indices.append(j_slice_offset + j_arc)
-    vertex_buffer.setup_next_strip(indices)
-
-    for i in range(n_point):
-      m = get_xy_face_transform(
-          self.trace.tangents[i], self.trace.ups[i], 1.0)
-      arcs = [
-          v3.transform(m, a) + self.trace.points[i] 
-          for a in self.profile.arcs]
-      normals = [v3.transform(m, n) for n in self.profile.normals]
-      for i_arc in range(n_arc):
-        vertex_buffer.add_vertex(
-            arcs[i_arc], normals[i_arc], self.color, self.trace.objids[i])
-
-    # draw back face
-    indices = []
-    for i_arc in range((n_arc-1)/2):
-      indices.extend([i_arc, i_arc+1, n_arc-1-i_arc])
-      indices.extend([n_arc-1-i_arc, i_arc+1, n_arc-2-i_arc])
-    vertex_buffer.setup_next_strip(indices)
-
-    i_point = n_point - 1
-    m = get_xy_face_transform(
-        self.trace.tangents[i_point], self.trace.ups[i_point], 1.0)
-    arcs = [
-        v3.transform(m, a) + self.trace.points[i_point] 
-        for a in self.profile.arcs]
-    normal = self.trace.tangents[i_point]
-    for i_arc in reversed(range(n_arc)):
-      vertex_buffer.add_vertex(
-          arcs[i_arc], normal, self.color, self.trace.objids[i_point])
+    # one frame per slice, extruded through all the profile arcs
+    rotations = get_xy_face_rotations(self.trace.tangents, self.trace.ups)
+    centers = np.asarray(self.trace.points)[:, np.newaxis, :]
+    arcs = transform_templates(rotations, self.profile.arcs) + centers
+    normals = transform_templates(rotations, self.profile.normals)
+
+    # front face, extrusion in tube, back face in reverse
+    vertices = np.concatenate(
+        [arcs[0], arcs.reshape(-1, 3), arcs[-1, ::-1]])
+    normals = np.concatenate([
+        np.tile(-self.trace.tangents[0], (n_arc, 1)),
+        normals.reshape(-1, 3),
+        np.tile(self.trace.tangents[-1], (n_arc, 1))])
+    return vertices, normals
 
+  def build_triangles(self, vertex_buffer):
+    n_point = len(self.trace.points)
+    n_arc = len(self.profile.arcs)
+    vertices, normals = self.get_geometry()
+    objids = np.concatenate([
+        np.repeat(self.trace.objids[:1], n_arc),
+        np.repeat(self.trace.objids, n_arc),
+        np.repeat(self.trace.objids[-1:], n_arc)])
+
+    cap_indices = get_cap_indices(n_arc)
+    ring_offsets = n_arc + n_arc*np.arange(n_point-1)
+    indices = np.concatenate([
+        cap_indices,
+        np.add.outer(ring_offsets, get_ring_indices(n_arc)).ravel(),
+        cap_indices + n_arc*(n_point+1)])
+
+    vertex_buffer.add_indices(indices)
+    vertex_buffer.add_vertices(vertices, normals, self.color, objids)
+
+
+def get_tube_geometries(builders):
+  """
+  Returns the vertices and normals of the TubeBuilders concatenated
+  in order, as from their get_geometry, but with the frames of all
+  tubes sharing a profile computed in one pass.
+  """
+  offsets = np.cumsum([0] + [r.n_vertex for r in builders])
+  vertices = np.zeros((offsets[-1], 3))
+  normals = np.zeros((offsets[-1], 3))
+  profiles = []
+  for r in builders:
+    if not any(r.profile is profile for profile in profiles):
+      profiles.append(r.profile)
+
+  for profile in profiles:
+    i_builders = [i for i, r in enumerate(builders) if r.profile is profile]
+    traces = [builders[i].trace for i in i_builders]
+    tangents = np.concatenate([t.tangents for t in traces])
+    ups = np.concatenate([t.ups for t in traces])
+    centers = np.concatenate([t.points for t in traces])[:, np.newaxis, :]
+    rotations = get_xy_face_rotations(tangents, ups)
+    arcs = transform_templates(rotations, profile.arcs) + centers
+    arc_normals = transform_templates(rotations, profile.normals)
+
+    # front face, extrusion in tube, back face in reverse
+    n_arc = len(profile.arcs)
+    i_slice = 0
+    for i, trace in zip(i_builders, traces):
+      j_slice = i_slice + len(trace.points)
+      k = offsets[i]
+      vertices[k:k+n_arc] = arcs[i_slice]
+      normals[k:k+n_arc] = -trace.tangents[0]
+      k += n_arc
+      n = n_arc*(j_slice - i_slice)
+      vertices[k:k+n] = arcs[i_slice:j_slice].reshape(-1, 3)
+      normals[k:k+n] = arc_normals[i_slice:j_slice].reshape(-1, 3)
+      k += n
+      vertices[k:k+n_arc] = arcs[j_slice-1, ::-1]
+      normals[k:k+n_arc] = trace.tangents[-1]
+      i_slice = j_slice
+
+  return vertices, normals
 
 
 
@@ -166,6 +238,25 @@ class Arrow:
       j = (i+1) % n_arc
       self.indices.extend([i+n_arc, i, j, j+n_arc, i+n_arc, j])
 
+    # flat-shaded template: each vertex is split by the normal of
+    # the faces it touches, and vertices shared within a face with
+    # the same normal are merged
+    self.points = []
+    self.normals = []
+    self.face_indices = []
+    i_point_by_key = {}
+    for i in range(0, len(self.indices), 3):
+      triangle = self.indices[i:i+3]
+      points = [self.vertices[j] for j in triangle]
+      normal = v3.cross(points[1] - points[0], points[0] - points[2])
+      for j in triangle:
+        key = (j, tuple(normal))
+        if key not in i_point_by_key:
+          i_point_by_key[key] = len(self.points)
+          self.points.append(self.vertices[j])
+          self.normals.append(normal)
+        self.face_indices.append(i_point_by_key[key])
+
   def get_orientate(self, tanget, up, scale):
     return get_xy_face_transform(tanget, up, scale)
 
@@ -199,6 +290,16 @@ class Cylinder:
         get_xy_face_transform(tangent, up, scale),
         v3.scaling_matrix(1.0, 1.0, v3.mag(tangent)/scale))
 
+  def get_orientates(self, tangents, ups, scale):
+    """
+    Returns the (n, 3, 3) rotation parts of get_orientate for 
+    each pair in the (n, 3) arrays tangents and ups.
+    """
+    m = get_xy_face_rotations(tangents, ups, scale)
+    lengths = np.sqrt((tangents*tangents).sum(axis=1)).astype(np.float64)
+    m[:,:,2] *= (lengths/scale)[:,np.newaxis]
+    return m
+
 
 
 class Sphere:
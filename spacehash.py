@@ -1,40 +1,74 @@
-import array
 import math
 
+import numpy as np
+
+
+def get_cell_offsets(n_ring=1):
+  """
+  Returns an (n, 3) array of the cell offsets within n_ring cells,
+  starting with (0, 0, 0) and followed only by the offsets that are
+  lexicographically positive. Pairing every cell with this half-shell
+  visits each pair of neighbouring cells exactly once.
+  """
+  r = range(-n_ring, n_ring+1)
+  offsets = [(0, 0, 0)]
+  for offset in ((i, j, k) for i in r for j in r for k in r):
+    if offset > (0, 0, 0):
+      offsets.append(offset)
+  return np.array(offsets, dtype=np.int64)
+
+
+def expand_cell_pairs(starts0, counts0, starts1, counts1):
+  """
+  Given matched runs [starts0, starts0+counts0) and
+  [starts1, starts1+counts1), returns two arrays holding every
+  cross combination of an element in the first run with an
+  element in the second run.
+  """
+  n_pairs = counts0*counts1
+  n_total = n_pairs.sum()
+  owner = np.repeat(np.arange(len(n_pairs)), n_pairs)
+  local = np.arange(n_total) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+  counts1 = counts1[owner]
+  return starts0[owner] + local//counts1, starts1[owner] + local%counts1
+
 
 class SpaceHash(object):
+  """
+  Uniform grid over a set of vertices. The vertices are sorted by
+  the hash of their cell so that every occupied cell is a
+  contiguous run of self.order, and neighbouring cells are found
+  with a table of cell offsets.
+  """
 
   def __init__(self, vertices, div=5.3, padding=0.05):
-    self.vertices = vertices
+    self.vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
     self.div = div
     self.inv_div = 1.0/self.div
     self.padding = padding
 
-    zero3 = lambda: [0.0]*3
-    self.minima = zero3()
-    self.maxima = zero3()
-    self.spans = zero3()
-    self.sizes = zero3()
-
-    for i in range(3):
-      self.minima[i] = min([v[i] for v in self.vertices])
-      self.maxima[i] = max([v[i] for v in self.vertices])
-      self.minima[i] -= self.padding
-      self.maxima[i] += self.padding
-      self.spans[i] = self.maxima[i] - self.minima[i]
-      self.sizes[i] = int(math.ceil(self.spans[i]*self.inv_div))
+    if len(self.vertices):
+      self.minima = self.vertices.min(axis=0) - self.padding
+      self.maxima = self.vertices.max(axis=0) + self.padding
+    else:
+      self.minima = np.zeros(3)
+      self.maxima = np.zeros(3)
+    self.spans = self.maxima - self.minima
+    self.sizes = np.maximum(
+        1, np.ceil(self.spans*self.inv_div)).astype(np.int64)
 
     self.size1_size2 = self.sizes[1]*self.sizes[2]
     self.size2 = self.sizes[2]
+    self.strides = np.array([self.size1_size2, self.size2, 1], dtype=np.int64)
 
-    self.cells = {}
-    self.spaces = []
-    for i_vertex, vertex in enumerate(self.vertices):
-      space = self.vertex_to_space(vertex)
-      self.spaces.append(space)
-      space_hash = self.space_to_hash(space)
-      cell = self.cells.setdefault(space_hash, array.array('L'))
-      cell.append(i_vertex)
+    self.spaces = np.floor(
+        (self.vertices - self.minima)*self.inv_div).astype(np.int64)
+    self.hashes = self.spaces.dot(self.strides)
+
+    self.order = np.argsort(self.hashes, kind='mergesort')
+    self.cell_hashes, self.cell_starts, self.cell_counts = np.unique(
+        self.hashes[self.order], return_index=True, return_counts=True)
+    self.cell_spaces = self.spaces[self.order[self.cell_starts]]
 
   def vertex_to_space(self, v):
     return [int((v[i] - self.minima[i])*self.inv_div) for i in range(3)]
@@ -52,12 +86,304 @@ class SpaceHash(object):
         for s2 in neighbourhood_in_dim(space, 2):
           yield [s0, s1, s2]
 
+  def find_cells(self, spaces):
+    """
+    Returns the index into self.cell_hashes of each space in the
+    (n, 3) array spaces, or -1 where the space is off the grid or
+    the cell is empty.
+    """
+    spaces = np.asarray(spaces, dtype=np.int64)
+    is_inside = np.all((spaces >= 0) & (spaces < self.sizes), axis=1)
+    hashes = spaces.dot(self.strides)
+    n_cell = len(self.cell_hashes)
+    if n_cell == 0:
+      return np.full(len(spaces), -1, dtype=np.int64)
+    i_cells = np.minimum(np.searchsorted(self.cell_hashes, hashes), n_cell-1)
+    is_found = is_inside & (self.cell_hashes[i_cells] == hashes)
+    return np.where(is_found, i_cells, -1)
+
+  def close_pair_arrays(self, cutoff=None):
+    """
+    Returns arrays (i, j, d) of all vertex pairs i < j closer than
+    cutoff, with their distances d, sorted by i then j. If cutoff
+    is None, returns all pairs in neighbouring cells instead.
+    Cutoffs larger than div are handled by searching more rings
+    of cells.
+    """
+    if cutoff is None:
+      n_ring = 1
+    else:
+      n_ring = max(1, int(math.ceil(cutoff*self.inv_div)))
+
+    i_pairs = []
+    j_pairs = []
+    for offset in get_cell_offsets(n_ring):
+      i_cells0 = np.arange(len(self.cell_hashes))
+      i_cells1 = self.find_cells(self.cell_spaces + offset)
+      is_found = i_cells1 >= 0
+      i_cells0, i_cells1 = i_cells0[is_found], i_cells1[is_found]
+      i_sorted0, i_sorted1 = expand_cell_pairs(
+          self.cell_starts[i_cells0], self.cell_counts[i_cells0],
+          self.cell_starts[i_cells1], self.cell_counts[i_cells1])
+      if not offset.any():
+        is_upper = i_sorted0 < i_sorted1
+        i_sorted0, i_sorted1 = i_sorted0[is_upper], i_sorted1[is_upper]
+      i_vertices0 = self.order[i_sorted0]
+      i_vertices1 = self.order[i_sorted1]
+      if cutoff is not None:
+        diff = self.vertices[i_vertices0] - self.vertices[i_vertices1]
+        is_close = (diff*diff).sum(axis=1) < cutoff*cutoff
+        i_vertices0, i_vertices1 = i_vertices0[is_close], i_vertices1[is_close]
+      i_pairs.append(np.minimum(i_vertices0, i_vertices1))
+      j_pairs.append(np.maximum(i_vertices0, i_vertices1))
+
+    i_pairs = np.concatenate(i_pairs)
+    j_pairs = np.concatenate(j_pairs)
+    order = np.lexsort((j_pairs, i_pairs))
+    i_pairs, j_pairs = i_pairs[order], j_pairs[order]
+    diff = self.vertices[i_pairs] - self.vertices[j_pairs]
+    dists = np.sqrt((diff*diff).sum(axis=1))
+    return i_pairs, j_pairs, dists
+
   def close_pairs(self):
-    n_vertex = len(self.vertices)
-    for i_vertex0 in range(n_vertex):
-      space0 = self.spaces[i_vertex0]
-      for space1 in self.neighbourhood(space0):
-        hash1 = self.space_to_hash(space1)
-        for i_vertex1 in self.cells.get(hash1, []):
-          if i_vertex0 < i_vertex1:
-            yield i_vertex0, i_vertex1
+    i_pairs, j_pairs, dists = self.close_pair_arrays()
+    for i_vertex0, i_vertex1 in zip(i_pairs.tolist(), j_pairs.tolist()):
+      yield i_vertex0, i_vertex1
+
+  def get_query_offsets(self, r, spaces):
+    """
+    Returns the cell offsets that can hold a vertex within r of a
+    point in any of spaces, skipping offsets that fall off the
+    grid for all of spaces, and corner cells whose nearest face is
+    further than r.
+    """
+    if len(spaces) == 0:
+      return np.zeros((0, 3), dtype=np.int64)
+    n_ring = max(1, int(math.ceil(r*self.inv_div)))
+    lo = np.maximum(-n_ring, -spaces.max(axis=0))
+    hi = np.minimum(n_ring, self.sizes - 1 - spaces.min(axis=0))
+    if np.any(lo > hi):
+      return np.zeros((0, 3), dtype=np.int64)
+    offsets = np.mgrid[
+        lo[0]:hi[0]+1, lo[1]:hi[1]+1, lo[2]:hi[2]+1].reshape(3, -1).T
+    gaps = np.maximum(np.abs(offsets) - 1, 0)*self.div
+    is_reachable = (gaps*gaps).sum(axis=1) <= r*r
+    return offsets[is_reachable]
+
+  def query_radius_batch(self, points, r):
+    """
+    Returns CSR arrays (indptr, indices, dists) of the vertices
+    within r of each of points, so that the neighbours of points[i]
+    are indices[indptr[i]:indptr[i+1]], sorted by distance.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    n_query = len(points)
+    spaces = np.floor((points - self.minima)*self.inv_div).astype(np.int64)
+
+    i_queries = []
+    i_vertices = []
+    for offset in self.get_query_offsets(r, spaces):
+      i_cells = self.find_cells(spaces + offset)
+      is_found = i_cells >= 0
+      i_query, i_cells = np.nonzero(is_found)[0], i_cells[is_found]
+      i_query, i_sorted = expand_cell_pairs(
+          i_query, np.ones(len(i_query), dtype=np.int64),
+          self.cell_starts[i_cells], self.cell_counts[i_cells])
+      i_queries.append(i_query)
+      i_vertices.append(self.order[i_sorted])
+
+    if i_queries:
+      i_queries = np.concatenate(i_queries)
+      i_vertices = np.concatenate(i_vertices)
+    else:
+      i_queries = np.zeros(0, dtype=np.int64)
+      i_vertices = np.zeros(0, dtype=np.int64)
+    diff = self.vertices[i_vertices] - points[i_queries]
+    dists = np.sqrt((diff*diff).sum(axis=1))
+    is_close = dists <= r
+    i_queries, i_vertices, dists = \
+        i_queries[is_close], i_vertices[is_close], dists[is_close]
+
+    order = np.lexsort((i_vertices, dists, i_queries))
+    indptr = np.zeros(n_query+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(i_queries, minlength=n_query))
+    return indptr, i_vertices[order], dists[order]
+
+  def query_radius(self, point, r):
+    """
+    Returns arrays (indices, dists) of the vertices within r of
+    point, sorted by distance.
+    """
+    indptr, indices, dists = self.query_radius_batch([point], r)
+    return indices, dists
+
+  def query_knn_batch(self, points, k):
+    """
+    Returns (n_point, k) arrays (indices, dists) of the k nearest
+    vertices to each of points, sorted by distance. The search
+    radius is doubled until k vertices are found, or it covers
+    every vertex. If there are fewer than k vertices, the
+    remaining columns are filled with -1 and inf.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    n_query = len(points)
+    indices = np.full((n_query, k), -1, dtype=np.int64)
+    dists = np.full((n_query, k), np.inf)
+    k = min(k, len(self.vertices))
+    if k == 0:
+      return indices, dists
+
+    corners = np.maximum(
+        np.abs(points - self.minima), np.abs(points - self.maxima))
+    max_rs = np.sqrt((corners*corners).sum(axis=1))
+
+    i_todo = np.arange(n_query)
+    r = self.div
+    while len(i_todo):
+      indptr, i_vertices, ds = self.query_radius_batch(points[i_todo], r)
+      is_done = (np.diff(indptr) >= k) | (r >= max_rs[i_todo])
+      i_firsts = indptr[:-1][is_done, np.newaxis] + np.arange(k)
+      indices[i_todo[is_done], :k] = i_vertices[i_firsts]
+      dists[i_todo[is_done], :k] = ds[i_firsts]
+      i_todo = i_todo[~is_done]
+      r *= 2.0
+    return indices, dists
+
+  def query_knn(self, point, k):
+    """
+    Returns arrays (indices, dists) of the k nearest vertices to
+    point, sorted by distance.
+    """
+    indices, dists = self.query_knn_batch([point], k)
+    k = min(k, len(self.vertices))
+    return indices[0, :k], dists[0, :k]
+
+  def query_ray(self, origin, direction, r, n_chunk=32):
+    """
+    Returns (i, t) of the first vertex whose sphere of radius r is
+    hit by the ray origin + t*direction, t >= 0, with direction
+    normalized, or (-1, inf) if there is none. The ray is marched
+    through the grid n_chunk cells at a time, only testing the
+    vertices in cells within r of those cells, and stops at the
+    first chunk whose nearest hit lies within it.
+    """
+    origin = np.asarray(origin, dtype=np.float64)
+    direction = np.asarray(direction, dtype=np.float64)
+    direction = direction/np.sqrt((direction*direction).sum())
+    if len(self.vertices) == 0:
+      return -1, np.inf
+
+    # clip the ray to the grid grown by r
+    lo = self.minima - r
+    hi = self.maxima + r
+    is_flat = direction == 0
+    is_inside = (origin >= lo) & (origin <= hi)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      t_los = (lo - origin)/direction
+      t_his = (hi - origin)/direction
+    t_nears = np.where(
+        is_flat, np.where(is_inside, -np.inf, np.inf),
+        np.minimum(t_los, t_his))
+    t_fars = np.where(
+        is_flat, np.where(is_inside, np.inf, -np.inf),
+        np.maximum(t_los, t_his))
+    t_start = max(t_nears.max(), 0.0)
+    t_end = t_fars.min()
+    if t_start > t_end:
+      return -1, np.inf
+
+    # the t where the ray crosses a cell boundary, which splits it
+    # into the segments that lie in one cell each
+    ts = [[t_start, t_end]]
+    for i_dim in np.nonzero(~is_flat)[0]:
+      ks = np.sort([
+          (origin[i_dim] + t*direction[i_dim] - self.minima[i_dim])*self.inv_div
+          for t in (t_start, t_end)])
+      ks = np.arange(math.ceil(ks[0]), math.floor(ks[1]) + 1)
+      boundaries = self.minima[i_dim] + ks*self.div
+      ts.append((boundaries - origin[i_dim])/direction[i_dim])
+    ts = np.unique(np.clip(np.concatenate(ts), t_start, t_end))
+    if len(ts) == 1:
+      ts = np.array([t_start, t_end])
+    mids = 0.5*(ts[:-1] + ts[1:])
+    spaces = np.floor(
+        (origin + mids[:,np.newaxis]*direction - self.minima)*self.inv_div
+        ).astype(np.int64)
+
+    r_sq = r*r
+    for i in range(0, len(spaces), n_chunk):
+      chunk = spaces[i:i+n_chunk]
+      i_cells = np.unique(np.concatenate([
+          self.find_cells(chunk + offset)
+          for offset in self.get_query_offsets(r, chunk)]))
+      i_cells = i_cells[i_cells >= 0]
+      if len(i_cells) == 0:
+        continue
+      i_sorted = expand_cell_pairs(
+          np.zeros(len(i_cells), dtype=np.int64),
+          np.ones(len(i_cells), dtype=np.int64),
+          self.cell_starts[i_cells], self.cell_counts[i_cells])[1]
+      i_vertices = self.order[i_sorted]
+      diff = self.vertices[i_vertices] - origin
+      bs = diff.dot(direction)
+      discs = bs*bs - (diff*diff).sum(axis=1) + r_sq
+      is_hit = (discs >= 0) & (bs + np.sqrt(np.maximum(discs, 0)) >= 0)
+      if not np.any(is_hit):
+        continue
+      i_vertices = i_vertices[is_hit]
+      t_hits = np.maximum(bs[is_hit] - np.sqrt(discs[is_hit]), 0.0)
+      i_first = np.lexsort((i_vertices, t_hits))[0]
+      # a nearer hit beyond this chunk would have been in this chunk
+      if t_hits[i_first] <= ts[min(i + n_chunk, len(ts) - 1)]:
+        return int(i_vertices[i_first]), float(t_hits[i_first])
+    return -1, np.inf
+
+
+class VerletList(object):
+  """
+  Neighbour list of the vertex pairs closer than cutoff, kept while
+  the vertices move, as in MD codes. Candidate pairs are found with
+  a SpaceHash at cutoff + skin and are only re-filtered by distance
+  until some vertex has moved more than skin/2 since the last build,
+  which cannot have let any other pair within cutoff.
+  """
+
+  def __init__(self, cutoff, skin=1.0):
+    self.cutoff = cutoff
+    self.skin = skin
+    self.built_vertices = None
+    self.n_build = 0
+
+  def build(self, vertices):
+    r = self.cutoff + self.skin
+    self.built_vertices = vertices.copy()
+    self.i_candidates, self.j_candidates, dists = \
+        SpaceHash(vertices, div=r).close_pair_arrays(r)
+    self.n_build += 1
+
+  def is_stale(self, vertices):
+    if self.built_vertices is None:
+      return True
+    if len(vertices) != len(self.built_vertices):
+      return True
+    if len(vertices) == 0:
+      return False
+    diff = vertices - self.built_vertices
+    max_move = 0.5*self.skin
+    return (diff*diff).sum(axis=1).max() > max_move*max_move
+
+  def close_pair_arrays(self, vertices):
+    """
+    Returns arrays (i, j, d) of all vertex pairs i < j closer than
+    cutoff, with their distances d, sorted by i then j, as in
+    SpaceHash.close_pair_arrays. The vertices must be the same
+    points, in the same order, on every call.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    if self.is_stale(vertices):
+      self.build(vertices)
+    i_pairs, j_pairs = self.i_candidates, self.j_candidates
+    diff = vertices[i_pairs] - vertices[j_pairs]
+    dists_sq = (diff*diff).sum(axis=1)
+    is_close = dists_sq < self.cutoff*self.cutoff
+    return i_pairs[is_close], j_pairs[is_close], np.sqrt(dists_sq[is_close])
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+Binary container of named numpy arrays that is opened by memory-
+mapping, used to store converted structures so that they load in
+milliseconds without parsing.
+
+Layout, all integers little-endian:
+
+    0   8 bytes   magic 'PYBALLSF'
+    8   uint32    byte-order marker 0x01020304
+    12  uint32    format version
+    16  uint64    length of the JSON header
+    24  JSON      {'arrays': {name: {'dtype', 'shape', 'offset'}},
+                   'meta': {...}}
+    ... arrays, each aligned to 64 bytes, with offsets counted
+        from the first aligned byte after the JSON header
+
+Arrays are always written little-endian, and their dtypes carry
+an explicit byte order, so files can be read on any host.
+"""
+
+
+import os
+import json
+import struct
+
+import numpy as np
+
+
+magic = 'PYBALLSF'
+byte_order_marker = 0x01020304
+format_version = 1
+alignment = 64
+
+header_struct = struct.Struct('<8sIIQ')
+
+
+def align(n):
+  return (n + alignment - 1)//alignment*alignment
+
+
+def dtype_to_json(dtype):
+  if dtype.fields is None:
+    return dtype.str
+  return dtype.descr
+
+
+def json_to_dtype(descr):
+  def to_tuple(field):
+    return tuple(to_tuple(x) if isinstance(x, list) else x for x in field)
+  if isinstance(descr, list):
+    return np.dtype([to_tuple(field) for field in descr])
+  return np.dtype(str(descr))
+
+
+def to_little_endian(array):
+  array = np.asarray(array)
+  dtype = array.dtype.newbyteorder('<')
+  if array.dtype != dtype:
+    array = array.astype(dtype)
+  return np.ascontiguousarray(array)
+
+
+def is_struct_file(fname):
+  try:
+    with open(fname, 'rb') as f:
+      return f.read(len(magic)) == magic
+  except IOError:
+    return False
+
+
+def write_struct_file(fname, arrays, meta=None):
+  """
+  Writes the dict of arrays and the JSON-able meta to fname. The
+  file is written under a temporary name first, so that readers
+  never see a partial file.
+  """
+  arrays = dict((name, to_little_endian(a)) for name, a in arrays.items())
+  entries = {}
+  offset = 0
+  for name in sorted(arrays):
+    array = arrays[name]
+    entries[name] = {
+      'dtype': dtype_to_json(array.dtype),
+      'shape': list(array.shape),
+      'offset': offset,
+    }
+    offset = align(offset + array.nbytes)
+  header = json.dumps({'arrays': entries, 'meta': meta or {}})
+
+  data_start = align(header_struct.size + len(header))
+  tmp_fname = fname + '.tmp'
+  with open(tmp_fname, 'wb') as f:
+    f.write(header_struct.pack(
+        magic, byte_order_marker, format_version, len(header)))
+    f.write(header)
+    for name in sorted(arrays):
+      f.seek(data_start + entries[name]['offset'])
+      f.write(arrays[name].tobytes())
+    f.truncate(data_start + offset)
+  os.rename(tmp_fname, fname)
+
+
+def read_struct_file(fname):
+  """
+  Returns (arrays, meta) of a file written by write_struct_file,
+  with every array memory-mapped read-only. Raises ValueError if
+  the file is not a struct file, comes from a newer version, has
+  the wrong byte order or is truncated.
+  """
+  with open(fname, 'rb') as f:
+    fixed = f.read(header_struct.size)
+    if len(fixed) < header_struct.size or not fixed.startswith(magic):
+      raise ValueError('%s is not a pyball struct file' % fname)
+    file_magic, marker, version, header_size = header_struct.unpack(fixed)
+    if marker == struct.unpack('>I', struct.pack('<I', byte_order_marker))[0]:
+      raise ValueError('%s was written with a big-endian header' % fname)
+    if marker != byte_order_marker:
+      raise ValueError(
+          '%s has an unknown byte-order marker 0x%08x' % (fname, marker))
+    if version > format_version:
+      raise ValueError(
+          '%s has format version %d, newer than the supported %d' %
+          (fname, version, format_version))
+    header = json.loads(f.read(header_size))
+  data_start = align(header_struct.size + header_size)
+  file_size = os.path.getsize(fname)
+
+  arrays = {}
+  for name, entry in header['arrays'].items():
+    dtype = json_to_dtype(entry['dtype'])
+    shape = tuple(entry['shape'])
+    offset = data_start + entry['offset']
+    n_byte = dtype.itemsize*int(np.prod(shape))
+    if offset + n_byte > file_size:
+      raise ValueError('%s is truncated at array %s' % (fname, name))
+    if n_byte == 0:
+      arrays[str(name)] = np.zeros(shape, dtype=dtype)
+    else:
+      arrays[str(name)] = np.memmap(
+          fname, dtype=dtype, mode='r', offset=offset, shape=shape)
+  return arrays, header['meta']
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""
+Memory-mapped reader of MD trajectories, and a prefetcher that
+streams their frames into a ring buffer on a worker thread.
+
+Two formats are read:
+
+    DCD   CHARMM/NAMD/X-PLOR binary trajectories, in either byte
+          order, with or without unit cell records
+    raw   headerless float32 coordinates, n_frame*n_atom*3 values
+          in native byte order, one frame after the other
+
+Frames are (n_atom, 3) float32 views into the mapped file, so
+opening a trajectory reads only its header. In DCD files the x, y
+and z of a frame are separate Fortran records, which a strided view
+still covers without copying.
+"""
+
+
+import os
+import time
+import struct
+import threading
+
+import numpy as np
+
+
+dcd_magic = 'CORD'
+
+
+def read_dcd_header(f):
+  """
+  Returns (n_atom, byte_order, frame_offset, frame_size,
+  cell_size) of the open DCD file f, where cell_size is the length
+  of the unit cell record that starts every frame, or 0.
+  """
+  fixed = f.read(92)
+  if len(fixed) < 92 or fixed[4:8] != dcd_magic:
+    raise ValueError('not a DCD file')
+  for byte_order in '<>':
+    if struct.unpack(byte_order + 'i', fixed[:4])[0] == 84:
+      break
+  else:
+    raise ValueError('DCD file has a bad header record')
+  icntrl = struct.unpack(byte_order + '20i', fixed[8:88])
+  is_charmm = icntrl[19] != 0
+  if icntrl[8] != 0:
+    raise ValueError('DCD files with fixed atoms are not supported')
+  if is_charmm and icntrl[11] != 0:
+    raise ValueError('DCD files with 4D coordinates are not supported')
+  cell_size = 4 + 48 + 4 if is_charmm and icntrl[10] != 0 else 0
+
+  title_size = struct.unpack(byte_order + 'i', f.read(4))[0]
+  f.seek(title_size + 4, os.SEEK_CUR)
+  marker, n_atom, marker = struct.unpack(byte_order + '3i', f.read(12))
+  if marker != 4:
+    raise ValueError('DCD file has a bad atom count record')
+
+  frame_offset = f.tell()
+  frame_size = cell_size + 3*(4 + 4*n_atom + 4)
+  return n_atom, byte_order, frame_offset, frame_size, cell_size
+
+
+def is_dcd_file(fname):
+  try:
+    with open(fname, 'rb') as f:
+      return f.read(8)[4:] == dcd_magic
+  except IOError:
+    return False
+
+
+class Trajectory():
+  """
+  Frames of a DCD or raw float32 trajectory file, memory-mapped.
+  If n_atom is given, such as the number of atoms in the table the
+  frames belong to, the file must match it; raw files need it.
+  self.frames is an (n_frame, n_atom, 3) float32 view of the file.
+  """
+  def __init__(self, fname, n_atom=None):
+    self.fname = fname
+    file_size = os.path.getsize(fname)
+    if is_dcd_file(fname):
+      with open(fname, 'rb') as f:
+        file_n_atom, byte_order, offset, frame_size, cell_size = \
+            read_dcd_header(f)
+      if n_atom is not None and n_atom != file_n_atom:
+        raise ValueError('%s has %d atoms, not %d' % (
+            fname, file_n_atom, n_atom))
+      n_atom = file_n_atom
+      n_frame = (file_size - offset)//frame_size
+      dtype = np.dtype(byte_order + 'f4')
+      # x, y and z each sit in their own record after the unit cell
+      first = offset + cell_size + 4
+      strides = (frame_size, dtype.itemsize, 4*n_atom + 8)
+    else:
+      if n_atom is None:
+        raise ValueError('%s is raw, n_atom must be given' % fname)
+      frame_size = 12*n_atom
+      if frame_size == 0 or file_size % frame_size != 0:
+        raise ValueError('%s is not %d-atom float32 frames' % (fname, n_atom))
+      n_frame = file_size//frame_size
+      dtype = np.dtype(np.float32)
+      first = 0
+      strides = (frame_size, 12, 4)
+
+    self.n_atom = n_atom
+    if n_frame == 0:
+      self.frames = np.zeros((0, n_atom, 3), dtype=dtype)
+    else:
+      self.mmap = np.memmap(fname, dtype=np.uint8, mode='r')
+      self.frames = np.ndarray(
+          (n_frame, n_atom, 3), dtype=dtype, buffer=self.mmap,
+          offset=first, strides=strides)
+
+  def __len__(self):
+    return len(self.frames)
+
+  def __getitem__(self, i_frame):
+    return self.frames[i_frame]
+
+
+def write_raw(fname, frames):
+  np.asarray(frames, dtype=np.float32).tofile(fname)
+
+
+def write_dcd(fname, frames, cells=None):
+  """
+  Writes the (n_frame, n_atom, 3) frames to a little-endian CHARMM
+  DCD file, with a unit cell record per frame if cells holds the
+  (n_frame, 6) cell parameters.
+  """
+  frames = np.asarray(frames, dtype='<f4')
+  n_frame, n_atom = frames.shape[:2]
+  icntrl = [0]*20
+  icntrl[0] = n_frame
+  icntrl[10] = 1 if cells is not None else 0
+  icntrl[19] = 24
+  def record(data):
+    return struct.pack('<i', len(data)) + data + struct.pack('<i', len(data))
+  with open(fname, 'wb') as f:
+    f.write(record(dcd_magic + struct.pack('<20i', *icntrl)))
+    f.write(record(struct.pack('<i', 1) + 'pyball trajectory'.ljust(80)))
+    f.write(record(struct.pack('<i', n_atom)))
+    for i_frame in range(n_frame):
+      if cells is not None:
+        f.write(record(np.asarray(cells[i_frame], dtype='<f8').tobytes()))
+      for k in range(3):
+        f.write(record(np.ascontiguousarray(frames[i_frame,:,k]).tobytes()))
+
+
+class FramePrefetcher():
+  """
+  Plays the frames of a Trajectory, or of any (n_frame, n_atom, 3)
+  array, by copying the next frames into a ring buffer of n_slot
+  frames on a worker thread, so that page faults on the mapped file
+  never happen on the caller's thread.
+
+  next_frame is polled, typically from a timer, and never blocks:
+  it returns None until the next frame is both due, at fps, and
+  loaded. Frames advance by stride and loop at the end.
+  """
+  def __init__(self, frames, n_slot=8, stride=1, fps=None):
+    self.frames = frames
+    self.n_frame = len(frames)
+    n_atom = frames[0].shape[0] if self.n_frame else 0
+    self.ring = np.zeros((n_slot, n_atom, 3), dtype=np.float32)
+    self.slot_frames = [-1]*n_slot
+    self.stride = stride
+    self.fps = fps
+    self.i_frame = 0
+    self.last_time = None
+    self.is_closed = False
+    self.condition = threading.Condition()
+    self.thread = threading.Thread(target=self.prefetch)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def get_window(self):
+    """
+    Returns the frames that should be in the ring, in order.
+    """
+    n = min(len(self.ring), self.n_frame)
+    return [(self.i_frame + k*self.stride) % self.n_frame for k in range(n)]
+
+  def prefetch(self):
+    while True:
+      with self.condition:
+        while True:
+          if self.is_closed:
+            return
+          window = self.get_window()
+          missing = [i for i in window if i not in self.slot_frames]
+          if missing:
+            break
+          self.condition.wait()
+        i_frame = missing[0]
+        i_slot = [
+            i for i, j in enumerate(self.slot_frames) if j not in window][0]
+        self.slot_frames[i_slot] = -1
+      # the only read of the mapped file, outside the lock
+      self.ring[i_slot] = self.frames[i_frame]
+      with self.condition:
+        self.slot_frames[i_slot] = i_frame
+        self.condition.notify_all()
+
+  def get_frame(self, i_frame):
+    """
+    Returns the ring slot holding i_frame, or None if it is not
+    loaded yet. The slot is valid until the window moves on.
+    """
+    with self.condition:
+      if i_frame in self.slot_frames:
+        return self.ring[self.slot_frames.index(i_frame)]
+    return None
+
+  def seek(self, i_frame):
+    with self.condition:
+      self.i_frame = i_frame % self.n_frame
+      self.last_time = None
+      self.condition.notify_all()
+
+  def set_stride(self, stride):
+    with self.condition:
+      self.stride = max(1, stride)
+      self.condition.notify_all()
+
+  def next_frame(self, now=None):
+    """
+    Returns (i_frame, positions) of the next frame if it is due
+    and loaded, otherwise None.
+    """
+    if self.n_frame == 0:
+      return None
+    if now is None:
+      now = time.time()
+    if self.fps and self.last_time is not None:
+      if now - self.last_time < 1.0/self.fps:
+        return None
+    if self.last_time is None:
+      i_frame = self.i_frame
+    else:
+      i_frame = (self.i_frame + self.stride) % self.n_frame
+    positions = self.get_frame(i_frame)
+    if positions is None:
+      return None
+    with self.condition:
+      self.i_frame = i_frame
+      self.condition.notify_all()
+    self.last_time = now
+    return i_frame, positions
+
+  def close(self):
+    with self.condition:
+      self.is_closed = True
+      self.condition.notify_all()
+    self.thread.join()